@@ -1,5 +1,6 @@
 import os
 import sys
+import secrets
 import threading
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -13,11 +14,15 @@ db = SQLAlchemy()
 from routes.user import user_bp
 from routes.deals import deals_bp
 from routes.payments import payments_bp
-from routes.monitoring import monitoring_bp, set_payment_monitor
+from routes.monitoring import monitoring_bp, set_payment_monitor, set_webhook_consumer, set_address_pool
 from routes.disputes import disputes_bp, set_dispute_manager
+from routes.telegram_webhook import telegram_webhook_bp, set_telegram_bot, set_update_forwarding
+from routes.broadcasts import broadcasts_bp
 from telegram_bot import OTCBot
 from services.payment_monitor import PaymentMonitor
 from services.dispute_manager import DisputeManager
+from services.webhook_consumer import WebhookConsumer
+from services.address_pool import DepositAddressPool
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -28,6 +33,8 @@ app.register_blueprint(deals_bp, url_prefix='/api')
 app.register_blueprint(payments_bp, url_prefix='/api')
 app.register_blueprint(monitoring_bp, url_prefix='/api')
 app.register_blueprint(disputes_bp, url_prefix='/api')
+app.register_blueprint(telegram_webhook_bp, url_prefix='/api')
+app.register_blueprint(broadcasts_bp, url_prefix='/api')
 
 # إعداد قاعدة البيانات
 db_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database')
@@ -37,6 +44,14 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
 
+# مستهلك webhooks (يبدأ عند وصول أول webhook أو عند تشغيل الخادم)
+webhook_consumer = WebhookConsumer(app)
+set_webhook_consumer(webhook_consumer)
+
+# مجمع عناوين الإيداع الجاهزة (تتم تعبئته في الخلفية عند تشغيل الخادم)
+address_pool = DepositAddressPool(app)
+set_address_pool(address_pool)
+
 # متغير البوت العام
 bot_instance = None
 
@@ -84,11 +99,39 @@ def get_users():
 # إعداد البوت
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
+# وضع استقبال التحديثات: polling أو webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # مثال: https://example.com/api/telegram/webhook
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+
+# دور العملية: all (الـ API والبوت معاً)، api (الـ API فقط)، bot (البوت ومستقبل webhook)،
+# receiver (الـ API ومستقبل webhook يحفظ التحديثات في صندوق الوارد)،
+# handlers (معالجات البوت تقرأ صندوق الوارد، بدون خادم HTTP)
+APP_ROLE = os.getenv('APP_ROLE', 'all')
+
+if APP_ROLE == 'handlers':
+    # عملية المعالجات تسجل الـ webhook لدى Telegram ليشير إلى عملية المستقبل
+    BOT_MODE = 'webhook'
+
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    print("تحذير: لم يتم تعيين WEBHOOK_URL. سيتم استخدام وضع polling.")
+    BOT_MODE = 'polling'
+
+if APP_ROLE in ('receiver', 'handlers') and not os.getenv('WEBHOOK_SECRET'):
+    print("تحذير: يجب تعيين نفس WEBHOOK_SECRET لعمليتي المستقبل والمعالجات.")
+
+if APP_ROLE == 'receiver':
+    set_update_forwarding(WEBHOOK_SECRET)
+
 def start_bot():
     """تشغيل البوت في thread منفصل"""
     global bot_instance
     if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE':
-        bot_instance = OTCBot(BOT_TOKEN, app)
+        bot_instance = OTCBot(BOT_TOKEN, app, update_queue_size=UPDATE_QUEUE_SIZE,
+                              max_concurrent_updates=MAX_CONCURRENT_UPDATES)
+        set_telegram_bot(bot_instance)
         
         # إنشاء مراقب المدفوعات
         payment_monitor = PaymentMonitor(app, bot_instance)
@@ -117,12 +160,13 @@ def start_bot():
         monitor_thread.start()
         
         # تشغيل البوت
-        bot_instance.run()
+        bot_instance.run(BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, from_inbox=APP_ROLE == 'handlers')
     else:
         print("تحذير: لم يتم تعيين توكن البوت. البوت لن يعمل.")
 
 # تشغيل البوت في thread منفصل
-if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE':
+bot_thread = None
+if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE' and APP_ROLE in ('all', 'bot', 'handlers'):
     bot_thread = threading.Thread(target=start_bot, daemon=True)
     bot_thread.start()
 
@@ -143,12 +187,48 @@ def serve(path):
             return "index.html not found", 404
 
 
+def _cli_option(name):
+    """قراءة قيمة خيار من سطر الأوامر"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return None
+
 if __name__ == '__main__':
     if '--init-db' in sys.argv:
         with app.app_context():
             print("Creating database tables...")
             db.create_all()
             print("Database tables created successfully!")
+    elif '--migrate' in sys.argv:
+        # إضافة الجداول والأعمدة والفهارس الجديدة إلى قاعدة بيانات موجودة
+        from services.schema_migrations import SchemaMigrator
+        
+        result = SchemaMigrator(app).migrate()
+        print(f"Added {len(result['added_columns'])} columns and created {len(result['created'])} indexes in {result['elapsed']}s")
+        for name in result['added_columns'] + result['created']:
+            print(f"  + {name}")
+    elif '--replay-payment-events' in sys.argv:
+        # إعادة بناء حالة الدفع من سجل أحداث الدفع
+        # مثال: python src/main.py --replay-payment-events --order <deal_id> --since 2025-01-01
+        from datetime import datetime
+        from services.payment_events import PaymentEventStore
+        
+        since = _cli_option('--since')
+        stats = PaymentEventStore(app).replay(
+            order_id=_cli_option('--order'),
+            since=datetime.fromisoformat(since) if since else None
+        )
+        print(f"Replayed {stats['events']} events in {stats['elapsed']}s: "
+              f"{stats['confirmed']} deals confirmed, {stats['missing_deals']} events without deal")
+    elif (APP_ROLE == 'bot' and BOT_MODE == 'polling') or APP_ROLE == 'handlers':
+        # البوت فقط بوضع polling أو بقراءة صندوق الوارد: لا حاجة لخادم HTTP
+        if bot_thread:
+            bot_thread.join()
     else:
+        # معالجة أي أحداث متبقية في صندوق الوارد
+        webhook_consumer.start()
+        address_pool.start()
         app.run(host='0.0.0.0', port=5000, debug=True)
 
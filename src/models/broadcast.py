@@ -0,0 +1,65 @@
+import json
+from datetime import datetime
+from src.main import db
+
+class BroadcastCampaign(db.Model):
+    """حملة رسالة جماعية لكل المستخدمين النشطين، مع نقطة استئناف بعد إعادة التشغيل"""
+    __tablename__ = 'broadcast_campaigns'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    message = db.Column(db.Text, nullable=False)
+    keyboard = db.Column(db.Text)  # JSON: صفوف أزرار inline_keyboard
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, paused, completed, cancelled, failed
+    last_user_id = db.Column(db.BigInteger, nullable=False, default=0)  # آخر telegram_id تمت معالجته
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    blocked_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_broadcast_campaigns_status_id', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'message': self.message,
+            'keyboard': json.loads(self.keyboard) if self.keyboard else None,
+            'status': self.status,
+            'last_user_id': self.last_user_id,
+            'sent_count': self.sent_count,
+            'failed_count': self.failed_count,
+            'blocked_count': self.blocked_count,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class BroadcastRecipient(db.Model):
+    """نتيجة إرسال الحملة لمستخدم واحد"""
+    __tablename__ = 'broadcast_recipients'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('broadcast_campaigns.id'), nullable=False)
+    telegram_id = db.Column(db.BigInteger, nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # sent, failed, blocked
+    error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('campaign_id', 'telegram_id', name='uq_broadcast_recipient'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'campaign_id': self.campaign_id,
+            'telegram_id': self.telegram_id,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
@@ -0,0 +1,21 @@
+from datetime import datetime
+from src.main import db
+
+class ConversationState(db.Model):
+    """حالة محادثة مستخدم داخل خطوات البوت (إنشاء صفقة، فتح نزاع) حتى تستمر بعد إعادة التشغيل"""
+    __tablename__ = 'conversation_states'
+
+    telegram_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    flow = db.Column(db.String(30), nullable=False)  # deal_creation, dispute
+    step = db.Column(db.String(30), nullable=False)
+    data = db.Column(db.Text)  # JSON
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def to_dict(self):
+        return {
+            'telegram_id': self.telegram_id,
+            'flow': self.flow,
+            'step': self.step,
+            'data': self.data,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
@@ -13,12 +13,23 @@ class Deal(db.Model):
     price = db.Column(db.Float, nullable=False)
     commission = db.Column(db.Float, nullable=False, default=0.05)  # 5% عمولة
     total_price = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, paid, confirmed, completed, disputed
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, paid, underpaid, confirmed, completed, disputed
     media_files = db.Column(db.Text, nullable=True)  # JSON string للصور والفيديوهات
     payment_id = db.Column(db.String(100), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_deals_status_created', 'status', 'created_at'),
+        db.Index('ix_deals_seller_created', 'seller_id', 'created_at'),
+        db.Index('ix_deals_buyer_created', 'buyer_id', 'created_at'),
+        db.Index('ix_deals_created_at', 'created_at'),
+        # فهرس جزئي للصفقات التي ينتظر مراقب الدفع دفعها فقط (جزء صغير من الجدول)
+        db.Index('ix_deals_awaiting_payment', 'status', 'created_at', 'id',
+                 sqlite_where=db.text("status = 'pending' AND payment_id IS NOT NULL"),
+                 postgresql_where=db.text("status = 'pending' AND payment_id IS NOT NULL")),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
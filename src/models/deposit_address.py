@@ -0,0 +1,37 @@
+from datetime import datetime
+from src.main import db
+
+class DepositAddress(db.Model):
+    """عنوان إيداع مُنشأ مسبقاً لدى CCPayment وجاهز للربط بصفقة"""
+    __tablename__ = 'deposit_addresses'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    order_ref = db.Column(db.String(64), nullable=False, unique=True)  # orderId المستخدم لدى CCPayment
+    coin_type = db.Column(db.String(20), nullable=False)
+    network = db.Column(db.String(20), nullable=False)
+    address = db.Column(db.String(200), nullable=False)
+    memo = db.Column(db.String(100))
+    status = db.Column(db.String(20), nullable=False, default='available')  # available, bound
+    deal_id = db.Column(db.String(36), nullable=True, index=True)
+    expected_amount = db.Column(db.Float)  # مبلغ الصفقة عند الربط، لأن عنوان المجمع يُنشأ بدون مبلغ
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    bound_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_deposit_addresses_pool', 'coin_type', 'network', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'order_ref': self.order_ref,
+            'coin_type': self.coin_type,
+            'network': self.network,
+            'address': self.address,
+            'memo': self.memo,
+            'status': self.status,
+            'deal_id': self.deal_id,
+            'expected_amount': self.expected_amount,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'bound_at': self.bound_at.isoformat() if self.bound_at else None
+        }
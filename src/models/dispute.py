@@ -29,6 +29,10 @@ class Dispute(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_disputes_deal_status', 'deal_id', 'status'),
+    )
+    
     def __init__(self, id, deal_id, reporter_id, reported_id, reason, description, evidence=None):
         self.id = id
         self.deal_id = deal_id
@@ -74,6 +78,10 @@ class UserRating(db.Model):
     # معلومات إضافية
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_user_ratings_rated_rating', 'rated_id', 'rating'),
+    )
+    
     def __init__(self, deal_id, rater_id, rated_id, rating, comment=None):
         self.deal_id = deal_id
         self.rater_id = rater_id
@@ -113,6 +121,10 @@ class SecurityLog(db.Model):
     # معلومات إضافية
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_security_logs_created_at', 'created_at'),
+    )
+    
     def __init__(self, user_id, event_type, description, severity='info', ip_address=None, user_agent=None, additional_data=None):
         self.user_id = user_id
         self.event_type = event_type
@@ -159,6 +171,10 @@ class UserBan(db.Model):
     lifted_at = db.Column(db.DateTime)
     lift_reason = db.Column(db.Text)
     
+    __table_args__ = (
+        db.Index('ix_user_bans_user_active', 'user_id', 'is_active'),
+    )
+    
     def __init__(self, user_id, banned_by, reason, description=None, ban_type='temporary', expires_at=None):
         self.user_id = user_id
         self.banned_by = banned_by
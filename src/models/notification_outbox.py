@@ -0,0 +1,41 @@
+from datetime import datetime
+from src.main import db
+
+class NotificationOutbox(db.Model):
+    """صندوق صادر الإشعارات: يُكتب مع تحديث الصفقة في نفس المعاملة ويُرسل لاحقاً"""
+    __tablename__ = 'notification_outbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    dedupe_key = db.Column(db.String(150), unique=True, nullable=False)  # kind:key:chat_id
+    kind = db.Column(db.String(50), nullable=False)
+    deal_id = db.Column(db.String(36))
+    chat_id = db.Column(db.BigInteger, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    reply_markup = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'dedupe_key': self.dedupe_key,
+            'kind': self.kind,
+            'deal_id': self.deal_id,
+            'chat_id': self.chat_id,
+            'text': self.text,
+            'reply_markup': self.reply_markup,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
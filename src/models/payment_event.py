@@ -0,0 +1,31 @@
+from datetime import datetime
+from src.main import db
+
+class PaymentEvent(db.Model):
+    """سجل أحداث الدفع (إضافة فقط) - كل حدث فريد حسب (orderId, txId, status)"""
+    __tablename__ = 'payment_events'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    order_id = db.Column(db.String(64), nullable=False)
+    tx_id = db.Column(db.String(128), nullable=False, default='')  # فارغ بدلاً من NULL حتى يعمل القيد الفريد
+    status = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.String(50))
+    source = db.Column(db.String(20), nullable=False, default='webhook')  # webhook, monitor
+    payload = db.Column(db.Text)  # JSON الخام
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('order_id', 'tx_id', 'status', name='uq_payment_events_order_tx_status'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'order_id': self.order_id,
+            'tx_id': self.tx_id,
+            'status': self.status,
+            'amount': self.amount,
+            'source': self.source,
+            'payload': self.payload,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
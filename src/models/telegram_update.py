@@ -0,0 +1,28 @@
+from datetime import datetime
+from src.main import db
+
+class TelegramUpdateInbox(db.Model):
+    """تحديثات Telegram التي استقبلتها عملية المستقبل بانتظار عملية المعالجات"""
+    __tablename__ = 'telegram_update_inbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    update_id = db.Column(db.BigInteger, unique=True, nullable=False)  # يمنع تكرار تحديث أعاد Telegram إرساله
+    payload = db.Column(db.Text, nullable=False)  # JSON الخام كما وصل
+    # التحديث يبقى بعد سحبه (claimed) حتى يستمر منع التكرار، ويُحذف لاحقاً حسب عمره
+    status = db.Column(db.String(20), nullable=False, default='pending', server_default='pending')  # pending, claimed
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_telegram_update_inbox_status_id', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'update_id': self.update_id,
+            'payload': self.payload,
+            'status': self.status,
+            'received_at': self.received_at.isoformat() if self.received_at else None,
+            'claimed_at': self.claimed_at.isoformat() if self.claimed_at else None
+        }
@@ -0,0 +1,31 @@
+from datetime import datetime
+from src.main import db
+
+class WebhookInbox(db.Model):
+    """صندوق وارد webhooks الخاصة بـ CCPayment قبل معالجتها"""
+    __tablename__ = 'webhook_inbox'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    source = db.Column(db.String(20), nullable=False, default='ccpayment')
+    payload = db.Column(db.Text, nullable=False)  # JSON الخام كما وصل
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processed, duplicate, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_webhook_inbox_status_id', 'status', 'id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'source': self.source,
+            'payload': self.payload,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'received_at': self.received_at.isoformat() if self.received_at else None,
+            'processed_at': self.processed_at.isoformat() if self.processed_at else None
+        }
@@ -0,0 +1,118 @@
+from flask import Blueprint, request, jsonify
+import json
+import logging
+from models.broadcast import BroadcastCampaign, BroadcastRecipient
+from models.deal import db
+from sqlalchemy import func
+from telegram import InlineKeyboardMarkup
+
+broadcasts_bp = Blueprint('broadcasts', __name__)
+logger = logging.getLogger(__name__)
+
+# الانتقالات المسموحة لحالة الحملة من الـ API
+CAMPAIGN_ACTIONS = {
+    'pause': (('pending', 'running'), 'paused'),
+    'resume': (('paused', 'failed'), 'running'),
+    'cancel': (('pending', 'running', 'paused'), 'cancelled')
+}
+
+@broadcasts_bp.route('/broadcasts', methods=['POST'])
+def create_campaign():
+    """إنشاء حملة بث لكل المستخدمين النشطين (يرسلها البوت في الخلفية)"""
+    try:
+        data = request.get_json() or {}
+
+        message = (data.get('message') or '').strip()
+        if not message:
+            return jsonify({'success': False, 'error': 'Missing message'}), 400
+
+        keyboard = data.get('keyboard')
+        if keyboard is not None:
+            # نفس التحويل الذي يستخدمه البوت عند الإرسال، حتى لا تُحفظ حملة لا يمكن إرسالها
+            try:
+                InlineKeyboardMarkup.de_json({'inline_keyboard': keyboard}, None)
+            except Exception:
+                return jsonify({'success': False, 'error': 'Keyboard must be a list of inline button rows'}), 400
+
+        campaign = BroadcastCampaign(
+            message=message,
+            keyboard=json.dumps(keyboard) if keyboard else None
+        )
+        db.session.add(campaign)
+        db.session.commit()
+
+        return jsonify({
+            'success': True,
+            'campaign': campaign.to_dict()
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error creating broadcast campaign: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
+@broadcasts_bp.route('/broadcasts', methods=['GET'])
+def list_campaigns():
+    """آخر حملات البث"""
+    try:
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        campaigns = BroadcastCampaign.query.order_by(BroadcastCampaign.id.desc()).limit(limit).all()
+
+        return jsonify({
+            'success': True,
+            'campaigns': [campaign.to_dict() for campaign in campaigns]
+        })
+
+    except Exception as e:
+        logger.error(f"Error listing broadcast campaigns: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
+@broadcasts_bp.route('/broadcasts/<int:campaign_id>', methods=['GET'])
+def get_campaign(campaign_id):
+    """تفاصيل حملة مع توزيع نتائج المستلمين"""
+    try:
+        campaign = BroadcastCampaign.query.get(campaign_id)
+        if not campaign:
+            return jsonify({'success': False, 'error': 'Campaign not found'}), 404
+
+        outcomes = dict(db.session.query(
+            BroadcastRecipient.status, func.count(BroadcastRecipient.id)
+        ).filter(BroadcastRecipient.campaign_id == campaign_id).group_by(BroadcastRecipient.status).all())
+
+        return jsonify({
+            'success': True,
+            'campaign': campaign.to_dict(),
+            'outcomes': outcomes
+        })
+
+    except Exception as e:
+        logger.error(f"Error getting broadcast campaign: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
+@broadcasts_bp.route('/broadcasts/<int:campaign_id>/<action>', methods=['POST'])
+def change_campaign_status(campaign_id, action):
+    """إيقاف حملة مؤقتاً أو استئنافها أو إلغاؤها"""
+    try:
+        if action not in CAMPAIGN_ACTIONS:
+            return jsonify({'success': False, 'error': 'Unknown action'}), 400
+
+        allowed, status = CAMPAIGN_ACTIONS[action]
+        # تحديث مشروط حتى لا يتعارض مع البوت الذي يحدث نفس الحملة
+        updated = BroadcastCampaign.query.filter(
+            BroadcastCampaign.id == campaign_id,
+            BroadcastCampaign.status.in_(allowed)
+        ).update({'status': status}, synchronize_session=False)
+        db.session.commit()
+
+        if updated != 1:
+            return jsonify({'success': False, 'error': 'Campaign not found or not in a valid state'}), 409
+
+        return jsonify({
+            'success': True,
+            'campaign': BroadcastCampaign.query.get(campaign_id).to_dict()
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error changing broadcast campaign status: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from models.deal import Deal, db
 from models.telegram_user import TelegramUser
+from services.outbox import PAYMENT_CONFIRMED, enqueue_notification
 
 deals_bp = Blueprint('deals', __name__)
 
@@ -112,6 +113,7 @@ def confirm_payment(deal_id):
         if payment_id:
             deal.payment_id = payment_id
         
+        enqueue_notification(deal, *PAYMENT_CONFIRMED)
         db.session.commit()
         
         return jsonify({
@@ -142,6 +144,7 @@ def release_funds(deal_id):
         
         # تحديث حالة الصفقة
         deal.status = 'completed'
+        enqueue_notification(deal, 'seller_funds_released', 'buyer_transaction_completed')
         db.session.commit()
         
         return jsonify({
@@ -174,6 +177,7 @@ def create_dispute(deal_id):
         
         # تحديث حالة الصفقة
         deal.status = 'disputed'
+        enqueue_notification(deal, 'dispute_created', reporter_id=user_id, reason=reason)
         db.session.commit()
         
         return jsonify({
@@ -4,6 +4,8 @@ from datetime import datetime, timedelta
 from models.deal import Deal, db
 from models.telegram_user import TelegramUser
 from services.payment_monitor import PaymentMonitor
+from services.ccpayment import ccpayment_registry, reload_ccpayment_service
+from services.webhook_guard import webhook_replay_guard
 from sqlalchemy import func
 
 monitoring_bp = Blueprint('monitoring', __name__)
@@ -12,11 +14,39 @@ logger = logging.getLogger(__name__)
 # متغير عام لمراقب المدفوعات
 payment_monitor = None
 
+# متغير عام لمستهلك webhooks
+webhook_consumer = None
+
+# متغير عام لمجمع عناوين الإيداع
+address_pool = None
+
 def set_payment_monitor(monitor):
     """تعيين مراقب المدفوعات"""
     global payment_monitor
     payment_monitor = monitor
 
+def get_payment_monitor():
+    """الحصول على مراقب المدفوعات الحالي"""
+    return payment_monitor
+
+def set_address_pool(pool):
+    """تعيين مجمع عناوين الإيداع"""
+    global address_pool
+    address_pool = pool
+
+def get_address_pool():
+    """الحصول على مجمع عناوين الإيداع"""
+    return address_pool
+
+def set_webhook_consumer(consumer):
+    """تعيين مستهلك webhooks"""
+    global webhook_consumer
+    webhook_consumer = consumer
+
+def get_webhook_consumer():
+    """الحصول على مستهلك webhooks الحالي"""
+    return webhook_consumer
+
 @monitoring_bp.route('/monitoring/stats', methods=['GET'])
 def get_monitoring_stats():
     """الحصول على إحصائيات المراقبة"""
@@ -35,6 +65,42 @@ def get_monitoring_stats():
         logger.error(f"Error getting monitoring stats: {str(e)}")
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+@monitoring_bp.route('/monitoring/webhooks', methods=['GET'])
+def get_webhook_stats():
+    """إحصائيات صندوق وارد webhooks (العمق والتأخير)"""
+    try:
+        if webhook_consumer:
+            stats = webhook_consumer.get_stats()
+        else:
+            stats = {'error': 'Webhook consumer not initialized'}
+        
+        stats['replay_guard'] = webhook_replay_guard.get_stats()
+        
+        return jsonify({
+            'success': True,
+            'stats': stats
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting webhook stats: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
+@monitoring_bp.route('/monitoring/address-pool', methods=['GET'])
+def get_address_pool_stats():
+    """مقاييس مجمع عناوين الإيداع"""
+    try:
+        if not address_pool:
+            return jsonify({'success': False, 'error': 'Address pool not initialized'}), 503
+        
+        return jsonify({
+            'success': True,
+            'stats': address_pool.get_stats()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting address pool stats: {str(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
 @monitoring_bp.route('/monitoring/deals', methods=['GET'])
 def get_deals_stats():
     """الحصول على إحصائيات الصفقات"""
@@ -185,17 +251,25 @@ def force_check_payment(deal_id):
         if not payment_monitor:
             return jsonify({'success': False, 'error': 'Payment monitor not available'}), 503
         
-        # تشغيل الفحص في الخلفية
-        import asyncio
+        deal = Deal.query.get(deal_id)
+        if not deal:
+            return jsonify({'success': False, 'error': 'Deal not found'}), 404
         
-        async def check_deal():
-            return await payment_monitor.force_check_deal(deal_id)
-        
-        # تشغيل المهمة غير المتزامنة
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(check_deal())
-        loop.close()
+        if payment_monitor.is_running:
+            # تقديم الصفقة إلى بداية طابور الفحص
+            payment_monitor.prioritize(deal.id, deal.created_at)
+            result = True
+        else:
+            # المراقب متوقف: تشغيل الفحص مباشرة
+            import asyncio
+            
+            async def check_deal():
+                return await payment_monitor.force_check_deal(deal_id)
+            
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            result = loop.run_until_complete(check_deal())
+            loop.close()
         
         if result:
             return jsonify({
@@ -212,6 +286,31 @@ def force_check_payment(deal_id):
         logger.error(f"Error force checking payment: {str(e)}")
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+@monitoring_bp.route('/monitoring/ccpayment/reload', methods=['POST'])
+def reload_ccpayment_credentials():
+    """إعادة تحميل بيانات اعتماد CCPayment دون إعادة تشغيل الخادم"""
+    try:
+        changed = reload_ccpayment_service()
+        
+        return jsonify({
+            'success': True,
+            'changed': changed,
+            'ccpayment': ccpayment_registry.get_stats()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error reloading CCPayment credentials: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@monitoring_bp.route('/monitoring/ccpayment', methods=['GET'])
+def get_ccpayment_stats():
+    """حالة خدمة CCPayment: دمج الطلبات والذاكرة المؤقتة"""
+    try:
+        return jsonify(ccpayment_registry.get_stats())
+    except Exception as e:
+        logger.error(f"Error getting CCPayment stats: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @monitoring_bp.route('/monitoring/recent-activity', methods=['GET'])
 def get_recent_activity():
     """الحصول على النشاط الأخير"""
@@ -256,6 +355,7 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat(),
             'database': 'connected',
             'payment_monitor': 'running' if payment_monitor and payment_monitor.is_running else 'stopped',
+            'webhook_consumer': 'running' if webhook_consumer and webhook_consumer.is_running else 'stopped',
             'services': {
                 'ccpayment': 'unknown',  # سيتم تحديثه بناءً على آخر فحص
                 'telegram_bot': 'unknown'
@@ -3,7 +3,12 @@ import json
 import logging
 from models.deal import Deal, db
 from models.telegram_user import TelegramUser
+from models.webhook_inbox import WebhookInbox
 from services.ccpayment import get_ccpayment_service, DEFAULT_COINS
+from services.webhook_guard import webhook_replay_guard
+from services.payment_events import confirm_payment, get_payment_order_id
+from services.payment_service import PaymentService
+from routes.monitoring import get_payment_monitor, get_webhook_consumer, get_address_pool
 
 payments_bp = Blueprint('payments', __name__)
 logger = logging.getLogger(__name__)
@@ -20,53 +25,16 @@ def create_payment():
         if not deal_id:
             return jsonify({'success': False, 'error': 'Deal ID is required'}), 400
         
-        # الحصول على الصفقة
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'success': False, 'error': 'Deal not found'}), 404
-        
-        if deal.status != 'pending':
-            return jsonify({'success': False, 'error': 'Deal is not available for payment'}), 400
-        
-        # الحصول على معلومات العملة
-        coin_info = DEFAULT_COINS.get(coin_type)
-        if not coin_info:
-            return jsonify({'success': False, 'error': 'Unsupported coin type'}), 400
-        
-        if network not in coin_info['networks']:
-            return jsonify({'success': False, 'error': 'Unsupported network for this coin'}), 400
-        
-        # إنشاء عنوان الدفع
-        ccpayment = get_ccpayment_service()
-        result = ccpayment.create_deposit_address(
-            order_id=deal_id,
-            coin_id=coin_info['coin_id'],
-            amount=deal.total_price
-        )
+        payment_service = PaymentService(get_address_pool(), get_payment_monitor())
+        result = payment_service.create_payment(deal_id, coin_type, network)
         
         if result['success']:
-            # تحديث الصفقة بمعلومات الدفع
-            payment_info = {
-                'address': result['address'],
-                'amount': result['amount'],
-                'coin_name': result['coin_name'],
-                'network': result['network'],
-                'coin_type': coin_type
-            }
-            
-            deal.payment_id = json.dumps(payment_info)
-            db.session.commit()
-            
-            return jsonify({
-                'success': True,
-                'payment_info': payment_info,
-                'deal_id': deal_id
-            })
+            return jsonify(result)
         else:
             return jsonify({
                 'success': False,
                 'error': result['error']
-            }), 500
+            }), result['status_code']
             
     except Exception as e:
         logger.error(f"Error creating payment: {str(e)}")
@@ -82,34 +50,19 @@ def create_checkout():
         if not deal_id:
             return jsonify({'success': False, 'error': 'Deal ID is required'}), 400
         
-        # الحصول على الصفقة
-        deal = Deal.query.get(deal_id)
-        if not deal:
-            return jsonify({'success': False, 'error': 'Deal not found'}), 404
-        
-        if deal.status != 'pending':
-            return jsonify({'success': False, 'error': 'Deal is not available for payment'}), 400
-        
-        # إنشاء صفحة الدفع
-        ccpayment = get_ccpayment_service()
-        result = ccpayment.create_checkout_page(
-            order_id=deal_id,
-            amount=deal.total_price,
+        result = PaymentService().create_checkout(
+            deal_id,
             return_url=f"https://t.me/{request.host}/success",
             cancel_url=f"https://t.me/{request.host}/cancel"
         )
         
         if result['success']:
-            return jsonify({
-                'success': True,
-                'checkout_url': result['checkout_url'],
-                'deal_id': deal_id
-            })
+            return jsonify(result)
         else:
             return jsonify({
                 'success': False,
                 'error': result['error']
-            }), 500
+            }), result['status_code']
             
     except Exception as e:
         logger.error(f"Error creating checkout: {str(e)}")
@@ -123,16 +76,27 @@ def check_payment_status(deal_id):
         if not deal:
             return jsonify({'success': False, 'error': 'Deal not found'}), 404
         
+        # المستخدم ينتظر الدفع: تقديم الصفقة في طابور المراقب
+        payment_monitor = get_payment_monitor()
+        if payment_monitor and deal.status == 'pending':
+            payment_monitor.prioritize(deal.id, deal.created_at)
+        
         # التحقق من حالة الدفع عبر CCPayment
         ccpayment = get_ccpayment_service()
-        result = ccpayment.get_deposit_record(deal_id)
+        result = ccpayment.get_deposit_record(get_payment_order_id(deal))
         
         if result['success']:
             payment_status = result.get('status', 'unknown')
             
             # تحديث حالة الصفقة حسب حالة الدفع
             if payment_status == 'success' and deal.status == 'pending':
-                deal.status = 'paid'
+                confirm_payment(deal, {
+                    'orderId': get_payment_order_id(deal),
+                    'txId': result.get('tx_id'),
+                    'status': 'success',
+                    'amount': result.get('amount'),
+                    'coinSymbol': result.get('data', {}).get('coinSymbol')
+                }, source='status')
                 db.session.commit()
             
             return jsonify({
@@ -169,43 +133,29 @@ def handle_webhook():
             logger.warning("Invalid webhook signature")
             return jsonify({'error': 'Invalid signature'}), 401
         
-        # معالجة البيانات
-        order_id = webhook_data.get('orderId')
-        status = webhook_data.get('status')
-        amount = webhook_data.get('amount')
-        tx_id = webhook_data.get('txId')
-        
-        if not order_id:
+        if not webhook_data.get('orderId'):
             return jsonify({'error': 'Order ID missing'}), 400
         
-        # الحصول على الصفقة
-        deal = Deal.query.get(order_id)
-        if not deal:
-            logger.warning(f"Deal not found for order_id: {order_id}")
-            return jsonify({'error': 'Deal not found'}), 404
+        # رفض الطلبات المعادة أو القديمة قبل أي وصول لقاعدة البيانات
+        # (التوقيت من جسم الطلب فقط لأنه مشمول بالتوقيع، بخلاف الـ headers)
+        accepted, reason = webhook_replay_guard.check(signature, webhook_data.get('timestamp'))
+        if not accepted:
+            logger.warning(f"Rejected webhook for order {webhook_data.get('orderId')}: {reason}")
+            return jsonify({'error': 'Replayed or expired webhook'}), 401
         
-        # تحديث حالة الصفقة
-        if status == 'success':
-            if deal.status == 'pending':
-                deal.status = 'paid'
-                
-                # تحديث معلومات المعاملة
-                if deal.payment_id:
-                    try:
-                        payment_info = json.loads(deal.payment_id)
-                        payment_info['tx_id'] = tx_id
-                        payment_info['confirmed_amount'] = amount
-                        deal.payment_id = json.dumps(payment_info)
-                    except:
-                        pass
-                
-                db.session.commit()
-                
-                # إرسال إشعار للبوت (يمكن تطويره لاحقاً)
-                logger.info(f"Payment confirmed for deal {order_id}")
-                
-        elif status == 'failed':
-            logger.info(f"Payment failed for deal {order_id}")
+        # حفظ الحدث الخام في صندوق الوارد، المعالجة تتم في الخلفية
+        try:
+            db.session.add(WebhookInbox(payload=json.dumps(webhook_data)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # السماح لـ CCPayment بإعادة المحاولة بنفس التوقيع
+            webhook_replay_guard.forget(signature)
+            raise
+        
+        webhook_consumer = get_webhook_consumer()
+        if webhook_consumer:
+            webhook_consumer.notify()
         
         return jsonify({'status': 'success'})
         
@@ -0,0 +1,85 @@
+from flask import Blueprint, request, jsonify
+import hmac
+import logging
+from models.deal import db
+from services.update_inbox import store_telegram_update
+
+telegram_webhook_bp = Blueprint('telegram_webhook', __name__)
+logger = logging.getLogger(__name__)
+
+# متغير عام للبوت الذي يستقبل التحديثات في هذه العملية
+telegram_bot = None
+
+# الرمز السري لعملية المستقبل المنفصلة (APP_ROLE=receiver): التحديثات تُحفظ في
+# صندوق الوارد وتقرؤها عملية المعالجات (APP_ROLE=handlers)
+forward_secret = None
+
+# مهلة انتظار مكان في طابور التحديثات قبل رفض التحديث (ثانية)
+UPDATE_QUEUE_TIMEOUT = 5
+
+def set_telegram_bot(bot):
+    """تعيين البوت المستقبل لتحديثات webhook"""
+    global telegram_bot
+    telegram_bot = bot
+
+def set_update_forwarding(secret):
+    """تفعيل حفظ التحديثات في صندوق الوارد لعملية معالجات منفصلة"""
+    global forward_secret
+    forward_secret = secret
+
+def get_telegram_bot():
+    """الحصول على البوت الحالي"""
+    return telegram_bot
+
+@telegram_webhook_bp.route('/telegram/webhook', methods=['POST'])
+def receive_update():
+    """استقبال تحديثات Telegram بوضع webhook"""
+    try:
+        bot = telegram_bot if telegram_bot and telegram_bot.is_accepting_updates() else None
+        if not bot and not forward_secret:
+            return jsonify({'error': 'Bot is not running in webhook mode'}), 503
+
+        # التحقق من الرمز السري الذي تم تعيينه عند تسجيل الـ webhook
+        expected_secret = bot.webhook_secret if bot else forward_secret
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not expected_secret or not hmac.compare_digest(secret, expected_secret):
+            logger.warning("Invalid Telegram webhook secret token")
+            return jsonify({'error': 'Invalid secret token'}), 403
+
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'error': 'Invalid update'}), 400
+
+        if not bot:
+            # المعالجات في عملية أخرى: حفظ التحديث في صندوق الوارد المشترك
+            if not isinstance(data.get('update_id'), int):
+                return jsonify({'error': 'Invalid update'}), 400
+            try:
+                store_telegram_update(data)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return jsonify({'status': 'success'})
+
+        # عند امتلاء الطابور يعيد Telegram إرسال التحديث لاحقاً
+        if not bot.submit_update(data, timeout=UPDATE_QUEUE_TIMEOUT):
+            logger.warning("Telegram update queue is full")
+            return jsonify({'error': 'Update queue is full'}), 503
+
+        return jsonify({'status': 'success'})
+
+    except Exception as e:
+        logger.error(f"Error receiving Telegram update: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@telegram_webhook_bp.route('/telegram/webhook/stats', methods=['GET'])
+def get_update_queue_stats():
+    """حالة طابور تحديثات البوت"""
+    if not telegram_bot:
+        return jsonify({'success': False, 'error': 'Bot is not running in this process'}), 503
+
+    return jsonify({
+        'success': True,
+        'stats': telegram_bot.get_update_queue_stats()
+    })
@@ -0,0 +1,236 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy import func
+from src.models.deal import Deal, db
+from src.models.deposit_address import DepositAddress
+from src.services.ccpayment import get_ccpayment_service, DEFAULT_COINS
+
+logger = logging.getLogger(__name__)
+
+class DepositAddressPool:
+    """مجمع عناوين إيداع جاهزة لكل (عملة، شبكة)
+
+    يتم إنشاء العناوين مسبقاً لدى CCPayment على شبكة المجمع وبرقم طلب خاص به،
+    وعند الدفع يُربط أول عنوان متاح بالصفقة في معاملة محلية واحدة دون انتظار CCPayment.
+    عند نزول عدد العناوين المتاحة تحت الحد الأدنى تتم إعادة التعبئة في الخلفية.
+    """
+
+    def __init__(self, flask_app, target_size: int = 5, low_watermark: int = 2,
+                 coins: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.flask_app = flask_app
+        self.target_size = target_size  # عدد العناوين الجاهزة المطلوب لكل (عملة، شبكة)
+        self.low_watermark = low_watermark  # إعادة التعبئة عند النزول تحت هذا العدد
+        self.coins = coins or DEFAULT_COINS
+        self.max_bind_attempts = 3
+
+        self._refilling = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refill_count = 0
+        self.refill_errors = 0
+        self.addresses_created = 0
+        self.refill_samples = 0
+        self.total_refill_latency = 0.0
+        self.last_refill_latency = None
+
+    def pool_keys(self) -> List[Tuple[str, str]]:
+        """جميع أزواج (عملة، شبكة) المدعومة"""
+        return [(coin_type, network)
+                for coin_type, coin_info in self.coins.items()
+                for network in coin_info['networks']]
+
+    def start(self):
+        """تعبئة جميع المجمعات في الخلفية عند بدء التشغيل"""
+        for coin_type, network in self.pool_keys():
+            self.request_refill(coin_type, network)
+
+    def acquire(self, deal: Deal, coin_type: str, network: str) -> Optional[Dict[str, Any]]:
+        """ربط عنوان جاهز بالصفقة وإرجاع معلومات الدفع، أو None إذا كان المجمع فارغاً
+
+        يجب استدعاؤها داخل app context. الربط وتحديث الصفقة يتمان في commit واحد.
+        إذا كان للصفقة عنوان مربوط لنفس (العملة، الشبكة) يُعاد نفسه، فتكرار طلب
+        الدفع لا ينقل المراقبة إلى عنوان جديد بعد أن يكون المشتري قد دفع للأول.
+        """
+        existing = DepositAddress.query.filter_by(
+            deal_id=deal.id, coin_type=coin_type, network=network, status='bound'
+        ).order_by(DepositAddress.id.desc()).first()
+        if existing:
+            payment_info = self._payment_info(deal, existing)
+            if deal.payment_id != json.dumps(payment_info) or existing.expected_amount != deal.total_price:
+                existing.expected_amount = deal.total_price
+                deal.payment_id = json.dumps(payment_info)
+                db.session.commit()
+
+            with self._lock:
+                self.hits += 1
+            return payment_info
+
+        for _ in range(self.max_bind_attempts):
+            candidate = DepositAddress.query.filter_by(
+                coin_type=coin_type, network=network, status='available'
+            ).order_by(DepositAddress.id).first()
+
+            if not candidate:
+                break
+
+            # تحديث مشروط: ينجح لطلب واحد فقط إذا تنافس عدة طلبات على نفس العنوان.
+            # العنوان أُنشئ بدون مبلغ، فيُحفظ المبلغ المتوقع مع الربط ويُتحقق منه عند تأكيد الدفع
+            now = datetime.utcnow()
+            bound = DepositAddress.query.filter_by(id=candidate.id, status='available').update({
+                'status': 'bound',
+                'deal_id': deal.id,
+                'expected_amount': deal.total_price,
+                'bound_at': now
+            }, synchronize_session=False)
+
+            if bound != 1:
+                db.session.rollback()
+                continue
+
+            payment_info = self._payment_info(deal, candidate)
+            deal.payment_id = json.dumps(payment_info)
+            db.session.commit()
+
+            with self._lock:
+                self.hits += 1
+            self._refill_if_low(coin_type, network)
+            return payment_info
+
+        with self._lock:
+            self.misses += 1
+        self.request_refill(coin_type, network)
+        return None
+
+    @staticmethod
+    def _payment_info(deal: Deal, address: DepositAddress) -> Dict[str, Any]:
+        return {
+            'address': address.address,
+            'memo': address.memo,
+            'amount': deal.total_price,
+            'coin_name': address.coin_type,
+            'network': address.network,
+            'coin_type': address.coin_type,
+            'order_id': address.order_ref
+        }
+
+    def available_count(self, coin_type: str, network: str) -> int:
+        return DepositAddress.query.filter_by(
+            coin_type=coin_type, network=network, status='available'
+        ).count()
+
+    def _refill_if_low(self, coin_type: str, network: str):
+        if self.available_count(coin_type, network) < self.low_watermark:
+            self.request_refill(coin_type, network)
+
+    def request_refill(self, coin_type: str, network: str):
+        """بدء إعادة تعبئة مجمع في thread منفصل (مرة واحدة لكل مجمع في نفس الوقت)"""
+        key = (coin_type, network)
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+
+        thread = threading.Thread(
+            target=self._refill,
+            args=(coin_type, network),
+            name=f'address-pool-{coin_type}-{network}',
+            daemon=True
+        )
+        thread.start()
+
+    def _refill(self, coin_type: str, network: str) -> int:
+        """إنشاء العناوين الناقصة لمجمع وإرجاع عدد العناوين الجديدة"""
+        created = 0
+        try:
+            with self.flask_app.app_context():
+                missing = self.target_size - self.available_count(coin_type, network)
+                if missing <= 0:
+                    return 0
+
+                ccpayment = get_ccpayment_service()
+                coin_id = self.coins[coin_type]['coin_id']
+
+                for _ in range(missing):
+                    order_ref = f"pool-{uuid.uuid4().hex}"
+                    started = time.monotonic()
+                    result = ccpayment.create_deposit_address(order_ref, coin_id, None, chain=network)
+                    latency = time.monotonic() - started
+
+                    if not result['success']:
+                        with self._lock:
+                            self.refill_errors += 1
+                        logger.warning(f"Failed to create pool address for {coin_type}/{network}: {result['error']}")
+                        break
+
+                    db.session.add(DepositAddress(
+                        order_ref=order_ref,
+                        coin_type=coin_type,
+                        network=network,
+                        address=result['address'],
+                        memo=result.get('data', {}).get('memo')
+                    ))
+                    created += 1
+
+                    with self._lock:
+                        self.refill_samples += 1
+                        self.total_refill_latency += latency
+                        self.last_refill_latency = latency
+
+                db.session.commit()
+
+                with self._lock:
+                    self.addresses_created += created
+                    self.refill_count += 1
+
+                logger.info(f"Refilled {coin_type}/{network} address pool with {created} addresses")
+
+        except Exception as e:
+            with self._lock:
+                self.refill_errors += 1
+            logger.error(f"Error refilling {coin_type}/{network} address pool: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard((coin_type, network))
+
+        return created
+
+    def get_stats(self) -> Dict[str, Any]:
+        """مقاييس المجمع: نسبة الإصابة وزمن إعادة التعبئة والعناوين المتاحة"""
+        with self.flask_app.app_context():
+            rows = db.session.query(
+                DepositAddress.coin_type,
+                DepositAddress.network,
+                func.count(DepositAddress.id)
+            ).filter(DepositAddress.status == 'available').group_by(
+                DepositAddress.coin_type, DepositAddress.network
+            ).all()
+
+        available = {f"{coin_type}/{network}": 0 for coin_type, network in self.pool_keys()}
+        for coin_type, network, count in rows:
+            available[f"{coin_type}/{network}"] = count
+
+        with self._lock:
+            requests_total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_total, 4) if requests_total else None,
+                'refill_count': self.refill_count,
+                'refill_errors': self.refill_errors,
+                'refills_in_progress': len(self._refilling),
+                'addresses_created': self.addresses_created,
+                'avg_refill_latency': round(self.total_refill_latency / self.refill_samples, 3)
+                                      if self.refill_samples else None,
+                'last_refill_latency': round(self.last_refill_latency, 3)
+                                       if self.last_refill_latency is not None else None,
+                'target_size': self.target_size,
+                'low_watermark': self.low_watermark,
+                'available': available
+            }
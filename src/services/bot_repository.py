@@ -0,0 +1,618 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from sqlalchemy.dialects import sqlite, postgresql
+from src.models.deal import Deal, db
+from src.models.telegram_user import TelegramUser
+from src.models.conversation_state import ConversationState
+from src.models.broadcast import BroadcastCampaign, BroadcastRecipient
+from src.models.notification_outbox import NotificationOutbox
+from src.models.telegram_update import TelegramUpdateInbox
+from src.services.deal_cards import DealCard, deal_card_cache, render_deal_card
+from src.services.outbox import OutboxEntry, enqueue_notification
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class DealSnapshot:
+    """نسخة ثابتة من الصفقة لا ترتبط بجلسة قاعدة البيانات"""
+    id: str
+    seller_id: int
+    buyer_id: Optional[int]
+    title: str
+    description: str
+    price: float
+    commission: float
+    total_price: float
+    status: str
+    media_files: Optional[str]
+    payment_id: Optional[str]
+    created_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, deal: Deal) -> 'DealSnapshot':
+        return cls(
+            id=deal.id,
+            seller_id=deal.seller_id,
+            buyer_id=deal.buyer_id,
+            title=deal.title,
+            description=deal.description,
+            price=deal.price,
+            commission=deal.commission,
+            total_price=deal.total_price,
+            status=deal.status,
+            media_files=deal.media_files,
+            payment_id=deal.payment_id,
+            created_at=deal.created_at
+        )
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """نسخة ثابتة من مستخدم Telegram"""
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+    @classmethod
+    def from_model(cls, user: TelegramUser) -> 'UserSnapshot':
+        return cls(
+            telegram_id=user.telegram_id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+
+@dataclass(frozen=True)
+class CampaignSnapshot:
+    """نسخة ثابتة من حملة البث مع نقطة الاستئناف"""
+    id: int
+    message: str
+    keyboard: Optional[List[List[Dict[str, Any]]]]
+    last_user_id: int
+    sent_count: int
+    failed_count: int
+    blocked_count: int
+
+    @classmethod
+    def from_model(cls, campaign: BroadcastCampaign) -> 'CampaignSnapshot':
+        return cls(
+            id=campaign.id,
+            message=campaign.message,
+            keyboard=json.loads(campaign.keyboard) if campaign.keyboard else None,
+            last_user_id=campaign.last_user_id or 0,
+            sent_count=campaign.sent_count or 0,
+            failed_count=campaign.failed_count or 0,
+            blocked_count=campaign.blocked_count or 0
+        )
+
+class BotRepository:
+    """طبقة الوصول للبيانات لمعالجات البوت
+
+    عمليات SQLAlchemy المتزامنة تعمل على thread pool محدود الحجم داخل app context
+    خاص بها، وتُرجع نسخاً ثابتة (snapshots)، فلا تنتظر معالجات البوت إلا I/O
+    ولا يوقف قفل كتابة SQLite بطيء جميع المحادثات.
+    """
+
+    def __init__(self, flask_app, max_workers: int = 8):
+        self.flask_app = flask_app
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bot-db')
+
+        self._stats_lock = threading.Lock()
+        self.submitted_count = 0
+        self.completed_count = 0
+        self.running_count = 0
+        self.calls_count = 0
+        self.errors_count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def _call_in_context(self, fn: Callable, *args, **kwargs):
+        started = time.monotonic()
+        with self._stats_lock:
+            self.running_count += 1
+        try:
+            with self.flask_app.app_context():
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    db.session.rollback()
+                    with self._stats_lock:
+                        self.errors_count += 1
+                    raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self._stats_lock:
+                self.running_count -= 1
+                self.calls_count += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """تشغيل دالة قاعدة بيانات متزامنة على الـ thread pool"""
+        loop = asyncio.get_running_loop()
+        with self._stats_lock:
+            self.submitted_count += 1
+        try:
+            return await loop.run_in_executor(self.executor, partial(self._call_in_context, fn, *args, **kwargs))
+        finally:
+            with self._stats_lock:
+                self.completed_count += 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _insert(table):
+        """جملة INSERT تدعم ON CONFLICT حسب نوع قاعدة البيانات"""
+        dialect = db.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        return insert(table)
+
+    # المستخدمون
+
+    def _upsert_users(self, profiles: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]]) -> int:
+        """INSERT ... ON CONFLICT DO UPDATE واحد لكل المستخدمين"""
+        now = datetime.utcnow()
+        rows = [
+            {
+                'telegram_id': telegram_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'is_active': True,
+                'created_at': now,
+                'updated_at': now
+            }
+            for telegram_id, (username, first_name, last_name) in profiles.items()
+        ]
+
+        statement = self._insert(TelegramUser.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['telegram_id'],
+            set_={
+                'username': statement.excluded.username,
+                'first_name': statement.excluded.first_name,
+                'last_name': statement.excluded.last_name,
+                'is_active': True,
+                'updated_at': statement.excluded.updated_at
+            }
+        )
+        db.session.execute(statement)
+        db.session.commit()
+
+        # الـ upsert لا يمر بأحداث ORM، فيتم إبطال بطاقات البائعين يدوياً
+        for telegram_id in profiles:
+            deal_card_cache.invalidate_seller(telegram_id)
+        return len(rows)
+
+    async def upsert_users(self, profiles: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]]) -> int:
+        """حفظ أو تحديث مستخدمي Telegram: {telegram_id: (username, first_name, last_name)}"""
+        if not profiles:
+            return 0
+        return await self.run(self._upsert_users, profiles)
+
+    def _get_user(self, telegram_id: int) -> Optional[UserSnapshot]:
+        telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+        return UserSnapshot.from_model(telegram_user) if telegram_user else None
+
+    async def get_user(self, telegram_id: int) -> Optional[UserSnapshot]:
+        return await self.run(self._get_user, telegram_id)
+
+    # الصفقات
+
+    def _get_deal(self, deal_id: str) -> Optional[DealSnapshot]:
+        deal = Deal.query.get(deal_id)
+        return DealSnapshot.from_model(deal) if deal else None
+
+    async def get_deal(self, deal_id: str) -> Optional[DealSnapshot]:
+        return await self.run(self._get_deal, deal_id)
+
+    def _load_deal_card(self, deal_id: str) -> Optional[DealCard]:
+        deal = Deal.query.get(deal_id)
+        if not deal:
+            return None
+        seller = TelegramUser.query.filter_by(telegram_id=deal.seller_id).first()
+        return render_deal_card(deal, seller.first_name if seller else "غير معروف")
+
+    async def get_deal_card(self, deal_id: str) -> Optional[DealCard]:
+        """بطاقة الصفقة الجاهزة للعرض، من الذاكرة المؤقتة إن وُجدت"""
+        card = deal_card_cache.get(deal_id)
+        if card:
+            return card
+
+        generation = deal_card_cache.generation
+        card = await self.run(self._load_deal_card, deal_id)
+        if card:
+            deal_card_cache.set(card, generation)
+        return card
+
+    def _get_seller_deals(self, seller_id: int, limit: int) -> Tuple[int, List[DealSnapshot]]:
+        query = Deal.query.filter_by(seller_id=seller_id)
+        deals = query.limit(limit).all()
+        return query.count(), [DealSnapshot.from_model(deal) for deal in deals]
+
+    async def get_seller_deals(self, seller_id: int, limit: int = 5) -> Tuple[int, List[DealSnapshot]]:
+        """عدد صفقات البائع وأول limit منها"""
+        return await self.run(self._get_seller_deals, seller_id, limit)
+
+    def _get_completed_deal_between(self, user_id: int, other_user_id: int) -> Optional[DealSnapshot]:
+        deal = Deal.query.filter(
+            ((Deal.seller_id == user_id) & (Deal.buyer_id == other_user_id)) |
+            ((Deal.seller_id == other_user_id) & (Deal.buyer_id == user_id)),
+            Deal.status == 'completed'
+        ).first()
+        return DealSnapshot.from_model(deal) if deal else None
+
+    async def get_completed_deal_between(self, user_id: int, other_user_id: int) -> Optional[DealSnapshot]:
+        """صفقة مكتملة بين مستخدمين (لتقييم أحدهما للآخر)"""
+        return await self.run(self._get_completed_deal_between, user_id, other_user_id)
+
+    def _create_deal(self, **fields) -> DealSnapshot:
+        deal = Deal(**fields)
+        db.session.add(deal)
+        db.session.commit()
+        return DealSnapshot.from_model(deal)
+
+    async def create_deal(self, **fields) -> DealSnapshot:
+        return await self.run(self._create_deal, **fields)
+
+    def _update_deal(self, deal_id: str, expected_status: Optional[str], changes: Dict[str, Any],
+                     notify: Tuple[str, ...] = (), notify_params: Optional[Dict[str, Any]] = None) -> Optional[DealSnapshot]:
+        query = Deal.query.filter_by(id=deal_id)
+        if expected_status is not None:
+            query = query.filter_by(status=expected_status)
+
+        changes['updated_at'] = datetime.utcnow()
+        if query.update(changes, synchronize_session=False) != 1:
+            db.session.rollback()
+            return None
+
+        if notify:
+            # الإشعارات تُكتب في نفس المعاملة مع تحديث الصفقة
+            enqueue_notification(Deal.query.get(deal_id), *notify, **(notify_params or {}))
+
+        db.session.commit()
+        # التحديث المباشر لا يمر بأحداث ORM
+        deal_card_cache.invalidate(deal_id)
+        return self._get_deal(deal_id)
+
+    async def update_deal(self, deal_id: str, expected_status: Optional[str] = None,
+                          notify: Tuple[str, ...] = (), notify_params: Optional[Dict[str, Any]] = None,
+                          **changes) -> Optional[DealSnapshot]:
+        """تحديث الصفقة بشكل ذري، وإرجاع None إذا تغيرت حالتها عن expected_status
+
+        notify: أنواع الإشعارات (انظر services.outbox) التي تُكتب في صندوق الصادر مع التحديث.
+        """
+        return await self.run(self._update_deal, deal_id, expected_status, changes, notify, notify_params)
+
+    # حالات المحادثات
+
+    def _load_conversation(self, telegram_id: int) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        state = ConversationState.query.get(telegram_id)
+        if not state:
+            return None
+        return state.flow, state.step, json.loads(state.data) if state.data else {}
+
+    async def load_conversation(self, telegram_id: int) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        """(flow, step, data) المحفوظة للمستخدم أو None"""
+        return await self.run(self._load_conversation, telegram_id)
+
+    def _save_conversations(self, upserts: Dict[int, Tuple[str, str, Dict[str, Any]]], deletes: List[int]):
+        if upserts:
+            now = datetime.utcnow()
+            statement = self._insert(ConversationState.__table__).values([
+                {
+                    'telegram_id': telegram_id,
+                    'flow': flow,
+                    'step': step,
+                    'data': json.dumps(data),
+                    'updated_at': now
+                }
+                for telegram_id, (flow, step, data) in upserts.items()
+            ])
+            statement = statement.on_conflict_do_update(
+                index_elements=['telegram_id'],
+                set_={
+                    'flow': statement.excluded.flow,
+                    'step': statement.excluded.step,
+                    'data': statement.excluded.data,
+                    'updated_at': statement.excluded.updated_at
+                }
+            )
+            db.session.execute(statement)
+
+        if deletes:
+            ConversationState.query.filter(
+                ConversationState.telegram_id.in_(deletes)
+            ).delete(synchronize_session=False)
+
+        db.session.commit()
+
+    async def save_conversations(self, upserts: Dict[int, Tuple[str, str, Dict[str, Any]]], deletes: List[int]):
+        """حفظ وحذف حالات المحادثات في transaction واحدة"""
+        return await self.run(self._save_conversations, upserts, deletes)
+
+    def _purge_conversations(self, before: datetime) -> int:
+        count = ConversationState.query.filter(
+            ConversationState.updated_at < before
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    async def purge_conversations(self, before: datetime) -> int:
+        """حذف حالات المحادثات التي لم تتغير منذ before"""
+        return await self.run(self._purge_conversations, before)
+
+    # حملات البث
+
+    def _claim_broadcast_campaign(self) -> Optional[CampaignSnapshot]:
+        # الحملات الجارية (المتوقفة بسبب إعادة التشغيل) قبل الجديدة
+        campaign = BroadcastCampaign.query.filter_by(status='running').order_by(BroadcastCampaign.id).first()
+        if not campaign:
+            campaign = BroadcastCampaign.query.filter_by(status='pending').order_by(BroadcastCampaign.id).first()
+        if not campaign:
+            return None
+
+        if campaign.status == 'pending':
+            campaign.status = 'running'
+            campaign.started_at = datetime.utcnow()
+            db.session.commit()
+        return CampaignSnapshot.from_model(campaign)
+
+    async def claim_broadcast_campaign(self) -> Optional[CampaignSnapshot]:
+        """الحملة التالية للإرسال (مع تحويلها إلى running) أو None"""
+        return await self.run(self._claim_broadcast_campaign)
+
+    def _get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        rows = db.session.query(TelegramUser.telegram_id).filter(
+            TelegramUser.telegram_id > after_user_id,
+            TelegramUser.is_active == True
+        ).order_by(TelegramUser.telegram_id).limit(limit).all()
+        return [row.telegram_id for row in rows]
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """صفحة المستخدمين النشطين التالية بعد after_user_id (keyset pagination)"""
+        return await self.run(self._get_broadcast_recipients, after_user_id, limit)
+
+    def _save_broadcast_batch(self, campaign_id: int, last_user_id: int,
+                              outcomes: Dict[int, Tuple[str, Optional[str]]]) -> bool:
+        counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+        for status, _ in outcomes.values():
+            counts[status] += 1
+
+        # الرسائل أُرسلت فعلاً، فتُحفظ نتائجها حتى لو أُوقفت الحملة أو أُلغيت أثناء الدفعة
+        updated = BroadcastCampaign.query.filter(
+            BroadcastCampaign.id == campaign_id,
+            BroadcastCampaign.status != 'completed'
+        ).update({
+            'last_user_id': last_user_id,
+            'sent_count': BroadcastCampaign.sent_count + counts['sent'],
+            'failed_count': BroadcastCampaign.failed_count + counts['failed'],
+            'blocked_count': BroadcastCampaign.blocked_count + counts['blocked'],
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        if updated != 1:
+            db.session.rollback()
+            return False
+
+        if outcomes:
+            now = datetime.utcnow()
+            statement = self._insert(BroadcastRecipient.__table__).values([
+                {
+                    'campaign_id': campaign_id,
+                    'telegram_id': telegram_id,
+                    'status': status,
+                    'error': error[:200] if error else None,
+                    'created_at': now
+                }
+                for telegram_id, (status, error) in outcomes.items()
+            ])
+            # الدفعة التي قُطعت قبل حفظها تُعاد بعد الاستئناف
+            db.session.execute(statement.on_conflict_do_nothing(index_elements=['campaign_id', 'telegram_id']))
+
+        blocked = [telegram_id for telegram_id, (status, _) in outcomes.items() if status == 'blocked']
+        if blocked:
+            TelegramUser.query.filter(TelegramUser.telegram_id.in_(blocked)).update(
+                {'is_active': False}, synchronize_session=False
+            )
+
+        status = db.session.query(BroadcastCampaign.status).filter_by(id=campaign_id).scalar()
+        db.session.commit()
+        return status == 'running'
+
+    async def save_broadcast_batch(self, campaign_id: int, last_user_id: int,
+                                   outcomes: Dict[int, Tuple[str, Optional[str]]]) -> bool:
+        """حفظ نتائج دفعة ونقطة الاستئناف في transaction واحدة، و False إذا لم تعد الحملة جارية
+
+        outcomes: {telegram_id: (status, error)} حيث status هي sent أو failed أو blocked،
+        والمستخدمون blocked يصبحون غير نشطين فلا تصلهم الحملات التالية.
+        """
+        return await self.run(self._save_broadcast_batch, campaign_id, last_user_id, outcomes)
+
+    def _complete_broadcast_campaign(self, campaign_id: int) -> bool:
+        updated = BroadcastCampaign.query.filter_by(id=campaign_id, status='running').update({
+            'status': 'completed',
+            'completed_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        return updated == 1
+
+    async def complete_broadcast_campaign(self, campaign_id: int) -> bool:
+        return await self.run(self._complete_broadcast_campaign, campaign_id)
+
+    def _fail_broadcast_campaign(self, campaign_id: int) -> bool:
+        updated = BroadcastCampaign.query.filter_by(id=campaign_id, status='running').update({
+            'status': 'failed',
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        return updated == 1
+
+    async def fail_broadcast_campaign(self, campaign_id: int) -> bool:
+        """إيقاف حملة تفشل باستمرار حتى لا يختارها claim مرة أخرى"""
+        return await self.run(self._fail_broadcast_campaign, campaign_id)
+
+    # صندوق صادر الإشعارات
+
+    def _get_due_notifications(self, limit: int) -> List[OutboxEntry]:
+        entries = NotificationOutbox.query.filter(
+            NotificationOutbox.status == 'pending',
+            NotificationOutbox.next_attempt_at <= datetime.utcnow()
+        ).order_by(NotificationOutbox.next_attempt_at, NotificationOutbox.id).limit(limit).all()
+        return [OutboxEntry.from_model(entry) for entry in entries]
+
+    async def get_due_notifications(self, limit: int) -> List[OutboxEntry]:
+        """الإشعارات المعلقة التي حان موعد إرسالها"""
+        return await self.run(self._get_due_notifications, limit)
+
+    def _save_notification_results(self, results: Dict[int, Tuple[str, Optional[str], Optional[datetime]]]):
+        now = datetime.utcnow()
+        sent = [entry_id for entry_id, (status, _, _) in results.items() if status == 'sent']
+        if sent:
+            NotificationOutbox.query.filter(NotificationOutbox.id.in_(sent)).update({
+                'status': 'sent',
+                'attempts': NotificationOutbox.attempts + 1,
+                'error': None,
+                'sent_at': now
+            }, synchronize_session=False)
+
+        for entry_id, (status, error, next_attempt_at) in results.items():
+            if status == 'sent':
+                continue
+            changes = {
+                'status': status,
+                'attempts': NotificationOutbox.attempts + 1,
+                'error': error
+            }
+            if next_attempt_at:
+                changes['next_attempt_at'] = next_attempt_at
+            NotificationOutbox.query.filter_by(id=entry_id).update(changes, synchronize_session=False)
+
+        db.session.commit()
+
+    async def save_notification_results(self, results: Dict[int, Tuple[str, Optional[str], Optional[datetime]]]):
+        """حفظ نتائج دفعة إرسال: {id: (status, error, next_attempt_at)} في commit واحد"""
+        return await self.run(self._save_notification_results, results)
+
+    def _purge_notifications(self, before: datetime) -> int:
+        count = NotificationOutbox.query.filter(
+            NotificationOutbox.status == 'sent',
+            NotificationOutbox.sent_at < before
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    async def purge_notifications(self, before: datetime) -> int:
+        """حذف الإشعارات المرسلة قبل before"""
+        return await self.run(self._purge_notifications, before)
+
+    def _claim_telegram_updates(self, limit: int) -> List[str]:
+        rows = db.session.query(TelegramUpdateInbox.id, TelegramUpdateInbox.payload).filter(
+            TelegramUpdateInbox.status == 'pending'
+        ).order_by(TelegramUpdateInbox.id).limit(limit).all()
+        if rows:
+            TelegramUpdateInbox.query.filter(
+                TelegramUpdateInbox.id.in_([row.id for row in rows]),
+                TelegramUpdateInbox.status == 'pending'
+            ).update({
+                'status': 'claimed',
+                'claimed_at': datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+        return [row.payload for row in rows]
+
+    async def claim_telegram_updates(self, limit: int) -> List[str]:
+        """سحب أقدم limit تحديثات معلقة من صندوق الوارد بترتيب وصولها
+
+        الصفوف لا تُحذف بل تصبح claimed، فيبقى update_id الفريد يرفض إعادة إرسال
+        Telegram لنفس التحديث بعد سحبه. الحذف عبر purge_telegram_updates.
+        """
+        return await self.run(self._claim_telegram_updates, limit)
+
+    def _purge_telegram_updates(self, before: datetime) -> int:
+        count = TelegramUpdateInbox.query.filter(
+            TelegramUpdateInbox.status == 'claimed',
+            TelegramUpdateInbox.claimed_at < before
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    async def purge_telegram_updates(self, before: datetime) -> int:
+        """حذف التحديثات المسحوبة قبل before"""
+        return await self.run(self._purge_telegram_updates, before)
+
+    def get_deal_card_stats(self) -> Dict[str, Any]:
+        """إحصائيات ذاكرة بطاقات الصفقات التي يقرأ منها المستودع"""
+        return deal_card_cache.get_stats()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الـ thread pool"""
+        with self._stats_lock:
+            calls = self.calls_count
+            # الطلبات المرسلة التي لم تنتهِ بعد؛ ما لم يبدأ تنفيذها منها ينتظر في الطابور
+            in_flight = self.submitted_count - self.completed_count
+            return {
+                'max_workers': self.max_workers,
+                'in_flight': in_flight,
+                'running': self.running_count,
+                'queued': max(0, in_flight - self.running_count),
+                'calls_count': calls,
+                'errors_count': self.errors_count,
+                'avg_time': round(self.total_time / calls, 4) if calls else 0.0,
+                'max_time': round(self.max_time, 4)
+            }
+
+class LoopLagMonitor:
+    """قياس تأخر الـ event loop
+
+    مهمة تنام لفترة ثابتة وتقيس الفرق بين وقت الاستيقاظ الفعلي والمتوقع.
+    أي عمل متزامن يحجز الـ loop يظهر مباشرة كتأخر.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+
+    def start(self):
+        """بدء القياس على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.last_lag = lag
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'interval': self.interval,
+            'samples': self.samples,
+            'last_lag': round(self.last_lag, 4),
+            'avg_lag': round(self.total_lag / self.samples, 4) if self.samples else 0.0,
+            'max_lag': round(self.max_lag, 4)
+        }
@@ -0,0 +1,206 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from src.services.rate_limiter import BULK_PRIORITY
+
+logger = logging.getLogger(__name__)
+
+# أخطاء BadRequest التي تعني أن المستخدم لم يعد متاحاً (حساب محذوف)
+UNREACHABLE_ERRORS = ('chat not found', 'user is deactivated')
+
+class BroadcastEngine:
+    """إرسال حملات البث من جدول broadcast_campaigns
+
+    المستلمون يُقرأون من telegram_users على صفحات (keyset pagination على
+    telegram_id) بدلاً من تحميلهم كلهم في الذاكرة، والصفحة التالية تُقرأ أثناء
+    إرسال الحالية. الإرسال متوازٍ (concurrency رسالة جارية) وسرعته الفعلية
+    يحددها محدد معدل البوت بأولوية BULK_PRIORITY.
+
+    بعد كل دفعة تُحفظ النتائج ونقطة الاستئناف (last_user_id) معاً، فبعد إعادة
+    التشغيل تكمل الحملة من حيث توقفت (وفي أسوأ الأحوال تُعاد دفعة واحدة).
+    المستخدمون الذين حظروا البوت يصبحون غير نشطين ولا تصلهم الحملات التالية.
+    الحملة التي تفشل max_campaign_errors مرة متتالية بدون تقدم تصبح failed.
+    """
+
+    def __init__(self, bot, repository, batch_size: int = 500, concurrency: int = 30,
+                 poll_interval: float = 5.0, on_blocked: Optional[Callable[[int], Any]] = None,
+                 max_campaign_errors: int = 5):
+        self.bot = bot
+        self.repository = repository
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.on_blocked = on_blocked
+        self.max_campaign_errors = max_campaign_errors
+        self._task = None
+        # campaign_id -> (نقطة الاستئناف عند آخر خطأ، عدد الأخطاء المتتالية منها)
+        self._campaign_errors: Dict[int, Tuple[int, int]] = {}
+
+        self.current_campaign_id = None
+        self.current_rate = 0.0
+        self.campaigns_completed = 0
+        self.campaigns_failed = 0
+        self.batches_count = 0
+        self.sent_count = 0
+        self.failed_count = 0
+        self.blocked_count = 0
+        self.errors_count = 0
+
+    def start(self):
+        """بدء معالجة الحملات على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف الإرسال، والحملة الجارية تُستأنف من آخر نقطة محفوظة"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                campaign = await self.repository.claim_broadcast_campaign()
+            except Exception as e:
+                logger.error(f"Error loading broadcast campaign: {e}")
+                self.errors_count += 1
+                campaign = None
+
+            if not campaign:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            try:
+                await self.run_campaign(campaign)
+                self._campaign_errors.pop(campaign.id, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running broadcast campaign {campaign.id}: {e}")
+                self.errors_count += 1
+                try:
+                    await self._record_campaign_error(campaign)
+                except Exception as e:
+                    logger.error(f"Error failing broadcast campaign {campaign.id}: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _record_campaign_error(self, campaign):
+        """وضع الحملة failed بعد max_campaign_errors خطأ متتالياً من نفس نقطة الاستئناف
+
+        الحملة الجارية تُختار قبل غيرها، فبدون ذلك تُعاد الحملة المعطوبة للأبد
+        وتمنع الحملات التالية. التقدم بين الأخطاء يبدأ العد من جديد.
+        """
+        last_user_id, errors = self._campaign_errors.get(campaign.id, (None, 0))
+        errors = errors + 1 if last_user_id == campaign.last_user_id else 1
+        if errors < self.max_campaign_errors:
+            self._campaign_errors[campaign.id] = (campaign.last_user_id, errors)
+            return
+
+        self._campaign_errors.pop(campaign.id, None)
+        if await self.repository.fail_broadcast_campaign(campaign.id):
+            self.campaigns_failed += 1
+            logger.error(f"Broadcast campaign {campaign.id} failed after {errors} errors")
+
+    async def run_campaign(self, campaign) -> str:
+        """إرسال الحملة من نقطة الاستئناف حتى النهاية
+
+        يرجع completed، أو stopped إذا أوقفت الحملة أو أُلغيت أثناء الإرسال.
+        """
+        markup = InlineKeyboardMarkup.de_json({'inline_keyboard': campaign.keyboard}, self.bot) \
+            if campaign.keyboard else None
+        last_user_id = campaign.last_user_id
+        self.current_campaign_id = campaign.id
+        logger.info(f"Broadcast campaign {campaign.id} running from user {last_user_id}")
+
+        try:
+            page = await self.repository.get_broadcast_recipients(last_user_id, self.batch_size)
+            while page:
+                # قراءة الصفحة التالية أثناء إرسال الحالية
+                next_page = asyncio.ensure_future(
+                    self.repository.get_broadcast_recipients(page[-1], self.batch_size)
+                )
+                try:
+                    started = time.monotonic()
+                    outcomes = await self._send_batch(campaign.message, markup, page)
+                    self.current_rate = len(page) / max(time.monotonic() - started, 0.001)
+
+                    if not await self.repository.save_broadcast_batch(campaign.id, page[-1], outcomes):
+                        logger.info(f"Broadcast campaign {campaign.id} stopped")
+                        next_page.cancel()
+                        return 'stopped'
+                except BaseException:
+                    next_page.cancel()
+                    raise
+
+                self._record(outcomes)
+                page = await next_page
+
+            await self.repository.complete_broadcast_campaign(campaign.id)
+            self.campaigns_completed += 1
+            logger.info(f"Broadcast campaign {campaign.id} completed")
+            return 'completed'
+        finally:
+            self.current_campaign_id = None
+            self.current_rate = 0.0
+
+    async def _send_batch(self, message: str, markup: Optional[InlineKeyboardMarkup],
+                          user_ids: List[int]) -> Dict[int, Tuple[str, Optional[str]]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                try:
+                    await self.bot.send_message(
+                        chat_id=user_id,
+                        text=message,
+                        reply_markup=markup,
+                        rate_limit_args=BULK_PRIORITY
+                    )
+                    return user_id, ('sent', None)
+                except Forbidden as e:
+                    return user_id, ('blocked', str(e))
+                except BadRequest as e:
+                    if any(error in str(e).lower() for error in UNREACHABLE_ERRORS):
+                        return user_id, ('blocked', str(e))
+                    return user_id, ('failed', str(e))
+                except Exception as e:
+                    logger.warning(f"Error sending broadcast to user {user_id}: {e}")
+                    return user_id, ('failed', str(e))
+
+        return dict(await asyncio.gather(*[send(user_id) for user_id in user_ids]))
+
+    def _record(self, outcomes: Dict[int, Tuple[str, Optional[str]]]):
+        self.batches_count += 1
+        for user_id, (status, _) in outcomes.items():
+            if status == 'sent':
+                self.sent_count += 1
+            elif status == 'failed':
+                self.failed_count += 1
+            else:
+                self.blocked_count += 1
+                # المستخدم يعود نشطاً عند /start التالي فقط إذا لم يكن في ذاكرة المستخدمين المعروفين
+                if self.on_blocked:
+                    self.on_blocked(user_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'is_running': bool(self._task and not self._task.done()),
+            'current_campaign_id': self.current_campaign_id,
+            'current_rate': round(self.current_rate, 2),
+            'batch_size': self.batch_size,
+            'concurrency': self.concurrency,
+            'campaigns_completed': self.campaigns_completed,
+            'campaigns_failed': self.campaigns_failed,
+            'batches_count': self.batches_count,
+            'sent_count': self.sent_count,
+            'failed_count': self.failed_count,
+            'blocked_count': self.blocked_count,
+            'errors_count': self.errors_count
+        }
@@ -0,0 +1,94 @@
+import os
+import hmac
+import uuid
+import base64
+import hashlib
+import logging
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# رمز حرف واحد لكل إجراء على صفقة. الرموز حروف كبيرة حتى لا تتداخل مع
+# callback_data النصية القديمة (كلها تبدأ بحرف صغير) التي ما زالت في المحادثات
+ACTION_CODES = {
+    'view_deal': 'V',
+    'buy_deal': 'B',
+    'confirm_payment': 'C',
+    'release_funds': 'F',
+    'dispute': 'D',
+    'dispute_reason': 'S',
+    'confirm_delivery': 'L',
+    'pay_usdt_polygon': 'P',
+    'pay_usdt_eth': 'E',
+    'pay_btc': 'T',
+    'pay_checkout': 'K',
+    'rating': 'R'
+}
+CODE_ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+
+DEAL_ID_LENGTH = 22  # base64url لـ 16 بايت بدون =
+PARAM_SEPARATOR = ':'
+TAG_SEPARATOR = '.'
+MAX_CALLBACK_DATA = 64  # حد Telegram بالبايت
+
+class CallbackCodec:
+    """ترميز مختصر لـ callback_data الخاصة بإجراءات الصفقات
+
+    الشكل: رمز الإجراء (حرف) + UUID الصفقة بـ base64url (22 حرفاً) + معاملات
+    اختيارية مفصولة بـ ":" + وسم HMAC قصير بعد "." إذا تم تعيين secret.
+    مثلاً pay_usdt_polygon_<uuid> (53 بايت) تصبح 23 بايت، وفك الترميز
+    مجرد تقطيع بمواقع ثابتة.
+    """
+
+    def __init__(self, secret: Optional[str] = None, tag_length: int = 4):
+        self.secret = secret.encode() if secret else None
+        self.tag_length = tag_length  # بايت قبل base64url
+
+    @staticmethod
+    def is_encoded(data: str) -> bool:
+        return bool(data) and data[0] in CODE_ACTIONS
+
+    def _tag(self, body: str) -> str:
+        digest = hmac.new(self.secret, body.encode(), hashlib.sha256).digest()[:self.tag_length]
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def encode(self, action: str, deal_id: str, *params) -> str:
+        """ترميز إجراء على صفقة مع معاملات اختيارية"""
+        body = ACTION_CODES[action] + base64.urlsafe_b64encode(uuid.UUID(deal_id).bytes).decode().rstrip('=')
+        for param in params:
+            param = str(param)
+            if PARAM_SEPARATOR in param or TAG_SEPARATOR in param:
+                raise ValueError(f"Invalid callback parameter: {param}")
+            body += PARAM_SEPARATOR + param
+
+        data = body + TAG_SEPARATOR + self._tag(body) if self.secret else body
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f"Callback data too long: {data}")
+        return data
+
+    def decode(self, data: str) -> Tuple[str, str, Tuple[str, ...]]:
+        """فك الترميز إلى (الإجراء، deal_id، المعاملات)، ويرفع ValueError إذا كانت البيانات غير صالحة"""
+        action = CODE_ACTIONS.get(data[:1])
+        if not action:
+            raise ValueError("Unknown callback action")
+
+        body = data
+        if self.secret:
+            body, _, tag = data.rpartition(TAG_SEPARATOR)
+            if not body or not hmac.compare_digest(tag, self._tag(body)):
+                raise ValueError("Invalid callback tag")
+
+        raw_deal_id = body[1:1 + DEAL_ID_LENGTH]
+        rest = body[1 + DEAL_ID_LENGTH:]
+        if len(raw_deal_id) != DEAL_ID_LENGTH or (rest and rest[0] != PARAM_SEPARATOR):
+            raise ValueError("Malformed callback data")
+
+        deal_id = str(uuid.UUID(bytes=base64.urlsafe_b64decode(raw_deal_id + '==')))
+        params = tuple(rest[1:].split(PARAM_SEPARATOR)) if rest else ()
+        return action, deal_id, params
+
+callback_codec = CallbackCodec(os.getenv('CALLBACK_SECRET'))
+
+def encode_callback(action: str, deal_id: str, *params) -> str:
+    """callback_data مختصرة لإجراء على صفقة"""
+    return callback_codec.encode(action, deal_id, *params)
@@ -0,0 +1,151 @@
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Any, Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable[Any]]
+Parser = Callable[[str], Tuple[Any, ...]]
+ActionParser = Callable[[str, Tuple[str, ...]], Tuple[Any, ...]]
+
+def single_arg(rest: str) -> Tuple[str]:
+    """المحلل الافتراضي: باقي البيانات بعد البادئة كمعامل واحد (مثل deal_id)"""
+    if not rest:
+        raise ValueError("Missing callback argument")
+    return (rest,)
+
+def deal_arg(deal_id: str, params: Tuple[str, ...]) -> Tuple[str]:
+    """المحلل الافتراضي للأزرار المرمزة: deal_id فقط"""
+    return (deal_id,)
+
+@dataclass
+class CallbackRoute:
+    """مسار زر واحد مع إحصائياته"""
+    name: str
+    handler: Handler
+    parser: Optional[Callable[..., Tuple[Any, ...]]] = None
+    calls: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_time': round(self.total_time / self.calls, 4) if self.calls else 0.0,
+            'max_time': round(self.max_time, 4)
+        }
+
+@dataclass
+class _TrieNode:
+    children: Dict[str, '_TrieNode'] = field(default_factory=dict)
+    route: Optional[CallbackRoute] = None
+
+class CallbackRouter:
+    """توجيه بيانات الأزرار (callback_data) إلى معالجاتها
+
+    المسارات الثابتة في قاموس، ومسارات البادئات في trie حيث تفوز أطول بادئة
+    مطابقة (dispute_reason_ قبل dispute_). التكلفة تعتمد على طول البيانات
+    (64 بايت كحد أقصى في Telegram) وليس على عدد المسارات. البيانات تُحلل مرة
+    واحدة إلى معاملات ويُستدعى المعالج بـ (query, context, *args).
+
+    إذا تم تمرير codec، فالبيانات المرمزة (انظر callback_codec) تُفك وتُوجه
+    حسب اسم الإجراء عبر قاموس.
+    """
+
+    def __init__(self, codec=None):
+        self.codec = codec
+        self._exact: Dict[str, CallbackRoute] = {}
+        self._actions: Dict[str, CallbackRoute] = {}
+        self._prefixes = _TrieNode()
+        self.unmatched = 0
+        self.invalid = 0
+
+    def add(self, data: str, handler: Handler):
+        """مسار لقيمة callback_data ثابتة"""
+        self._exact[data] = CallbackRoute(name=data, handler=handler)
+
+    def add_prefix(self, prefix: str, handler: Handler, parser: Parser = single_arg):
+        """مسار لبادئة، وباقي البيانات يُحلل بواسطة parser (يرفع ValueError إذا كانت غير صالحة)"""
+        node = self._prefixes
+        for char in prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        node.route = CallbackRoute(name=f"{prefix}*", handler=handler, parser=parser)
+
+    def add_action(self, action: str, handler: Handler, parser: ActionParser = deal_arg):
+        """مسار لإجراء مرمز، و parser يحول (deal_id, params) إلى معاملات المعالج"""
+        self._actions[action] = CallbackRoute(name=action, handler=handler, parser=parser)
+
+    def resolve(self, data: str) -> Tuple[Optional[CallbackRoute], Tuple[Any, ...]]:
+        """إيجاد المسار وتحليل المعاملات، أو (None, ()) إذا لم يوجد مسار"""
+        if self.codec and self.codec.is_encoded(data):
+            action, deal_id, params = self.codec.decode(data)
+            route = self._actions.get(action)
+            if not route:
+                return None, ()
+            return route, route.parser(deal_id, params)
+
+        route = self._exact.get(data)
+        if route:
+            return route, ()
+
+        node = self._prefixes
+        match, match_length = None, 0
+        for index, char in enumerate(data):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.route:
+                match, match_length = node.route, index + 1
+
+        if not match:
+            return None, ()
+        return match, match.parser(data[match_length:])
+
+    async def dispatch(self, query, context) -> bool:
+        """تنفيذ معالج الزر، ويرجع False إذا كانت البيانات غير معروفة أو غير صالحة"""
+        data = query.data or ''
+        try:
+            route, args = self.resolve(data)
+        except (ValueError, TypeError):
+            self.invalid += 1
+            logger.warning(f"Invalid callback data: {data}")
+            return False
+
+        if not route:
+            self.unmatched += 1
+            logger.warning(f"No route for callback data: {data}")
+            return False
+
+        started = time.monotonic()
+        try:
+            await route.handler(query, context, *args)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            route.calls += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+        return True
+
+    def _prefix_routes(self):
+        stack = [self._prefixes]
+        while stack:
+            node = stack.pop()
+            if node.route:
+                yield node.route
+            stack.extend(node.children.values())
+
+    def get_stats(self) -> Dict[str, Any]:
+        """عدد الاستدعاءات وزمن التنفيذ لكل مسار، الأبطأ أولاً"""
+        routes = list(self._exact.values()) + list(self._actions.values()) + list(self._prefix_routes())
+        routes.sort(key=lambda route: route.total_time, reverse=True)
+        return {
+            'routes': {route.name: route.get_stats() for route in routes},
+            'unmatched': self.unmatched,
+            'invalid': self.invalid
+        }
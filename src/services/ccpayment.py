@@ -3,11 +3,103 @@ import json
 import time
 import hashlib
 import hmac
-import requests
-from typing import Dict, Any, Optional
+import asyncio
+import threading
+import math
+import weakref
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, Tuple, Iterable, List
+from src.services.singleflight import SingleFlight, AsyncSingleFlight, ResultCache
 
-class CCPaymentService:
-    """خدمة التكامل مع CCPayment API"""
+# حدود مجمع الاتصالات المشترك (keep-alive)
+POOL_LIMITS = httpx.Limits(
+    max_connections=50,
+    max_keepalive_connections=20,
+    keepalive_expiry=30
+)
+
+# مهلة كل endpoint بالثواني
+DEFAULT_TIMEOUT = 30
+CONNECT_TIMEOUT = 5
+ENDPOINT_TIMEOUTS = {
+    'merchant/getDepositRecord': 10,
+    'merchant/createDepositAddress': 20,
+    'merchant/createCheckoutPage': 20,
+    'merchant/createNetworkWithdrawal': 30,
+    'common/getCoinList': 15
+}
+
+# إعدادات جلب سجلات الإيداع بالجملة
+MAX_RECORDS_CHUNK_SIZE = 50
+DEFAULT_RECORDS_CONCURRENCY = 10
+
+REQUEST_HEADERS = {
+    'Content-Type': 'application/json',
+    'User-Agent': 'OTC-Bot/1.0'
+}
+
+# مدة حفظ نتيجة getDepositRecord لخدمة فحوصات الحالة المتكررة (ثانية)
+DEPOSIT_RECORD_CACHE_TTL = 5
+
+# دمج الطلبات المتطابقة الجارية حسب (endpoint, orderId)، مشترك بين جميع النسخ
+request_flights = SingleFlight()
+async_request_flights = AsyncSingleFlight()
+deposit_record_cache = ResultCache(ttl=DEPOSIT_RECORD_CACHE_TTL)
+
+_http_client = None
+_http_client_lock = threading.Lock()
+# عميل async لكل event loop (لا يمكن مشاركة AsyncClient بين عدة loops)
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> httpx.Client:
+    """الحصول على عميل HTTP المشترك بين جميع threads العملية"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=POOL_LIMITS, headers=REQUEST_HEADERS)
+    return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """الحصول على عميل HTTP غير المتزامن الخاص بالـ event loop الحالي"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=POOL_LIMITS, headers=REQUEST_HEADERS)
+        _async_http_clients[loop] = client
+    return client
+
+
+async def close_async_http_client():
+    """إغلاق عميل HTTP الخاص بالـ event loop الحالي"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def chunk_order_ids(order_ids: Iterable[str], concurrency: int,
+                    chunk_size: Optional[int] = None) -> List[List[str]]:
+    """تقسيم معرفات الطلبات (بدون تكرار) إلى دفعات"""
+    unique_ids = list(dict.fromkeys(order_ids))
+    if not unique_ids:
+        return []
+    if not chunk_size:
+        chunk_size = math.ceil(len(unique_ids) / max(1, concurrency))
+    chunk_size = max(1, min(chunk_size, MAX_RECORDS_CHUNK_SIZE))
+    return [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+
+
+def get_endpoint_timeout(endpoint: str) -> httpx.Timeout:
+    """مهلة الطلب حسب الـ endpoint"""
+    return httpx.Timeout(ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT), connect=CONNECT_TIMEOUT)
+
+
+class _CCPaymentBase:
+    """المنطق المشترك بين العميل المتزامن وغير المتزامن: التوقيع وتوحيد الاستجابات"""
     
     def __init__(self, app_id: str, app_secret: str, base_url: str = "https://ccpayment.com"):
         self.app_id = app_id
@@ -31,8 +123,8 @@ class CCPaymentService:
         
         return signature
     
-    def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        """إرسال طلب إلى CCPayment API"""
+    def _prepare_request(self, endpoint: str, data: Dict[str, Any]) -> Tuple[str, Dict[str, Any], httpx.Timeout]:
+        """تجهيز رابط الطلب والبيانات الموقعة والمهلة"""
         # إضافة معاملات أساسية
         data['appId'] = self.app_id
         data['timestamp'] = int(time.time())
@@ -41,66 +133,109 @@ class CCPaymentService:
         signature = self._generate_signature(data)
         data['sign'] = signature
         
-        # إرسال الطلب
         url = f"{self.api_url}/{endpoint}"
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'OTC-Bot/1.0'
-        }
-        
+        return url, data, get_endpoint_timeout(endpoint)
+    
+    @staticmethod
+    def _parse_response(response: httpx.Response) -> Dict[str, Any]:
+        """التحقق من الاستجابة وتحويلها إلى JSON"""
         try:
-            response = requests.post(url, json=data, headers=headers, timeout=30)
             response.raise_for_status()
-            
-            result = response.json()
-            return result
-            
-        except requests.exceptions.RequestException as e:
+            return response.json()
+        except httpx.HTTPError as e:
             raise Exception(f"CCPayment API request failed: {str(e)}")
         except json.JSONDecodeError as e:
             raise Exception(f"Invalid JSON response from CCPayment: {str(e)}")
     
-    def create_deposit_address(self, order_id: str, coin_id: int, amount: float, 
-                             fiat_id: Optional[int] = None) -> Dict[str, Any]:
-        """إنشاء عنوان إيداع لصفقة محددة"""
+    @staticmethod
+    def _failure(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'success': False,
+            'error': result.get('msg', 'Unknown error'),
+            'code': result.get('code')
+        }
+    
+    @classmethod
+    def _parse_deposit_address(cls, result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('code') == 10000:  # نجح الطلب
+            return {
+                'success': True,
+                'data': result.get('data', {}),
+                'address': result.get('data', {}).get('address'),
+                'amount': result.get('data', {}).get('amount'),
+                'coin_name': result.get('data', {}).get('coinName'),
+                'network': result.get('data', {}).get('network')
+            }
+        return cls._failure(result)
+    
+    @classmethod
+    def _parse_checkout_page(cls, result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('code') == 10000:
+            return {
+                'success': True,
+                'data': result.get('data', {}),
+                'checkout_url': result.get('data', {}).get('checkoutUrl'),
+                'order_id': result.get('data', {}).get('orderId')
+            }
+        return cls._failure(result)
+    
+    @classmethod
+    def _parse_deposit_record(cls, result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('code') == 10000:
+            return {
+                'success': True,
+                'data': result.get('data', {}),
+                'status': result.get('data', {}).get('status'),
+                'amount': result.get('data', {}).get('amount'),
+                'tx_id': result.get('data', {}).get('txId')
+            }
+        return cls._failure(result)
+    
+    @classmethod
+    def _parse_withdrawal(cls, result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('code') == 10000:
+            return {
+                'success': True,
+                'data': result.get('data', {}),
+                'withdrawal_id': result.get('data', {}).get('withdrawalId'),
+                'status': result.get('data', {}).get('status')
+            }
+        return cls._failure(result)
+    
+    @staticmethod
+    def _parse_coin_list(result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('code') == 10000:
+            return {
+                'success': True,
+                'coins': result.get('data', [])
+            }
+        return {
+            'success': False,
+            'error': result.get('msg', 'Unknown error')
+        }
+    
+    def _deposit_address_request(self, order_id: str, coin_id: int, amount: Optional[float],
+                                 fiat_id: Optional[int] = None, chain: Optional[str] = None):
         data = {
             'orderId': order_id,
-            'coinId': coin_id,
-            'price': str(amount)
+            'coinId': coin_id
         }
         
+        # الشبكة المطلوبة للعملات المتاحة على أكثر من شبكة (مثل USDT)
+        if chain:
+            data['chain'] = chain
+        
+        # بدون سعر للعناوين المُنشأة مسبقاً في المجمع
+        if amount is not None:
+            data['price'] = str(amount)
+        
         if fiat_id:
             data['fiatId'] = fiat_id
         
-        try:
-            result = self._make_request('merchant/createDepositAddress', data)
-            
-            if result.get('code') == 10000:  # نجح الطلب
-                return {
-                    'success': True,
-                    'data': result.get('data', {}),
-                    'address': result.get('data', {}).get('address'),
-                    'amount': result.get('data', {}).get('amount'),
-                    'coin_name': result.get('data', {}).get('coinName'),
-                    'network': result.get('data', {}).get('network')
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('msg', 'Unknown error'),
-                    'code': result.get('code')
-                }
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+        return 'merchant/createDepositAddress', data, self._parse_deposit_address
     
-    def create_checkout_page(self, order_id: str, amount: float, 
-                           return_url: str = None, cancel_url: str = None) -> Dict[str, Any]:
-        """إنشاء صفحة دفع حيث يختار العميل العملة"""
+    def _checkout_page_request(self, order_id: str, amount: float,
+                               return_url: str = None, cancel_url: str = None):
         data = {
             'orderId': order_id,
             'price': str(amount)
@@ -111,62 +246,16 @@ class CCPaymentService:
         if cancel_url:
             data['cancelUrl'] = cancel_url
         
-        try:
-            result = self._make_request('merchant/createCheckoutPage', data)
-            
-            if result.get('code') == 10000:
-                return {
-                    'success': True,
-                    'data': result.get('data', {}),
-                    'checkout_url': result.get('data', {}).get('checkoutUrl'),
-                    'order_id': result.get('data', {}).get('orderId')
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('msg', 'Unknown error'),
-                    'code': result.get('code')
-                }
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+        return 'merchant/createCheckoutPage', data, self._parse_checkout_page
     
-    def get_deposit_record(self, order_id: str) -> Dict[str, Any]:
-        """الحصول على سجل الإيداع لصفقة محددة"""
+    def _deposit_record_request(self, order_id: str):
         data = {
             'orderId': order_id
         }
-        
-        try:
-            result = self._make_request('merchant/getDepositRecord', data)
-            
-            if result.get('code') == 10000:
-                return {
-                    'success': True,
-                    'data': result.get('data', {}),
-                    'status': result.get('data', {}).get('status'),
-                    'amount': result.get('data', {}).get('amount'),
-                    'tx_id': result.get('data', {}).get('txId')
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('msg', 'Unknown error'),
-                    'code': result.get('code')
-                }
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+        return 'merchant/getDepositRecord', data, self._parse_deposit_record
     
-    def create_withdrawal(self, coin_id: int, chain: str, address: str, 
-                         amount: float, order_id: str) -> Dict[str, Any]:
-        """إنشاء طلب سحب (إرسال أموال للبائع)"""
+    def _withdrawal_request(self, coin_id: int, chain: str, address: str,
+                            amount: float, order_id: str):
         data = {
             'coinId': coin_id,
             'chain': chain,
@@ -174,29 +263,24 @@ class CCPaymentService:
             'amount': str(amount),
             'orderId': order_id
         }
-        
-        try:
-            result = self._make_request('merchant/createNetworkWithdrawal', data)
-            
-            if result.get('code') == 10000:
-                return {
-                    'success': True,
-                    'data': result.get('data', {}),
-                    'withdrawal_id': result.get('data', {}).get('withdrawalId'),
-                    'status': result.get('data', {}).get('status')
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('msg', 'Unknown error'),
-                    'code': result.get('code')
-                }
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+        return 'merchant/createNetworkWithdrawal', data, self._parse_withdrawal
+    
+    def _coin_list_request(self):
+        # هذا endpoint قد يختلف حسب وثائق CCPayment
+        return 'common/getCoinList', {}, self._parse_coin_list
+    
+    def _flight_key(self, endpoint: str, data: Dict[str, Any]) -> Optional[Tuple]:
+        """مفتاح دمج الطلب من كل معاملاته، أو None للطلبات غير المرتبطة بطلب محدد
+
+        طلبان لنفس orderId بعملة أو مبلغ أو عنوان مختلف ليسا متطابقين ولا يُدمجان.
+        """
+        if data.get('orderId') is None:
+            return None
+        params = tuple(sorted(
+            (name, str(value)) for name, value in data.items()
+            if name not in ('appId', 'timestamp', 'sign')
+        ))
+        return (self.app_id, endpoint, params)
     
     def verify_webhook(self, data: Dict[str, Any], signature: str) -> bool:
         """التحقق من صحة webhook من CCPayment"""
@@ -209,29 +293,174 @@ class CCPaymentService:
             
         except Exception:
             return False
+
+
+class CCPaymentService(_CCPaymentBase):
+    """خدمة التكامل مع CCPayment API"""
+    
+    def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """إرسال طلب إلى CCPayment API عبر مجمع الاتصالات المشترك"""
+        url, data, timeout = self._prepare_request(endpoint, data)
+        
+        try:
+            response = get_http_client().post(url, json=data, timeout=timeout)
+        except httpx.HTTPError as e:
+            raise Exception(f"CCPayment API request failed: {str(e)}")
+        
+        return self._parse_response(response)
+    
+    def _call(self, endpoint: str, data: Dict[str, Any], parser: Callable) -> Dict[str, Any]:
+        """تنفيذ الطلب وتوحيد الاستجابة (الطلبات المتطابقة الجارية تشترك في نفس الاستدعاء)"""
+        key = self._flight_key(endpoint, data)
+        if key is None:
+            return self._call_once(endpoint, data, parser)
+        return request_flights.do(key, lambda: self._call_once(endpoint, data, parser))
+    
+    def _call_once(self, endpoint: str, data: Dict[str, Any], parser: Callable) -> Dict[str, Any]:
+        try:
+            return parser(self._make_request(endpoint, data))
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
+    def create_deposit_address(self, order_id: str, coin_id: int, amount: float, 
+                             fiat_id: Optional[int] = None, chain: Optional[str] = None) -> Dict[str, Any]:
+        """إنشاء عنوان إيداع لصفقة محددة"""
+        return self._call(*self._deposit_address_request(order_id, coin_id, amount, fiat_id, chain))
+    
+    def create_checkout_page(self, order_id: str, amount: float, 
+                           return_url: str = None, cancel_url: str = None) -> Dict[str, Any]:
+        """إنشاء صفحة دفع حيث يختار العميل العملة"""
+        return self._call(*self._checkout_page_request(order_id, amount, return_url, cancel_url))
+    
+    def get_deposit_record(self, order_id: str) -> Dict[str, Any]:
+        """الحصول على سجل الإيداع لصفقة محددة (مع ذاكرة مؤقتة قصيرة)"""
+        cached = deposit_record_cache.get(order_id)
+        if cached is not None:
+            return cached
+        
+        generation = deposit_record_cache.generation
+        result = self._call(*self._deposit_record_request(order_id))
+        if result.get('success'):
+            deposit_record_cache.set(order_id, result, generation)
+        return result
+    
+    def get_deposit_records(self, order_ids: Iterable[str], chunk_size: Optional[int] = None,
+                            max_concurrency: int = DEFAULT_RECORDS_CONCURRENCY) -> Dict[str, Dict[str, Any]]:
+        """الحصول على سجلات الإيداع لعدة طلبات
+
+        لا يوفر CCPayment endpoint للجلب بالجملة، لذلك يتم تقسيم الطلبات إلى دفعات
+        تُجلب بالتوازي، وكل دفعة ترسل طلباتها بالتتابع على اتصال keep-alive من المجمع.
+        النتيجة قاموس حسب رقم الطلب، ولكل طلب نتيجته أو خطؤه الخاص.
+        """
+        chunks = chunk_order_ids(order_ids, max_concurrency, chunk_size)
+        results = {}
+        if not chunks:
+            return results
+        
+        def fetch_chunk(chunk):
+            return {order_id: self.get_deposit_record(order_id) for order_id in chunk}
+        
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+            for chunk_results in executor.map(fetch_chunk, chunks):
+                results.update(chunk_results)
+        
+        return results
+    
+    def create_withdrawal(self, coin_id: int, chain: str, address: str, 
+                         amount: float, order_id: str) -> Dict[str, Any]:
+        """إنشاء طلب سحب (إرسال أموال للبائع)"""
+        return self._call(*self._withdrawal_request(coin_id, chain, address, amount, order_id))
     
     def get_supported_coins(self) -> Dict[str, Any]:
         """الحصول على قائمة العملات المدعومة"""
+        return self._call(*self._coin_list_request())
+
+
+class AsyncCCPaymentService(_CCPaymentBase):
+    """نسخة غير متزامنة من خدمة CCPayment للاستخدام داخل event loop"""
+    
+    async def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """إرسال طلب إلى CCPayment API دون حجز الـ event loop"""
+        url, data, timeout = self._prepare_request(endpoint, data)
+        
         try:
-            # هذا endpoint قد يختلف حسب وثائق CCPayment
-            result = self._make_request('common/getCoinList', {})
-            
-            if result.get('code') == 10000:
-                return {
-                    'success': True,
-                    'coins': result.get('data', [])
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': result.get('msg', 'Unknown error')
-                }
-                
+            response = await get_async_http_client().post(url, json=data, timeout=timeout)
+        except httpx.HTTPError as e:
+            raise Exception(f"CCPayment API request failed: {str(e)}")
+        
+        return self._parse_response(response)
+    
+    async def _call(self, endpoint: str, data: Dict[str, Any], parser: Callable) -> Dict[str, Any]:
+        """تنفيذ الطلب وتوحيد الاستجابة (الطلبات المتطابقة الجارية تشترك في نفس الاستدعاء)"""
+        key = self._flight_key(endpoint, data)
+        if key is None:
+            return await self._call_once(endpoint, data, parser)
+        return await async_request_flights.do(key, lambda: self._call_once(endpoint, data, parser))
+    
+    async def _call_once(self, endpoint: str, data: Dict[str, Any], parser: Callable) -> Dict[str, Any]:
+        try:
+            return parser(await self._make_request(endpoint, data))
         except Exception as e:
             return {
                 'success': False,
                 'error': str(e)
             }
+    
+    async def create_deposit_address(self, order_id: str, coin_id: int, amount: float,
+                                     fiat_id: Optional[int] = None, chain: Optional[str] = None) -> Dict[str, Any]:
+        """إنشاء عنوان إيداع لصفقة محددة"""
+        return await self._call(*self._deposit_address_request(order_id, coin_id, amount, fiat_id, chain))
+    
+    async def create_checkout_page(self, order_id: str, amount: float,
+                                   return_url: str = None, cancel_url: str = None) -> Dict[str, Any]:
+        """إنشاء صفحة دفع حيث يختار العميل العملة"""
+        return await self._call(*self._checkout_page_request(order_id, amount, return_url, cancel_url))
+    
+    async def get_deposit_record(self, order_id: str) -> Dict[str, Any]:
+        """الحصول على سجل الإيداع لصفقة محددة (مع ذاكرة مؤقتة قصيرة)"""
+        cached = deposit_record_cache.get(order_id)
+        if cached is not None:
+            return cached
+        
+        generation = deposit_record_cache.generation
+        result = await self._call(*self._deposit_record_request(order_id))
+        if result.get('success'):
+            deposit_record_cache.set(order_id, result, generation)
+        return result
+    
+    async def get_deposit_records(self, order_ids: Iterable[str], chunk_size: Optional[int] = None,
+                                  max_concurrency: int = DEFAULT_RECORDS_CONCURRENCY,
+                                  timeout: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """الحصول على سجلات الإيداع لعدة طلبات (دفعات متوازية، مهلة اختيارية لكل طلب)"""
+        chunks = chunk_order_ids(order_ids, max_concurrency, chunk_size)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        results = {}
+        
+        async def fetch_one(order_id):
+            try:
+                return await asyncio.wait_for(self.get_deposit_record(order_id), timeout=timeout)
+            except asyncio.TimeoutError:
+                return {'success': False, 'error': 'timeout', 'timed_out': True}
+        
+        async def fetch_chunk(chunk):
+            async with semaphore:
+                for order_id in chunk:
+                    results[order_id] = await fetch_one(order_id)
+        
+        await asyncio.gather(*[fetch_chunk(chunk) for chunk in chunks])
+        return results
+    
+    async def create_withdrawal(self, coin_id: int, chain: str, address: str,
+                                amount: float, order_id: str) -> Dict[str, Any]:
+        """إنشاء طلب سحب (إرسال أموال للبائع)"""
+        return await self._call(*self._withdrawal_request(coin_id, chain, address, amount, order_id))
+    
+    async def get_supported_coins(self) -> Dict[str, Any]:
+        """الحصول على قائمة العملات المدعومة"""
+        return await self._call(*self._coin_list_request())
 
 # إعدادات افتراضية للعملات الشائعة
 DEFAULT_COINS = {
@@ -249,13 +478,120 @@ DEFAULT_COINS = {
     }
 }
 
-def get_ccpayment_service() -> CCPaymentService:
-    """إنشاء instance من خدمة CCPayment"""
-    app_id = os.getenv('CCPAYMENT_APP_ID', 'your_app_id_here')
-    app_secret = os.getenv('CCPAYMENT_APP_SECRET', 'your_app_secret_here')
+# ملف بيانات الاعتماد الذي يُقرأ من جديد عند كل إعادة تحميل (KEY=VALUE كملف .env)
+DEFAULT_CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), '.env')
+
+def _read_env_file(path: str) -> Dict[str, str]:
+    """قراءة متغيرات KEY=VALUE من ملف بصيغة .env (بدون توسيع المتغيرات)"""
+    values = {}
+    with open(path, encoding='utf-8') as env_file:
+        for line in env_file:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            name = name.strip()
+            if name.startswith('export '):
+                name = name[len('export '):].strip()
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in ('"', "'"):
+                value = value[1:-1]
+            values[name] = value
+    return values
+
+def _load_credentials() -> Tuple[str, str]:
+    """قراءة بيانات اعتماد CCPayment
+
+    القيم في ملف CCPAYMENT_CREDENTIALS_FILE (افتراضياً .env في جذر المشروع) لها
+    الأولوية على متغيرات البيئة، لأن متغيرات بيئة العملية لا تتغير بعد التشغيل
+    بينما يمكن تدوير المفاتيح في الملف ثم استدعاء reload.
+    """
+    path = os.getenv('CCPAYMENT_CREDENTIALS_FILE', DEFAULT_CREDENTIALS_FILE)
+    values = _read_env_file(path) if os.path.isfile(path) else {}
+
+    app_id = values.get('CCPAYMENT_APP_ID') or os.getenv('CCPAYMENT_APP_ID', 'your_app_id_here')
+    app_secret = values.get('CCPAYMENT_APP_SECRET') or os.getenv('CCPAYMENT_APP_SECRET', 'your_app_secret_here')
     
     if app_id == 'your_app_id_here' or app_secret == 'your_app_secret_here':
         raise Exception("CCPayment credentials not configured. Please set CCPAYMENT_APP_ID and CCPAYMENT_APP_SECRET environment variables.")
     
-    return CCPaymentService(app_id, app_secret)
+    return app_id, app_secret
+
+class CCPaymentRegistry:
+    """سجل مشترك لخدمة CCPayment على مستوى العملية
+
+    يتم إنشاء الخدمة مرة واحدة ومشاركتها بين threads الـ Flask والبوت والمراقب.
+    عند إعادة تحميل بيانات الاعتماد يتم استبدال المرجع بشكل ذري، والطلبات
+    الجارية تكمل بالنسخة القديمة عبر نفس مجمع الاتصالات.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services = None  # (credentials, sync_service, async_service)
+        self.reload_count = 0
+        self.loaded_at = None
+    
+    def _build(self, credentials: Tuple[str, str]):
+        app_id, app_secret = credentials
+        return (
+            credentials,
+            CCPaymentService(app_id, app_secret),
+            AsyncCCPaymentService(app_id, app_secret)
+        )
+    
+    def _current(self):
+        services = self._services
+        if services is None:
+            with self._lock:
+                if self._services is None:
+                    self._services = self._build(_load_credentials())
+                    self.loaded_at = time.time()
+                services = self._services
+        return services
+    
+    def get(self) -> CCPaymentService:
+        """الخدمة المتزامنة المشتركة"""
+        return self._current()[1]
+    
+    def get_async(self) -> AsyncCCPaymentService:
+        """الخدمة غير المتزامنة المشتركة"""
+        return self._current()[2]
+    
+    def reload(self) -> bool:
+        """إعادة قراءة بيانات الاعتماد واستبدال الخدمة إذا تغيرت"""
+        credentials = _load_credentials()
+        with self._lock:
+            if self._services is not None and self._services[0] == credentials:
+                return False
+            self._services = self._build(credentials)
+            self.reload_count += 1
+            self.loaded_at = time.time()
+        deposit_record_cache.clear()
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """حالة السجل"""
+        services = self._services
+        return {
+            'configured': services is not None,
+            'app_id': services[0][0] if services else None,
+            'reload_count': self.reload_count,
+            'loaded_at': self.loaded_at,
+            'request_flights': request_flights.get_stats(),
+            'async_request_flights': async_request_flights.get_stats(),
+            'deposit_record_cache': deposit_record_cache.get_stats()
+        }
+
+ccpayment_registry = CCPaymentRegistry()
+
+def get_ccpayment_service() -> CCPaymentService:
+    """الحصول على خدمة CCPayment المشتركة"""
+    return ccpayment_registry.get()
+
+def get_async_ccpayment_service() -> AsyncCCPaymentService:
+    """الحصول على خدمة CCPayment غير المتزامنة المشتركة"""
+    return ccpayment_registry.get_async()
 
+def reload_ccpayment_service() -> bool:
+    """إعادة تحميل بيانات اعتماد CCPayment من ملف بيانات الاعتماد"""
+    return ccpayment_registry.reload()
@@ -0,0 +1,223 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+class Conversation:
+    """حالة محادثة مستخدم واحد: الخطوات الجارية وبياناتها"""
+    __slots__ = ('flow', 'step', 'data', 'touched')
+
+    def __init__(self, flow: str, step: str, data: Optional[Dict[str, Any]] = None):
+        self.flow = flow
+        self.step = step
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+class ConversationStore:
+    """حالات المحادثات في الذاكرة مع كتابة غير متزامنة إلى قاعدة البيانات
+
+    كل تعديل يُسجل ويُكتب دفعة واحدة كل flush_interval ثانية، فتستأنف
+    المحادثات بعد إعادة التشغيل. الحالات الخاملة لأكثر من idle_ttl تُحذف من
+    الذاكرة (وتُقرأ من قاعدة البيانات عند عودة المستخدم)، والمتروكة لأكثر من
+    abandon_ttl تُحذف من قاعدة البيانات، فيبقى استهلاك الذاكرة ثابتاً.
+
+    كل الدوال تُستدعى من الـ event loop الخاص بالبوت. بدون repository تعمل
+    الذاكرة فقط.
+    """
+
+    def __init__(self, repository=None, idle_ttl: float = 1800, max_entries: int = 10000,
+                 flush_interval: float = 1.0, abandon_ttl: float = 7 * 24 * 3600):
+        self.repository = repository
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.abandon_ttl = abandon_ttl
+
+        self._entries: 'OrderedDict[int, Conversation]' = OrderedDict()
+        self._dirty: Dict[int, Optional[Conversation]] = {}  # None = حذف
+        self._writing: Dict[int, Optional[Conversation]] = {}  # الدفعة الجاري كتابتها
+        self._known_empty: 'OrderedDict[int, float]' = OrderedDict()  # مستخدمون بدون حالة محفوظة
+        self._task = None
+        self._last_purge = 0.0
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+    async def get(self, user_id: int) -> Optional[Conversation]:
+        """حالة المستخدم الحالية أو None"""
+        conversation = self._entries.get(user_id)
+        if conversation is not None:
+            conversation.touched = time.monotonic()
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return conversation
+
+        # حذف لم يُكتب بعد، أو مستخدم تم التحقق من عدم وجود حالة له
+        if not self.repository or self._is_pending(user_id):
+            return None
+        expires_at = self._known_empty.get(user_id)
+        if expires_at and expires_at > time.monotonic():
+            return None
+
+        self.loads += 1
+        row = await self.repository.load_conversation(user_id)
+        # قد تكون الحالة تغيرت أثناء القراءة
+        if user_id in self._entries or self._is_pending(user_id):
+            return self._entries.get(user_id)
+
+        if row is None:
+            self._remember_empty(user_id)
+            return None
+
+        flow, step, data = row
+        conversation = Conversation(flow, step, data)
+        self._store(user_id, conversation)
+        return conversation
+
+    def start(self, user_id: int, flow: str, step: str, **data) -> Conversation:
+        """بدء خطوات جديدة (تستبدل أي حالة سابقة)"""
+        conversation = Conversation(flow, step, data)
+        self._store(user_id, conversation)
+        self._dirty[user_id] = conversation
+        self._known_empty.pop(user_id, None)
+        return conversation
+
+    def update(self, user_id: int, step: Optional[str] = None, **data) -> Optional[Conversation]:
+        """الانتقال لخطوة أخرى و/أو حفظ بيانات"""
+        conversation = self._entries.get(user_id)
+        if conversation is None:
+            return None
+        if step:
+            conversation.step = step
+        conversation.data.update(data)
+        conversation.touched = time.monotonic()
+        self._dirty[user_id] = conversation
+        return conversation
+
+    def finish(self, user_id: int):
+        """إنهاء الخطوات وحذف الحالة"""
+        self._entries.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._remember_empty(user_id)
+
+    def _is_pending(self, user_id: int) -> bool:
+        return user_id in self._dirty or user_id in self._writing
+
+    def _store(self, user_id: int, conversation: Conversation):
+        self._entries[user_id] = conversation
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_entries:
+            self._evict(limit_only=True)
+
+    def _remember_empty(self, user_id: int):
+        self._known_empty[user_id] = time.monotonic() + self.idle_ttl
+        self._known_empty.move_to_end(user_id)
+        while len(self._known_empty) > self.max_entries:
+            self._known_empty.popitem(last=False)
+
+    def _evict(self, limit_only: bool = False):
+        """حذف الحالات الخاملة أو الأقدم من الذاكرة، مع إبقاء ما لم يُكتب بعد"""
+        deadline = time.monotonic() - self.idle_ttl
+        for user_id in list(self._entries):
+            conversation = self._entries[user_id]
+            if limit_only:
+                if len(self._entries) <= self.max_entries:
+                    break
+            elif conversation.touched > deadline:
+                continue
+            if self._is_pending(user_id):
+                continue
+            del self._entries[user_id]
+            self.evictions += 1
+
+        now = time.monotonic()
+        while self._known_empty:
+            user_id, expires_at = next(iter(self._known_empty.items()))
+            if expires_at > now:
+                break
+            del self._known_empty[user_id]
+
+    async def flush(self) -> int:
+        """كتابة التعديلات المتراكمة دفعة واحدة"""
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        if not self.repository:
+            return 0
+
+        # نسخة من البيانات وقت الكتابة، لأن المحادثة قد تتغير أثناءها
+        upserts = {
+            user_id: (conversation.flow, conversation.step, dict(conversation.data))
+            for user_id, conversation in dirty.items() if conversation is not None
+        }
+        deletes = [user_id for user_id, conversation in dirty.items() if conversation is None]
+
+        self._writing = dirty
+        try:
+            await self.repository.save_conversations(upserts, deletes)
+        except Exception as e:
+            logger.error(f"Error saving conversation states: {e}")
+            self.flush_errors += 1
+            # إعادة ما لم يُكتب دون استبدال التعديلات الأحدث
+            for user_id, conversation in dirty.items():
+                self._dirty.setdefault(user_id, conversation)
+            return 0
+        finally:
+            self._writing = {}
+
+        self.flushes += 1
+        self.flushed_rows += len(dirty)
+        return len(dirty)
+
+    async def purge_abandoned(self) -> int:
+        """حذف الحالات المتروكة من قاعدة البيانات"""
+        if not self.repository:
+            return 0
+        before = datetime.utcnow() - timedelta(seconds=self.abandon_ttl)
+        return await self.repository.purge_conversations(before)
+
+    def start_writer(self):
+        """بدء الكتابة الدورية على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف الكتابة الدورية وكتابة ما تبقى"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict()
+
+            if time.monotonic() - self._last_purge > 3600:
+                self._last_purge = time.monotonic()
+                try:
+                    await self.purge_abandoned()
+                except Exception as e:
+                    logger.error(f"Error purging abandoned conversations: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'pending_writes': len(self._dirty),
+            'known_empty': len(self._known_empty),
+            'hits': self.hits,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'flush_errors': self.flush_errors
+        }
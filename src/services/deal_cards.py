@@ -0,0 +1,193 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Set, Tuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.models.deal import Deal
+from src.models.telegram_user import TelegramUser
+
+logger = logging.getLogger(__name__)
+
+DEAL_STATUS_TEXT = {
+    'pending': '⏳ في انتظار المشتري',
+    'paid': '💰 تم الدفع - في انتظار التأكيد',
+    'confirmed': '✅ تم التأكيد - في انتظار التحرير',
+    'completed': '🎉 مكتملة',
+    'disputed': '⚠️ نزاع مفتوح'
+}
+
+@dataclass(frozen=True)
+class DealCard:
+    """بطاقة صفقة جاهزة للعرض: النص والوسائط واسم البائع"""
+    deal_id: str
+    seller_id: int
+    buyer_id: Optional[int]
+    status: str
+    seller_name: str
+    text: str
+    media: Tuple[Tuple[str, str], ...]  # ((type, file_id), ...)
+
+def parse_media_files(media_files: Optional[str]) -> Tuple[Tuple[str, str], ...]:
+    """تحويل media_files (JSON) إلى قائمة (النوع، file_id)"""
+    if not media_files:
+        return ()
+    try:
+        return tuple((media['type'], media['file_id']) for media in json.loads(media_files))
+    except (ValueError, TypeError, KeyError):
+        logger.warning("Invalid media_files JSON")
+        return ()
+
+def render_deal_card(deal, seller_name: str) -> DealCard:
+    """بناء بطاقة الصفقة من Deal أو DealSnapshot"""
+    status_text = DEAL_STATUS_TEXT.get(deal.status, '❓ غير معروف')
+
+    text = f"""
+📦 تفاصيل الصفقة
+
+🏷️ العنوان: {deal.title}
+📝 الوصف: {deal.description}
+
+💰 السعر الأساسي: ${deal.price:.2f}
+💵 العمولة (5%): ${deal.commission:.2f}
+💳 السعر الإجمالي: ${deal.total_price:.2f}
+
+👤 البائع: {seller_name}
+📊 الحالة: {status_text}
+📅 تاريخ الإنشاء: {deal.created_at.strftime('%Y-%m-%d %H:%M') if deal.created_at else 'غير محدد'}
+            """
+
+    return DealCard(
+        deal_id=deal.id,
+        seller_id=deal.seller_id,
+        buyer_id=deal.buyer_id,
+        status=deal.status,
+        seller_name=seller_name,
+        text=text,
+        media=parse_media_files(deal.media_files)
+    )
+
+class DealCardCache:
+    """ذاكرة مؤقتة لبطاقات الصفقات التي تُفتح من روابط المشاركة
+
+    الصفقة المشهورة لا تكلف أي استعلام بعد أول فتح. تُحذف البطاقة عند أي
+    تعديل على الصفقة أو على بيانات البائع، وكما في ResultCache يمنع رقم الجيل
+    حفظ بطاقة بدأ تحميلها قبل الإبطال. الإبطال يتم داخل العملية فقط، لذلك
+    الـ ttl يحدد أقصى تأخر عند تعديل الصفقة من عملية أخرى (APP_ROLE=api).
+    """
+
+    def __init__(self, ttl: float = 120, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # deal_id -> (expires_at, card)
+        self._seller_deals: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, deal_id: str) -> Optional[DealCard]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(deal_id)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    self._remove(deal_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(deal_id)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, card: DealCard, generation: Optional[int] = None):
+        """حفظ بطاقة، مع تجاهلها إذا حدث إبطال منذ الجيل المعطى"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(card.deal_id)
+            self._entries[card.deal_id] = (time.monotonic() + self.ttl, card)
+            self._seller_deals.setdefault(card.seller_id, set()).add(card.deal_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, deal_id: str):
+        """حذف بطاقة وفهرس البائع الخاص بها (يجب استدعاؤها مع القفل)"""
+        entry = self._entries.pop(deal_id, None)
+        if entry is None:
+            return
+        seller_deals = self._seller_deals.get(entry[1].seller_id)
+        if seller_deals is not None:
+            seller_deals.discard(deal_id)
+            if not seller_deals:
+                del self._seller_deals[entry[1].seller_id]
+
+    def invalidate(self, deal_id: str):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._remove(deal_id)
+
+    def invalidate_seller(self, seller_id: int):
+        """حذف بطاقات جميع صفقات البائع (بعد تغيير اسمه مثلاً)"""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            for deal_id in list(self._seller_deals.get(seller_id, ())):
+                self._remove(deal_id)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._seller_deals.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations
+            }
+
+deal_card_cache = DealCardCache()
+
+def _invalidate_keys(keys):
+    for kind, key in keys:
+        if kind == 'deal':
+            deal_card_cache.invalidate(key)
+        else:
+            deal_card_cache.invalidate_seller(key)
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_after_flush(session, flush_context):
+    """إبطال بطاقات الصفقات والبائعين المعدلين في أي جلسة ORM"""
+    keys = []
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Deal) and obj.id:
+            keys.append(('deal', obj.id))
+        elif isinstance(obj, TelegramUser) and obj.telegram_id:
+            keys.append(('seller', obj.telegram_id))
+    if not keys:
+        return
+
+    _invalidate_keys(keys)
+    # إبطال ثانٍ بعد الـ commit حتى لا تُحفظ بطاقة قُرئت قبل ظهور التعديل
+    session.info.setdefault('deal_card_invalidations', []).extend(keys)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    keys = session.info.pop('deal_card_invalidations', None)
+    if keys:
+        _invalidate_keys(keys)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('deal_card_invalidations', None)
@@ -5,7 +5,7 @@ from typing import Dict, Any, List, Optional
 from src.models.dispute import Dispute, UserRating, SecurityLog, UserBan, db
 from src.models.deal import Deal
 from src.models.telegram_user import TelegramUser
-from src.services.notification import NotificationService
+from src.services.outbox import enqueue_notification
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +15,6 @@ class DisputeManager:
     def __init__(self, flask_app, bot_instance=None):
         self.flask_app = flask_app
         self.bot_instance = bot_instance
-        self.notification_service = NotificationService(bot_instance)
         
         # أسباب النزاعات المتاحة
         self.dispute_reasons = {
@@ -30,6 +29,12 @@ class DisputeManager:
             'other': 'أخرى'
         }
     
+    def _wake_notifications(self):
+        """تنبيه مرسل الإشعارات في البوت (قد يُستدعى من thread آخر)"""
+        dispatcher = getattr(self.bot_instance, 'notifications', None)
+        if dispatcher:
+            dispatcher.wake()
+    
     def create_dispute(self, deal_id: str, reporter_id: int, reason: str, 
                       description: str, evidence: Optional[str] = None) -> Dict[str, Any]:
         """إنشاء نزاع جديد"""
@@ -72,7 +77,11 @@ class DisputeManager:
                 deal.status = 'disputed'
                 
                 db.session.add(dispute)
+                # إشعار الطرف الآخر في نفس المعاملة
+                enqueue_notification(deal, 'dispute_created', key=dispute_id, reporter_id=reporter_id,
+                                     reason=self.dispute_reasons.get(reason, reason))
                 db.session.commit()
+                self._wake_notifications()
                 
                 # تسجيل الحدث
                 self.log_security_event(
@@ -82,9 +91,6 @@ class DisputeManager:
                     severity='warning'
                 )
                 
-                # إرسال إشعارات
-                self.notification_service.notify_dispute_created(deal, reason)
-                
                 return {
                     'success': True,
                     'dispute_id': dispute_id,
@@ -125,8 +131,11 @@ class DisputeManager:
                     else:
                         # حل وسط أو إلغاء
                         deal.status = 'cancelled'
+                    
+                    enqueue_notification(deal, 'dispute_resolved', key=dispute_id, resolution=resolution)
                 
                 db.session.commit()
+                self._wake_notifications()
                 
                 # تسجيل الحدث
                 self.log_security_event(
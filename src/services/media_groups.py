@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Dict, Any, Awaitable, Callable, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+# حد Telegram لعدد العناصر في الألبوم الواحد
+MAX_MEDIA_GROUP_SIZE = 10
+
+class _PendingGroup:
+    __slots__ = ('items', 'timer', 'on_complete')
+
+    def __init__(self, on_complete: Callable[[List[Dict[str, Any]]], Awaitable[Any]]):
+        self.items: List[Dict[str, Any]] = []
+        self.timer = None
+        self.on_complete = on_complete
+
+class MediaGroupCollector:
+    """تجميع أجزاء الألبوم (media_group_id) قبل معالجتها
+
+    يرسل Telegram كل صورة أو فيديو من الألبوم كتحديث مستقل. كل جزء جديد يعيد
+    تشغيل مهلة قصيرة (window)، وعند انتهائها دون أجزاء جديدة يُستدعى
+    on_complete مرة واحدة بكل العناصر.
+    """
+
+    def __init__(self, window: float = 1.0, max_items: int = MAX_MEDIA_GROUP_SIZE):
+        self.window = window
+        self.max_items = max_items
+        self._groups: Dict[Hashable, _PendingGroup] = {}
+
+        self.groups_completed = 0
+        self.items_collected = 0
+        self.errors_count = 0
+
+    def add(self, key: Hashable, item: Dict[str, Any],
+            on_complete: Callable[[List[Dict[str, Any]]], Awaitable[Any]]):
+        """إضافة جزء إلى الألبوم key (يُستدعى من الـ event loop)"""
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _PendingGroup(on_complete)
+
+        if len(group.items) < self.max_items:
+            group.items.append(item)
+            self.items_collected += 1
+
+        if group.timer:
+            group.timer.cancel()
+        # الألبوم الممتلئ لا ينتظر أجزاء أخرى
+        delay = 0 if len(group.items) >= self.max_items else self.window
+        group.timer = asyncio.get_running_loop().create_task(self._complete_later(key, group, delay))
+
+    async def _complete_later(self, key: Hashable, group: _PendingGroup, delay: float):
+        await asyncio.sleep(delay)
+        if self._groups.get(key) is not group:
+            return
+        del self._groups[key]
+        self.groups_completed += 1
+
+        try:
+            await group.on_complete(group.items)
+        except Exception as e:
+            self.errors_count += 1
+            logger.error(f"Error completing media group {key}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'window': self.window,
+            'pending_groups': len(self._groups),
+            'groups_completed': self.groups_completed,
+            'items_collected': self.items_collected,
+            'errors_count': self.errors_count
+        }
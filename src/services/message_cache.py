@@ -0,0 +1,52 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+def render_digest(text: str, reply_markup=None, parse_mode: Optional[str] = None) -> bytes:
+    """بصمة محتوى الرسالة كما يراه Telegram (المسافات في الطرفين تُحذف عند الإرسال)"""
+    markup = reply_markup.to_json() if reply_markup else ''
+    payload = '\0'.join((text.strip(), markup, parse_mode or ''))
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+class RenderedMessageCache:
+    """آخر محتوى معروض لكل رسالة (chat_id, message_id)
+
+    يُستخدم لتجاهل تعديل الرسالة بنفس المحتوى محلياً بدلاً من طلب يرفضه
+    Telegram بخطأ 'message is not modified'. يحفظ بصمة 16 بايت فقط لكل رسالة
+    مع حد أقصى للعدد (LRU). كل الدوال تُستدعى من الـ event loop الخاص بالبوت.
+    """
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, bytes]' = OrderedDict()
+
+        self.skipped = 0
+        self.edited = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        digest = self._entries.get(key)
+        if digest is not None:
+            self._entries.move_to_end(key)
+        return digest
+
+    def remember(self, key: Hashable, digest: bytes):
+        self._entries[key] = digest
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.skipped + self.edited
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'skipped': self.skipped,
+            'edited': self.edited,
+            'skip_rate': round(self.skipped / total, 4) if total else 0.0
+        }
@@ -1,37 +1,51 @@
 import logging
 import asyncio
-from typing import Optional, Dict, Any
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from src.models.deal import Deal
 from src.models.telegram_user import TelegramUser
+from src.services.callback_codec import encode_callback
+from src.services.rate_limiter import BULK_PRIORITY
 
 logger = logging.getLogger(__name__)
 
+# عدد رسائل البث الجارية في نفس الوقت (المعدل الفعلي يحدده محدد المعدل)
+BROADCAST_CONCURRENCY = 30
+
+@dataclass(frozen=True)
+class Notification:
+    """رسالة إشعار جاهزة للإرسال"""
+    chat_id: int
+    text: str
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+
 class NotificationService:
-    """خدمة إرسال الإشعارات للمستخدمين"""
+    """خدمة إرسال الإشعارات للمستخدمين
+
+    دوال render_* تبني رسائل الإشعار فقط، فتستخدمها notify_* للإرسال المباشر
+    وصندوق الصادر (services.outbox) لكتابتها مع تحديث الصفقة.
+    """
     
     def __init__(self, bot_instance=None):
         self.bot_instance = bot_instance
     
-    async def notify_payment_confirmed(self, deal: Deal):
-        """إشعار تأكيد الدفع"""
-        try:
-            # إشعار البائع
-            await self.notify_seller_payment_received(deal)
-            
-            # إشعار المشتري
-            await self.notify_buyer_payment_confirmed(deal)
-            
-        except Exception as e:
-            logger.error(f"Error sending payment confirmation notifications: {e}")
+    async def send(self, notifications: List[Notification]):
+        """إرسال رسائل جاهزة مباشرة"""
+        if not self.bot_instance:
+            return
+        
+        for notification in notifications:
+            await self.bot_instance.application.bot.send_message(
+                chat_id=notification.chat_id,
+                text=notification.text,
+                reply_markup=notification.reply_markup
+            )
     
-    async def notify_seller_payment_received(self, deal: Deal):
+    @staticmethod
+    def render_seller_payment_received(deal: Deal) -> List[Notification]:
         """إشعار البائع باستلام الدفع"""
-        try:
-            if not self.bot_instance:
-                return
-            
-            seller_text = f"""
+        seller_text = f"""
 💰 تم استلام الدفع!
 
 📦 الصفقة: {deal.title}
@@ -42,31 +56,22 @@ class NotificationService:
 قم بإرسال المنتج/الخدمة للمشتري، ثم اضغط "تأكيد الإرسال" لإشعار المشتري.
 
 🔒 الأموال محفوظة بأمان حتى تأكيد المشتري للاستلام.
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("✅ تأكيد الإرسال", callback_data=f"confirm_delivery_{deal.id}")],
-                [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=f"view_deal_{deal.id}")],
-                [InlineKeyboardButton("💬 التواصل مع المشتري", url=f"tg://user?id={deal.buyer_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.seller_id,
-                text=seller_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying seller of payment: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("✅ تأكيد الإرسال", callback_data=encode_callback("confirm_delivery", deal.id))],
+            [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=encode_callback("view_deal", deal.id))],
+            [InlineKeyboardButton("💬 التواصل مع المشتري", url=f"tg://user?id={deal.buyer_id}")]
+        ]
+        return [Notification(deal.seller_id, seller_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_buyer_payment_confirmed(self, deal: Deal):
+    @staticmethod
+    def render_buyer_payment_confirmed(deal: Deal) -> List[Notification]:
         """إشعار المشتري بتأكيد الدفع"""
-        try:
-            if not self.bot_instance:
-                return
-            
-            buyer_text = f"""
+        if not deal.buyer_id:
+            return []
+        
+        buyer_text = f"""
 ✅ تم تأكيد دفعتك!
 
 📦 الصفقة: {deal.title}
@@ -77,31 +82,22 @@ class NotificationService:
 البائع سيقوم بإرسال المنتج/الخدمة قريباً. ستحصل على إشعار عندما يؤكد البائع الإرسال.
 
 🔒 أموالك محمية ولن يتم تحريرها إلا بعد تأكيدك للاستلام.
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=f"view_deal_{deal.id}")],
-                [InlineKeyboardButton("💬 التواصل مع البائع", url=f"tg://user?id={deal.seller_id}")],
-                [InlineKeyboardButton("⚠️ فتح نزاع", callback_data=f"dispute_{deal.id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.buyer_id,
-                text=buyer_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying buyer of payment confirmation: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=encode_callback("view_deal", deal.id))],
+            [InlineKeyboardButton("💬 التواصل مع البائع", url=f"tg://user?id={deal.seller_id}")],
+            [InlineKeyboardButton("⚠️ فتح نزاع", callback_data=encode_callback("dispute", deal.id))]
+        ]
+        return [Notification(deal.buyer_id, buyer_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_payment_failed(self, deal: Deal):
+    @staticmethod
+    def render_payment_failed(deal: Deal) -> List[Notification]:
         """إشعار فشل الدفع"""
-        try:
-            if not self.bot_instance or not deal.buyer_id:
-                return
-            
-            failed_text = f"""
+        if not deal.buyer_id:
+            return []
+        
+        failed_text = f"""
 ❌ فشل في الدفع
 
 📦 الصفقة: {deal.title}
@@ -114,31 +110,22 @@ class NotificationService:
 • تأخير في الشبكة
 
 🔄 يمكنك المحاولة مرة أخرى أو التواصل مع الدعم.
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 إعادة المحاولة", callback_data=f"buy_deal_{deal.id}")],
-                [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=f"view_deal_{deal.id}")],
-                [InlineKeyboardButton("💬 الدعم الفني", url="https://t.me/your_support_bot")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.buyer_id,
-                text=failed_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying payment failure: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("🔄 إعادة المحاولة", callback_data=encode_callback("buy_deal", deal.id))],
+            [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=encode_callback("view_deal", deal.id))],
+            [InlineKeyboardButton("💬 الدعم الفني", url="https://t.me/your_support_bot")]
+        ]
+        return [Notification(deal.buyer_id, failed_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_payment_reminder(self, deal: Deal):
+    @staticmethod
+    def render_payment_reminder(deal: Deal) -> List[Notification]:
         """تذكير بالدفع"""
-        try:
-            if not self.bot_instance or not deal.buyer_id:
-                return
-            
-            reminder_text = f"""
+        if not deal.buyer_id:
+            return []
+        
+        reminder_text = f"""
 ⏰ تذكير بالدفع
 
 📦 الصفقة: {deal.title}
@@ -147,31 +134,22 @@ class NotificationService:
 ⚠️ لم يتم تأكيد دفعتك بعد. إذا كنت قد دفعت بالفعل، قد تحتاج لبعض الوقت للتأكيد.
 
 🔄 إذا لم تدفع بعد، يرجى إتمام الدفع قريباً لتجنب إلغاء الصفقة.
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("💳 إتمام الدفع", callback_data=f"buy_deal_{deal.id}")],
-                [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=f"view_deal_{deal.id}")],
-                [InlineKeyboardButton("❌ إلغاء الصفقة", callback_data=f"cancel_deal_{deal.id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.buyer_id,
-                text=reminder_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error sending payment reminder: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("💳 إتمام الدفع", callback_data=encode_callback("buy_deal", deal.id))],
+            [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=encode_callback("view_deal", deal.id))],
+            [InlineKeyboardButton("❌ إلغاء الصفقة", callback_data=f"cancel_deal_{deal.id}")]
+        ]
+        return [Notification(deal.buyer_id, reminder_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_delivery_confirmed(self, deal: Deal):
+    @staticmethod
+    def render_delivery_confirmed(deal: Deal) -> List[Notification]:
         """إشعار تأكيد الإرسال"""
-        try:
-            if not self.bot_instance or not deal.buyer_id:
-                return
-            
-            delivery_text = f"""
+        if not deal.buyer_id:
+            return []
+        
+        delivery_text = f"""
 📦 تم إرسال طلبك!
 
 📦 الصفقة: {deal.title}
@@ -182,43 +160,19 @@ class NotificationService:
 بعد استلام المنتج/الخدمة والتأكد من جودتها، اضغط "تحرير الأموال" لإتمام الصفقة.
 
 ⚠️ إذا لم تستلم شيئاً أو كان هناك مشكلة، يمكنك فتح نزاع.
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("✅ تحرير الأموال", callback_data=f"release_funds_{deal.id}")],
-                [InlineKeyboardButton("⚠️ فتح نزاع", callback_data=f"dispute_{deal.id}")],
-                [InlineKeyboardButton("💬 التواصل مع البائع", url=f"tg://user?id={deal.seller_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.buyer_id,
-                text=delivery_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying delivery confirmation: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("✅ تحرير الأموال", callback_data=encode_callback("release_funds", deal.id))],
+            [InlineKeyboardButton("⚠️ فتح نزاع", callback_data=encode_callback("dispute", deal.id))],
+            [InlineKeyboardButton("💬 التواصل مع البائع", url=f"tg://user?id={deal.seller_id}")]
+        ]
+        return [Notification(deal.buyer_id, delivery_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_funds_released(self, deal: Deal):
-        """إشعار تحرير الأموال"""
-        try:
-            # إشعار البائع
-            await self.notify_seller_funds_released(deal)
-            
-            # إشعار المشتري
-            await self.notify_buyer_transaction_completed(deal)
-            
-        except Exception as e:
-            logger.error(f"Error sending funds release notifications: {e}")
-    
-    async def notify_seller_funds_released(self, deal: Deal):
+    @staticmethod
+    def render_seller_funds_released(deal: Deal) -> List[Notification]:
         """إشعار البائع بتحرير الأموال"""
-        try:
-            if not self.bot_instance:
-                return
-            
-            seller_text = f"""
+        seller_text = f"""
 🎉 تم إتمام الصفقة بنجاح!
 
 📦 الصفقة: {deal.title}
@@ -228,31 +182,22 @@ class NotificationService:
 ✅ تم تحرير الأموال وستصلك قريباً في محفظتك.
 
 ⭐ شكراً لاستخدام خدمة الوساطة الآمنة!
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("📊 إحصائياتي", callback_data="my_stats")],
-                [InlineKeyboardButton("💰 إنشاء صفقة جديدة", callback_data="create_deal")],
-                [InlineKeyboardButton("⭐ تقييم المشتري", callback_data=f"rate_user_{deal.buyer_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.seller_id,
-                text=seller_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying seller of funds release: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("📊 إحصائياتي", callback_data="my_stats")],
+            [InlineKeyboardButton("💰 إنشاء صفقة جديدة", callback_data="create_deal")],
+            [InlineKeyboardButton("⭐ تقييم المشتري", callback_data=f"rate_user_{deal.buyer_id}")]
+        ]
+        return [Notification(deal.seller_id, seller_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_buyer_transaction_completed(self, deal: Deal):
+    @staticmethod
+    def render_buyer_transaction_completed(deal: Deal) -> List[Notification]:
         """إشعار المشتري بإتمام المعاملة"""
-        try:
-            if not self.bot_instance:
-                return
-            
-            buyer_text = f"""
+        if not deal.buyer_id:
+            return []
+        
+        buyer_text = f"""
 🎉 تم إتمام الصفقة بنجاح!
 
 📦 الصفقة: {deal.title}
@@ -261,56 +206,149 @@ class NotificationService:
 ✅ تم تحرير الأموال للبائع وإتمام المعاملة بنجاح.
 
 ⭐ شكراً لاستخدام خدمة الوساطة الآمنة!
-            """
-            
-            keyboard = [
-                [InlineKeyboardButton("📊 إحصائياتي", callback_data="my_stats")],
-                [InlineKeyboardButton("🛒 تصفح الصفقات", callback_data="browse_deals")],
-                [InlineKeyboardButton("⭐ تقييم البائع", callback_data=f"rate_user_{deal.seller_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await self.bot_instance.application.bot.send_message(
-                chat_id=deal.buyer_id,
-                text=buyer_text,
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            logger.error(f"Error notifying buyer of transaction completion: {e}")
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("📊 إحصائياتي", callback_data="my_stats")],
+            [InlineKeyboardButton("🛒 تصفح الصفقات", callback_data="browse_deals")],
+            [InlineKeyboardButton("⭐ تقييم البائع", callback_data=f"rate_user_{deal.seller_id}")]
+        ]
+        return [Notification(deal.buyer_id, buyer_text, InlineKeyboardMarkup(keyboard))]
     
-    async def notify_dispute_created(self, deal: Deal, dispute_reason: str):
-        """إشعار إنشاء نزاع"""
-        try:
-            # إشعار الطرف الآخر
-            if deal.buyer_id:  # إذا كان هناك مشتري
-                other_party = deal.seller_id if deal.buyer_id else deal.buyer_id
-                
-                dispute_text = f"""
+    @staticmethod
+    def render_dispute_created(deal: Deal, reporter_id: Optional[int] = None,
+                               reason: Optional[str] = None) -> List[Notification]:
+        """إشعار الطرف الآخر بفتح نزاع"""
+        if not deal.buyer_id:
+            return []
+        other_party = deal.buyer_id if reporter_id == deal.seller_id else deal.seller_id
+        
+        dispute_text = f"""
 ⚠️ تم فتح نزاع
 
 📦 الصفقة: {deal.title}
 💳 المبلغ: ${deal.total_price:.2f}
-📝 السبب: {dispute_reason}
+📝 السبب: {reason or 'غير محدد'}
 
 🔒 تم تجميد الأموال حتى حل النزاع.
 سيتم التواصل معك قريباً من فريق الدعم.
 
 💬 يمكنك التواصل مع الطرف الآخر لحل المشكلة ودياً.
-                """
-                
-                keyboard = [
-                    [InlineKeyboardButton("📋 تفاصيل النزاع", callback_data=f"view_dispute_{deal.id}")],
-                    [InlineKeyboardButton("💬 التواصل مع الدعم", url="https://t.me/your_support_bot")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await self.bot_instance.application.bot.send_message(
-                    chat_id=other_party,
-                    text=dispute_text,
-                    reply_markup=reply_markup
-                )
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("📋 تفاصيل النزاع", callback_data=f"view_dispute_{deal.id}")],
+            [InlineKeyboardButton("💬 التواصل مع الدعم", url="https://t.me/your_support_bot")]
+        ]
+        return [Notification(other_party, dispute_text, InlineKeyboardMarkup(keyboard))]
+    
+    @staticmethod
+    def render_dispute_resolved(deal: Deal, resolution: Optional[str] = None) -> List[Notification]:
+        """إشعار طرفي الصفقة بحل النزاع"""
+        status_text = {
+            'refunded': 'تمت إعادة الأموال للمشتري',
+            'completed': 'تم تحرير الأموال للبائع',
+            'cancelled': 'تم إلغاء الصفقة'
+        }.get(deal.status, deal.status)
+        
+        resolved_text = f"""
+⚖️ تم حل النزاع
+
+📦 الصفقة: {deal.title}
+💳 المبلغ: ${deal.total_price:.2f}
+🔄 النتيجة: {status_text}
+📝 القرار: {resolution or '-'}
+
+💬 للاستفسار، تواصل مع فريق الدعم.
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("📋 تفاصيل الصفقة", callback_data=encode_callback("view_deal", deal.id))],
+            [InlineKeyboardButton("💬 التواصل مع الدعم", url="https://t.me/your_support_bot")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        return [
+            Notification(user_id, resolved_text, reply_markup)
+            for user_id in (deal.seller_id, deal.buyer_id) if user_id
+        ]
+    
+    async def notify_payment_confirmed(self, deal: Deal):
+        """إشعار تأكيد الدفع"""
+        try:
+            # إشعار البائع
+            await self.notify_seller_payment_received(deal)
+            
+            # إشعار المشتري
+            await self.notify_buyer_payment_confirmed(deal)
+            
+        except Exception as e:
+            logger.error(f"Error sending payment confirmation notifications: {e}")
+    
+    async def notify_seller_payment_received(self, deal: Deal):
+        """إشعار البائع باستلام الدفع"""
+        try:
+            await self.send(self.render_seller_payment_received(deal))
+        except Exception as e:
+            logger.error(f"Error notifying seller of payment: {e}")
+    
+    async def notify_buyer_payment_confirmed(self, deal: Deal):
+        """إشعار المشتري بتأكيد الدفع"""
+        try:
+            await self.send(self.render_buyer_payment_confirmed(deal))
+        except Exception as e:
+            logger.error(f"Error notifying buyer of payment confirmation: {e}")
+    
+    async def notify_payment_failed(self, deal: Deal):
+        """إشعار فشل الدفع"""
+        try:
+            await self.send(self.render_payment_failed(deal))
+        except Exception as e:
+            logger.error(f"Error notifying payment failure: {e}")
+    
+    async def notify_payment_reminder(self, deal: Deal):
+        """تذكير بالدفع"""
+        try:
+            await self.send(self.render_payment_reminder(deal))
+        except Exception as e:
+            logger.error(f"Error sending payment reminder: {e}")
+    
+    async def notify_delivery_confirmed(self, deal: Deal):
+        """إشعار تأكيد الإرسال"""
+        try:
+            await self.send(self.render_delivery_confirmed(deal))
+        except Exception as e:
+            logger.error(f"Error notifying delivery confirmation: {e}")
+    
+    async def notify_funds_released(self, deal: Deal):
+        """إشعار تحرير الأموال"""
+        try:
+            # إشعار البائع
+            await self.notify_seller_funds_released(deal)
             
+            # إشعار المشتري
+            await self.notify_buyer_transaction_completed(deal)
+            
+        except Exception as e:
+            logger.error(f"Error sending funds release notifications: {e}")
+    
+    async def notify_seller_funds_released(self, deal: Deal):
+        """إشعار البائع بتحرير الأموال"""
+        try:
+            await self.send(self.render_seller_funds_released(deal))
+        except Exception as e:
+            logger.error(f"Error notifying seller of funds release: {e}")
+    
+    async def notify_buyer_transaction_completed(self, deal: Deal):
+        """إشعار المشتري بإتمام المعاملة"""
+        try:
+            await self.send(self.render_buyer_transaction_completed(deal))
+        except Exception as e:
+            logger.error(f"Error notifying buyer of transaction completion: {e}")
+    
+    async def notify_dispute_created(self, deal: Deal, dispute_reason: str, reporter_id: Optional[int] = None):
+        """إشعار إنشاء نزاع"""
+        try:
+            await self.send(self.render_dispute_created(deal, reporter_id, dispute_reason))
         except Exception as e:
             logger.error(f"Error notifying dispute creation: {e}")
     
@@ -332,23 +370,36 @@ class NotificationService:
     
     async def broadcast_message(self, user_ids: list, message: str, 
                               keyboard: Optional[InlineKeyboardMarkup] = None):
-        """إرسال رسالة جماعية"""
+        """إرسال رسالة جماعية
+
+        الإرسال متوازٍ ومحدد المعدل بواسطة PriorityRateLimiter الخاص بالبوت،
+        وبأولوية أقل من الإشعارات الفورية.
+        """
         try:
             if not self.bot_instance:
-                return
-            
-            for user_id in user_ids:
-                try:
-                    await self.bot_instance.application.bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        reply_markup=keyboard
-                    )
-                    # تأخير قصير لتجنب حدود التليجرام
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Error sending broadcast to user {user_id}: {e}")
+                return {'success': False, 'error': 'Bot is not available'}
+            
+            bot = self.bot_instance.application.bot
+            semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+            
+            async def send(user_id):
+                async with semaphore:
+                    try:
+                        await bot.send_message(
+                            chat_id=user_id,
+                            text=message,
+                            reply_markup=keyboard,
+                            rate_limit_args=BULK_PRIORITY
+                        )
+                        return True
+                    except Exception as e:
+                        logger.error(f"Error sending broadcast to user {user_id}: {e}")
+                        return False
+            
+            results = await asyncio.gather(*[send(user_id) for user_id in user_ids])
+            sent = sum(results)
+            return {'success': True, 'sent': sent, 'failed': len(results) - sent}
             
         except Exception as e:
             logger.error(f"Error in broadcast: {e}")
-
+            return {'success': False, 'error': str(e)}
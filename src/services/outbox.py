@@ -0,0 +1,225 @@
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy.dialects import sqlite, postgresql
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from src.models.deal import Deal, db
+from src.models.notification_outbox import NotificationOutbox
+from src.services.notification import NotificationService
+
+logger = logging.getLogger(__name__)
+
+# أنواع الإشعارات ودوال بناء رسائلها
+NOTIFICATION_RENDERERS = {
+    'seller_payment_received': NotificationService.render_seller_payment_received,
+    'buyer_payment_confirmed': NotificationService.render_buyer_payment_confirmed,
+    'payment_failed': NotificationService.render_payment_failed,
+    'payment_reminder': NotificationService.render_payment_reminder,
+    'delivery_confirmed': NotificationService.render_delivery_confirmed,
+    'seller_funds_released': NotificationService.render_seller_funds_released,
+    'buyer_transaction_completed': NotificationService.render_buyer_transaction_completed,
+    'dispute_created': NotificationService.render_dispute_created,
+    'dispute_resolved': NotificationService.render_dispute_resolved
+}
+
+# إشعارات تأكيد الدفع (من المراقب أو webhook)
+PAYMENT_CONFIRMED = ('seller_payment_received', 'buyer_payment_confirmed')
+
+@dataclass(frozen=True)
+class OutboxEntry:
+    """إشعار معلق من صندوق الصادر"""
+    id: int
+    chat_id: int
+    text: str
+    reply_markup: Optional[str]
+    attempts: int
+
+    @classmethod
+    def from_model(cls, entry: NotificationOutbox) -> 'OutboxEntry':
+        return cls(
+            id=entry.id,
+            chat_id=entry.chat_id,
+            text=entry.text,
+            reply_markup=entry.reply_markup,
+            attempts=entry.attempts or 0
+        )
+
+def _insert():
+    """جملة INSERT تتجاهل الإشعارات المكررة حسب نوع قاعدة البيانات"""
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    return insert(NotificationOutbox.__table__).on_conflict_do_nothing(index_elements=['dedupe_key'])
+
+def enqueue_notification(deal: Deal, *kinds: str, key: Optional[str] = None, **params) -> int:
+    """كتابة إشعارات الصفقة في صندوق الصادر داخل المعاملة الحالية (بدون commit)
+
+    الإشعار يُكتب مع تغيير حالة الصفقة أو لا يُكتب أبداً. مفتاح منع التكرار
+    kind:key:chat_id (key افتراضياً رقم الصفقة)، فإعادة معالجة نفس الحدث لا
+    تكرر الإرسال. يرجع عدد الإشعارات الجديدة.
+    """
+    now = datetime.utcnow()
+    rows = []
+    for kind in kinds:
+        for notification in NOTIFICATION_RENDERERS[kind](deal, **params):
+            rows.append({
+                'dedupe_key': f"{kind}:{key or deal.id}:{notification.chat_id}",
+                'kind': kind,
+                'deal_id': deal.id,
+                'chat_id': notification.chat_id,
+                'text': notification.text,
+                'reply_markup': notification.reply_markup.to_json() if notification.reply_markup else None,
+                'status': 'pending',
+                'attempts': 0,
+                'next_attempt_at': now,
+                'created_at': now
+            })
+
+    if not rows:
+        return 0
+    return db.session.execute(_insert().values(rows)).rowcount
+
+class NotificationDispatcher:
+    """إرسال إشعارات صندوق الصادر في الخلفية
+
+    يسحب الإشعارات المستحقة على دفعات ويرسلها بشكل متوازٍ عبر البوت (وبالتالي
+    عبر محدد المعدل بأولوية عادية)، ثم يحفظ نتائج الدفعة في commit واحد.
+    الأخطاء المؤقتة تُعاد مع تأخير متزايد حتى max_attempts، والمستخدم الذي حظر
+    البوت لا يُعاد له الإرسال. التسليم at-least-once: انقطاع بين الإرسال
+    وحفظ النتيجة قد يعيد إرسال رسالة واحدة.
+    """
+
+    def __init__(self, bot, repository, batch_size: int = 100, concurrency: int = 20,
+                 poll_interval: float = 1.0, max_attempts: int = 5, retry_delay: float = 5.0,
+                 retention_days: int = 7):
+        self.bot = bot
+        self.repository = repository
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention_days = retention_days
+
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._last_purge = 0.0
+
+        self.sent_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+        self.batches_count = 0
+        self.errors_count = 0
+        self.last_batch_size = 0
+        self.last_batch_at = None
+
+    def start(self):
+        """بدء الإرسال على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """تنبيه المرسل بوجود إشعارات جديدة (آمن من أي thread)"""
+        if self._loop and self._wakeup and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try:
+                dispatched = await self.dispatch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error dispatching notifications: {e}")
+                self.errors_count += 1
+                dispatched = 0
+
+            if time.monotonic() - self._last_purge > 3600:
+                self._last_purge = time.monotonic()
+                try:
+                    await self.repository.purge_notifications(
+                        datetime.utcnow() - timedelta(days=self.retention_days)
+                    )
+                except Exception as e:
+                    logger.error(f"Error purging sent notifications: {e}")
+
+            # الاستمرار مباشرة إذا كانت الدفعة ممتلئة
+            if dispatched < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def dispatch_once(self) -> int:
+        """إرسال دفعة واحدة من الإشعارات المستحقة وإرجاع عددها"""
+        entries = await self.repository.get_due_notifications(self.batch_size)
+        if not entries:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(entry: OutboxEntry):
+            async with semaphore:
+                return entry.id, await self._send(entry)
+
+        results = dict(await asyncio.gather(*[send(entry) for entry in entries]))
+        await self.repository.save_notification_results(results)
+
+        for status, _, _ in results.values():
+            if status == 'sent':
+                self.sent_count += 1
+            elif status == 'failed':
+                self.failed_count += 1
+            else:
+                self.retried_count += 1
+        self.batches_count += 1
+        self.last_batch_size = len(entries)
+        self.last_batch_at = datetime.utcnow()
+        return len(entries)
+
+    async def _send(self, entry: OutboxEntry) -> Tuple[str, Optional[str], Optional[datetime]]:
+        """(status, error, next_attempt_at) لإشعار واحد"""
+        try:
+            reply_markup = InlineKeyboardMarkup.de_json(json.loads(entry.reply_markup), self.bot) \
+                if entry.reply_markup else None
+            await self.bot.send_message(chat_id=entry.chat_id, text=entry.text, reply_markup=reply_markup)
+            return 'sent', None, None
+        except (Forbidden, BadRequest) as e:
+            # لن تنجح إعادة المحاولة
+            return 'failed', str(e), None
+        except Exception as e:
+            attempts = entry.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"Giving up on notification {entry.id} after {attempts} attempts: {e}")
+                return 'failed', str(e), None
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            return 'pending', str(e), datetime.utcnow() + timedelta(seconds=delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'is_running': bool(self._task and not self._task.done()),
+            'sent_count': self.sent_count,
+            'failed_count': self.failed_count,
+            'retried_count': self.retried_count,
+            'batches_count': self.batches_count,
+            'errors_count': self.errors_count,
+            'last_batch_size': self.last_batch_size,
+            'last_batch_at': self.last_batch_at.isoformat() if self.last_batch_at else None
+        }
@@ -0,0 +1,228 @@
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Any, Iterable, Optional, Tuple
+from sqlalchemy.dialects import sqlite, postgresql
+from src.models.deal import Deal, db
+from src.models.payment_event import PaymentEvent
+from src.models.deposit_address import DepositAddress
+from src.models.dispute import SecurityLog
+from src.services.ccpayment import deposit_record_cache
+from src.services.outbox import PAYMENT_CONFIRMED, enqueue_notification
+
+logger = logging.getLogger(__name__)
+
+def get_payment_order_id(deal: Deal) -> str:
+    """رقم الطلب لدى CCPayment: رقم عنوان المجمع إن وُجد، وإلا رقم الصفقة"""
+    if deal.payment_id:
+        try:
+            return json.loads(deal.payment_id).get('order_id') or deal.id
+        except (ValueError, AttributeError):
+            pass
+    return deal.id
+
+def load_deals_by_order_ids(order_ids: Iterable[str]) -> Dict[str, Deal]:
+    """تحميل الصفقات حسب أرقام طلبات CCPayment (رقم الصفقة أو رقم عنوان المجمع)"""
+    order_ids = set(order_ids)
+    if not order_ids:
+        return {}
+
+    deals = {deal.id: deal for deal in Deal.query.filter(Deal.id.in_(order_ids)).all()}
+
+    pool_refs = order_ids - deals.keys()
+    if pool_refs:
+        rows = db.session.query(DepositAddress.order_ref, Deal).join(
+            Deal, Deal.id == DepositAddress.deal_id
+        ).filter(DepositAddress.order_ref.in_(pool_refs)).all()
+        deals.update({order_ref: deal for order_ref, deal in rows})
+
+    return deals
+
+# هامش مقارنة المبلغ المستلم بالمطلوب (فروق التقريب)
+AMOUNT_TOLERANCE = 0.01
+
+def get_expected_payment(deal: Deal, order_id: Optional[str]) -> Tuple[float, Optional[str]]:
+    """المبلغ والعملة المتوقعان لطلب الدفع
+
+    عناوين المجمع تُنشأ لدى CCPayment بدون مبلغ، فالمبلغ المحفوظ عند ربط العنوان
+    هو المرجع. بدون ربط يكون المرجع سعر الصفقة وعملة معلومات الدفع.
+    """
+    binding = DepositAddress.query.filter_by(order_ref=order_id, deal_id=deal.id).first() if order_id else None
+    if binding:
+        amount = binding.expected_amount if binding.expected_amount is not None else deal.total_price
+        return amount, binding.coin_type
+
+    coin_type = None
+    if deal.payment_id:
+        try:
+            coin_type = json.loads(deal.payment_id).get('coin_type')
+        except (ValueError, AttributeError):
+            pass
+    return deal.total_price, coin_type
+
+def get_payment_mismatch(deal: Deal, event: Dict[str, Any]) -> Optional[str]:
+    """سبب عدم مطابقة الدفع للمبلغ والعملة المتوقعين، أو None إذا كان مطابقاً"""
+    expected_amount, expected_coin = get_expected_payment(deal, event.get('orderId'))
+
+    try:
+        received = float(event.get('amount'))
+    except (TypeError, ValueError):
+        return f"missing amount (expected {expected_amount})"
+    if received + AMOUNT_TOLERANCE < expected_amount:
+        return f"received {received} of {expected_amount}"
+
+    coin = event.get('coinSymbol')
+    if coin and expected_coin and coin.upper() != expected_coin.upper():
+        return f"received {coin} instead of {expected_coin}"
+    return None
+
+def apply_payment_event(deal: Deal, event: Dict[str, Any]) -> Optional[str]:
+    """تطبيق حدث دفع على الصفقة، وإرجاع الحالة الجديدة (paid أو underpaid) إذا تغيرت"""
+    status = event.get('status')
+
+    if status == 'success' and deal.status == 'pending':
+        mismatch = get_payment_mismatch(deal, event)
+        deal.status = 'underpaid' if mismatch else 'paid'
+
+        # تحديث معلومات المعاملة
+        if deal.payment_id:
+            try:
+                payment_info = json.loads(deal.payment_id)
+                payment_info['tx_id'] = event.get('txId')
+                payment_info['confirmed_amount'] = event.get('amount')
+                payment_info['confirmation_time'] = datetime.utcnow().isoformat()
+                deal.payment_id = json.dumps(payment_info)
+            except:
+                pass
+
+        if mismatch:
+            # لا تأكيد ولا إشعارات: الصفقة تنتظر مراجعة الدعم
+            db.session.add(SecurityLog(
+                user_id=deal.buyer_id or deal.seller_id,
+                event_type='payment_underpaid',
+                severity='warning',
+                description=f"Payment for deal {deal.id} does not match: {mismatch}",
+                additional_data=json.dumps({
+                    'deal_id': deal.id,
+                    'order_id': event.get('orderId'),
+                    'tx_id': event.get('txId'),
+                    'amount': event.get('amount'),
+                    'coin': event.get('coinSymbol')
+                })
+            ))
+            logger.warning(f"Underpaid payment for deal {deal.id}: {mismatch}")
+            return 'underpaid'
+
+        logger.info(f"Payment confirmed for deal {deal.id}")
+        return 'paid'
+
+    if status == 'failed':
+        logger.info(f"Payment failed for deal {deal.id}")
+
+    return None
+
+def confirm_payment(deal: Deal, event: Dict[str, Any], source: str) -> str:
+    """تسجيل حدث دفع وتطبيقه على الصفقة داخل المعاملة الحالية (بدون commit)
+
+    المسار المشترك لـ webhook ومراقب المدفوعات و/payments/status، فتنتهي الصفقة
+    بنفس الحالة أياً كان المسار الذي أكد الدفع. يرجع duplicate إذا كان الحدث
+    مسجلاً من قبل، وconfirmed إذا تأكد الدفع الآن، وunderpaid إذا لم يطابق المبلغ
+    أو العملة المتوقعين، وإلا recorded.
+    """
+    # الفهرس الفريد على (orderId, txId, status) يرفض الأحداث المكررة
+    if not PaymentEventStore().record(event, source=source):
+        return 'duplicate'
+
+    # فحوصات الحالة التالية يجب أن ترى الحالة الجديدة
+    deposit_record_cache.invalidate(event.get('orderId'))
+    new_status = apply_payment_event(deal, event)
+    if new_status == 'underpaid':
+        return 'underpaid'
+    if not new_status:
+        return 'recorded'
+
+    # الإشعارات تُكتب مع تأكيد الدفع في نفس المعاملة
+    enqueue_notification(deal, *PAYMENT_CONFIRMED)
+    return 'confirmed'
+
+class PaymentEventStore:
+    """مخزن أحداث الدفع: رفض المكرر عبر الفهرس الفريد وإعادة التشغيل بعد الأعطال"""
+
+    def __init__(self, flask_app=None):
+        self.flask_app = flask_app
+
+    def _insert(self):
+        """جملة INSERT تتجاهل التكرار حسب نوع قاعدة البيانات"""
+        dialect = db.session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        return insert(PaymentEvent.__table__).on_conflict_do_nothing(
+            index_elements=['order_id', 'tx_id', 'status']
+        )
+
+    def record(self, event: Dict[str, Any], source: str = 'webhook') -> bool:
+        """إضافة حدث داخل المعاملة الحالية، وإرجاع False إذا كان مكرراً"""
+        result = db.session.execute(self._insert().values(
+            order_id=event.get('orderId'),
+            tx_id=event.get('txId') or '',
+            status=event.get('status') or '',
+            amount=str(event['amount']) if event.get('amount') is not None else None,
+            source=source,
+            payload=json.dumps(event),
+            created_at=datetime.utcnow()
+        ))
+        return result.rowcount == 1
+
+    def replay(self, order_id: Optional[str] = None, since: Optional[datetime] = None,
+               batch_size: int = 1000) -> Dict[str, Any]:
+        """إعادة تطبيق الأحداث المخزنة لإعادة بناء حالة الدفع للصفقات"""
+        stats = {
+            'events': 0,
+            'confirmed': 0,
+            'missing_deals': 0,
+            'batches': 0,
+            'elapsed': 0.0
+        }
+        started = time.monotonic()
+
+        with self.flask_app.app_context():
+            last_id = 0
+
+            while True:
+                # ترقيم حسب المعرف (keyset) بدلاً من OFFSET
+                query = PaymentEvent.query.filter(PaymentEvent.id > last_id)
+                if order_id:
+                    query = query.filter(PaymentEvent.order_id == order_id)
+                if since:
+                    query = query.filter(PaymentEvent.created_at >= since)
+                events = query.order_by(PaymentEvent.id).limit(batch_size).all()
+
+                if not events:
+                    break
+
+                deals = load_deals_by_order_ids(event.order_id for event in events)
+
+                for event in events:
+                    stats['events'] += 1
+                    deal = deals.get(event.order_id)
+                    if not deal:
+                        stats['missing_deals'] += 1
+                        continue
+
+                    payload = json.loads(event.payload) if event.payload else {}
+                    if apply_payment_event(deal, {
+                        'orderId': event.order_id,
+                        'status': event.status,
+                        'txId': event.tx_id or None,
+                        'amount': event.amount,
+                        'coinSymbol': payload.get('coinSymbol')
+                    }) == 'paid':
+                        stats['confirmed'] += 1
+
+                db.session.commit()
+                stats['batches'] += 1
+                last_id = events[-1].id
+
+        stats['elapsed'] = round(time.monotonic() - started, 3)
+        logger.info(f"Replayed {stats['events']} payment events, {stats['confirmed']} deals confirmed")
+        return stats
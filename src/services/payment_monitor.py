@@ -5,8 +5,10 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Any
 import json
 from src.models.deal import Deal, db
-from src.services.ccpayment import get_ccpayment_service
-from src.services.notification import NotificationService
+from src.services.ccpayment import get_async_ccpayment_service
+from src.services.payment_scheduler import PaymentScheduler
+from src.services.payment_events import confirm_payment, get_payment_order_id
+from src.services.outbox import enqueue_notification
 
 logger = logging.getLogger(__name__)
 
@@ -16,16 +18,26 @@ class PaymentMonitor:
     def __init__(self, flask_app, bot_instance=None):
         self.flask_app = flask_app
         self.bot_instance = bot_instance
-        self.notification_service = NotificationService(bot_instance)
         self.ccpayment = None
         self.is_running = False
-        self.check_interval = 30  # ثانية
+        self.check_interval = 30  # ثانية - فترة مزامنة الجدول والمهام الدورية
+        self.tick_interval = 1  # ثانية - فترة فحص الصفقات المستحقة في الجدول
+        self.max_batch_size = 500  # أقصى عدد صفقات في دورة فحص واحدة
+        self.scheduler = PaymentScheduler()
+        self.max_concurrent_checks = 20  # الحد الأقصى للفحوصات المتزامنة
+        self.check_timeout = 15  # مهلة كل استدعاء CCPayment بالثواني
+        self.last_cycle_report = None
+        self.reconcile_interval = 900  # ثانية - فترة مطابقة الصفقات مع CCPayment
+        self.reconcile_window_days = 7  # عمر الصفقات التي تشملها المطابقة
+        self.last_reconcile_report = None
         
     def initialize_ccpayment(self):
         """تهيئة خدمة CCPayment"""
         try:
-            self.ccpayment = get_ccpayment_service()
-            logger.info("CCPayment service initialized successfully")
+            service = get_async_ccpayment_service()
+            if service is not self.ccpayment:
+                self.ccpayment = service
+                logger.info("CCPayment service initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize CCPayment service: {e}")
             self.ccpayment = None
@@ -42,14 +54,31 @@ class PaymentMonitor:
         # تهيئة CCPayment
         self.initialize_ccpayment()
         
+        last_sync = None
+        last_reconcile = time.monotonic()
+        
         while self.is_running:
             try:
+                # المزامنة والمهام الدورية كل check_interval
+                now = time.monotonic()
+                if last_sync is None or now - last_sync >= self.check_interval:
+                    last_sync = now
+                    # التقاط أي إعادة تحميل لبيانات اعتماد CCPayment
+                    self.initialize_ccpayment()
+                    await self.sync_pending_deals()
+                    await self.check_expired_payments()
+                    await self.cleanup_old_records()
+                
+                # فحص الصفقات التي حان موعدها فقط
                 await self.check_pending_payments()
-                await self.check_expired_payments()
-                await self.cleanup_old_records()
+                
+                # مطابقة دورية مع سجلات CCPayment
+                if now - last_reconcile >= self.reconcile_interval:
+                    last_reconcile = now
+                    await self.reconcile_payments()
                 
                 # انتظار قبل الفحص التالي
-                await asyncio.sleep(self.check_interval)
+                await asyncio.sleep(self.tick_interval)
                 
             except Exception as e:
                 logger.error(f"Error in payment monitoring loop: {e}")
@@ -60,70 +89,235 @@ class PaymentMonitor:
         self.is_running = False
         logger.info("Payment monitoring service stopped")
     
-    async def check_pending_payments(self):
-        """فحص المدفوعات المعلقة"""
+    async def sync_pending_deals(self):
+        """مزامنة جدول الفحص مع الصفقات المعلقة في قاعدة البيانات"""
+        try:
+            with self.flask_app.app_context():
+                rows = db.session.query(Deal.id, Deal.created_at).filter(
+                    Deal.status == 'pending',
+                    Deal.payment_id.isnot(None)
+                ).all()
+                self.scheduler.sync(rows)
+                
+        except Exception as e:
+            logger.error(f"Error syncing pending deals: {e}")
+    
+    def prioritize(self, deal_id: str, created_at: datetime = None):
+        """تقديم صفقة إلى بداية طابور الفحص"""
+        self.scheduler.prioritize(deal_id, created_at)
+    
+    async def check_pending_payments(self) -> Dict[str, Any]:
+        """فحص المدفوعات المعلقة المستحقة بشكل متزامن مع حد أقصى للتوازي"""
+        report = self._new_cycle_report()
+        
         if not self.ccpayment:
-            return
+            return report
+        
+        due_ids = self.scheduler.pop_due(limit=self.max_batch_size)
+        if not due_ids:
+            return report
+        
+        started = time.monotonic()
         
         try:
             with self.flask_app.app_context():
-                # الحصول على الصفقات المعلقة التي لها معلومات دفع
+                # الحصول على الصفقات المستحقة التي ما زالت معلقة
                 pending_deals = Deal.query.filter(
+                    Deal.id.in_(due_ids),
                     Deal.status == 'pending',
                     Deal.payment_id.isnot(None)
                 ).all()
                 
+                # إزالة الصفقات التي لم تعد معلقة من الجدول
+                found_ids = {deal.id for deal in pending_deals}
+                for deal_id in due_ids:
+                    if deal_id not in found_ids:
+                        self.scheduler.remove(deal_id)
+                
+                # جلب سجلات الإيداع بالجملة، مع مهلة لكل استدعاء
+                records = await self._fetch_deal_records(pending_deals)
+                
+                # تطبيق النتائج على قاعدة البيانات بشكل تسلسلي
                 for deal in pending_deals:
-                    await self.verify_deal_payment(deal)
+                    record = records.get(deal.id, {'success': False, 'error': 'missing record'})
+                    report['checked'] += 1
+                    outcome = await self.apply_deposit_record(deal, record)
+                    report[outcome] += 1
+                    
+                    if outcome in ('confirmed', 'underpaid'):
+                        self.scheduler.remove(deal.id)
+                    else:
+                        self.scheduler.reschedule(deal.id)
                     
         except Exception as e:
             logger.error(f"Error checking pending payments: {e}")
+            # إعادة جدولة الصفقات حتى لا تضيع من الطابور
+            for deal_id in due_ids:
+                self.scheduler.reschedule(deal_id)
+        
+        report['elapsed'] = round(time.monotonic() - started, 3)
+        self.last_cycle_report = report
+        
+        if report['checked']:
+            logger.info(
+                f"Payment check cycle: {report['checked']} checked, {report['confirmed']} confirmed, "
+                f"{report['failed']} failed, {report['timed_out']} timed out in {report['elapsed']}s"
+            )
+        
+        return report
+    
+    def _new_cycle_report(self) -> Dict[str, Any]:
+        """إنشاء تقرير فارغ لدورة فحص"""
+        return {
+            'started_at': datetime.utcnow().isoformat(),
+            'checked': 0,
+            'confirmed': 0,
+            'underpaid': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'errors': 0,
+            'unchanged': 0,
+            'elapsed': 0.0
+        }
+    
+    async def _fetch_deposit_records(self, order_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """جلب سجلات إيداع عدة صفقات بحد أقصى للتوازي ومهلة لكل استدعاء"""
+        try:
+            return await self.ccpayment.get_deposit_records(
+                order_ids,
+                max_concurrency=self.max_concurrent_checks,
+                timeout=self.check_timeout
+            )
+        except Exception as e:
+            logger.error(f"Error fetching deposit records: {e}")
+            return {order_id: {'success': False, 'error': str(e)} for order_id in order_ids}
+    
+    async def _fetch_deal_records(self, deals: List[Deal]) -> Dict[str, Dict[str, Any]]:
+        """جلب سجلات الإيداع لعدة صفقات، والنتيجة حسب رقم الصفقة"""
+        order_ids = {deal.id: get_payment_order_id(deal) for deal in deals}
+        records = await self._fetch_deposit_records(list(order_ids.values()))
+        return {deal_id: records[order_id] for deal_id, order_id in order_ids.items() if order_id in records}
     
-    async def verify_deal_payment(self, deal: Deal):
+    async def verify_deal_payment(self, deal: Deal) -> str:
         """التحقق من دفع صفقة محددة"""
+        records = await self._fetch_deal_records([deal])
+        return await self.apply_deposit_record(deal, records.get(deal.id, {'success': False}))
+    
+    async def apply_deposit_record(self, deal: Deal, result: Dict[str, Any]) -> str:
+        """تطبيق سجل الإيداع على الصفقة وإرجاع نتيجة الفحص"""
         try:
-            # الحصول على معلومات الدفع
-            result = self.ccpayment.get_deposit_record(deal.id)
+            if result.get('timed_out'):
+                return 'timed_out'
+            
+            if not result['success']:
+                return 'errors'
             
-            if result['success']:
-                payment_status = result.get('status', 'unknown')
+            payment_status = result.get('status', 'unknown')
+            
+            if payment_status == 'success' and deal.status == 'pending':
+                outcome = confirm_payment(deal, {
+                    'orderId': get_payment_order_id(deal),
+                    'txId': result.get('tx_id'),
+                    'status': 'success',
+                    'amount': result.get('amount'),
+                    'coinSymbol': result.get('data', {}).get('coinSymbol')
+                }, source='monitor')
+                db.session.commit()
+                if outcome == 'underpaid':
+                    return 'underpaid'
+                if outcome != 'confirmed':
+                    return 'unchanged'
+                self._wake_notifications()
+                return 'confirmed'
                 
-                if payment_status == 'success' and deal.status == 'pending':
-                    # تحديث حالة الصفقة
-                    deal.status = 'paid'
-                    
-                    # تحديث معلومات المعاملة
-                    if deal.payment_id:
-                        try:
-                            payment_info = json.loads(deal.payment_id)
-                            payment_info['tx_id'] = result.get('tx_id')
-                            payment_info['confirmed_amount'] = result.get('amount')
-                            payment_info['confirmation_time'] = datetime.utcnow().isoformat()
-                            deal.payment_id = json.dumps(payment_info)
-                        except:
-                            pass
-                    
-                    db.session.commit()
-                    
-                    # إرسال إشعارات
-                    await self.notification_service.notify_payment_confirmed(deal)
+            elif payment_status == 'failed':
+                # معالجة الدفع الفاشل
+                await self.handle_failed_payment(deal)
+                db.session.commit()
+                self._wake_notifications()
+                return 'failed'
+            
+            return 'unchanged'
                     
-                    logger.info(f"Payment confirmed for deal {deal.id}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error verifying payment for deal {deal.id}: {e}")
+            return 'errors'
+    
+    async def reconcile_payments(self) -> Dict[str, Any]:
+        """مطابقة حالة الصفقات الحديثة مع سجلات CCPayment
+
+        تلتقط الدفعات المؤكدة التي فاتت الـ webhook والمراقب، وتسجل الصفقات
+        المدفوعة التي لا يؤكدها CCPayment.
+        """
+        report = {
+            'started_at': datetime.utcnow().isoformat(),
+            'checked': 0,
+            'fixed': 0,
+            'mismatches': [],
+            'errors': 0,
+            'elapsed': 0.0
+        }
+        
+        if not self.ccpayment:
+            return report
+        
+        started = time.monotonic()
+        
+        try:
+            with self.flask_app.app_context():
+                since = datetime.utcnow() - timedelta(days=self.reconcile_window_days)
+                deals = Deal.query.filter(
+                    Deal.status.in_(['pending', 'paid']),
+                    Deal.payment_id.isnot(None),
+                    Deal.created_at >= since
+                ).all()
+                
+                records = await self._fetch_deal_records(deals)
+                
+                for deal in deals:
+                    record = records.get(deal.id, {'success': False})
+                    report['checked'] += 1
                     
-                elif payment_status == 'failed':
-                    # معالجة الدفع الفاشل
-                    await self.handle_failed_payment(deal)
+                    if not record.get('success'):
+                        report['errors'] += 1
+                        continue
                     
+                    payment_status = record.get('status')
+                    if deal.status == 'pending' and payment_status == 'success':
+                        if await self.apply_deposit_record(deal, record) == 'confirmed':
+                            report['fixed'] += 1
+                            self.scheduler.remove(deal.id)
+                    elif deal.status == 'paid' and payment_status != 'success':
+                        report['mismatches'].append(deal.id)
+                        logger.warning(f"Deal {deal.id} is paid but CCPayment reports '{payment_status}'")
+                        
         except Exception as e:
-            logger.error(f"Error verifying payment for deal {deal.id}: {e}")
+            logger.error(f"Error reconciling payments: {e}")
+        
+        report['elapsed'] = round(time.monotonic() - started, 3)
+        self.last_reconcile_report = report
+        
+        logger.info(
+            f"Payment reconciliation: {report['checked']} checked, {report['fixed']} fixed, "
+            f"{len(report['mismatches'])} mismatches in {report['elapsed']}s"
+        )
+        
+        return report
+    
+    def _wake_notifications(self):
+        """تنبيه مرسل الإشعارات في البوت بدلاً من انتظار دورته التالية"""
+        dispatcher = getattr(self.bot_instance, 'notifications', None)
+        if dispatcher:
+            dispatcher.wake()
     
     async def handle_failed_payment(self, deal: Deal):
         """معالجة الدفع الفاشل"""
         try:
             logger.info(f"Handling failed payment for deal {deal.id}")
             
-            # إرسال إشعار للمشتري
-            await self.notification_service.notify_payment_failed(deal)
+            # إشعار المشتري (مرة واحدة لكل صفقة)
+            enqueue_notification(deal, 'payment_failed')
             
             # يمكن إضافة منطق إضافي هنا مثل:
             # - إعادة إنشاء عنوان دفع جديد
@@ -148,6 +342,10 @@ class PaymentMonitor:
                 
                 for deal in expired_deals:
                     await self.handle_expired_payment(deal)
+                
+                if expired_deals:
+                    db.session.commit()
+                    self._wake_notifications()
                     
         except Exception as e:
             logger.error(f"Error checking expired payments: {e}")
@@ -157,8 +355,8 @@ class PaymentMonitor:
         try:
             logger.info(f"Handling expired payment for deal {deal.id}")
             
-            # إرسال تذكير للمشتري
-            await self.notification_service.notify_payment_reminder(deal)
+            # تذكير المشتري (مرة واحدة لكل صفقة)
+            enqueue_notification(deal, 'payment_reminder')
             
             # يمكن إضافة منطق إضافي مثل:
             # - إلغاء الصفقة بعد 24 ساعة
@@ -210,6 +408,7 @@ class PaymentMonitor:
                 stats = {
                     'is_running': self.is_running,
                     'check_interval': self.check_interval,
+                    'scheduler': self.scheduler.get_stats(),
                     'pending_payments': Deal.query.filter(
                         Deal.status == 'pending',
                         Deal.payment_id.isnot(None)
@@ -218,7 +417,11 @@ class PaymentMonitor:
                     'completed_deals': Deal.query.filter(Deal.status == 'completed').count(),
                     'disputed_deals': Deal.query.filter(Deal.status == 'disputed').count(),
                     'total_deals': Deal.query.count(),
-                    'ccpayment_status': 'connected' if self.ccpayment else 'disconnected'
+                    'ccpayment_status': 'connected' if self.ccpayment else 'disconnected',
+                    'max_concurrent_checks': self.max_concurrent_checks,
+                    'check_timeout': self.check_timeout,
+                    'last_cycle': self.last_cycle_report,
+                    'last_reconcile': self.last_reconcile_report
                 }
                 return stats
                 
@@ -0,0 +1,155 @@
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+
+class PaymentScheduler:
+    """جدولة فحص مدفوعات كل صفقة حسب عمرها
+
+    الصفقات الجديدة تُفحص بشكل متكرر، ثم تتضاعف الفترة بين الفحوصات
+    كلما تقدم عمر الصفقة حتى الحد الأقصى. يمكن تقديم صفقة إلى بداية
+    الطابور عند طلب فحصها يدوياً.
+    """
+
+    def __init__(self, base_interval: float = 10, max_interval: float = 1800,
+                 backoff_step: float = 600):
+        self.base_interval = base_interval  # فترة الفحص للصفقات الجديدة
+        self.max_interval = max_interval  # أقصى فترة بين فحصين
+        self.backoff_step = backoff_step  # تتضاعف الفترة كل backoff_step ثانية من عمر الصفقة
+
+        self._heap: List[Tuple[float, int, str]] = []
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _to_timestamp(created_at: Optional[datetime]) -> float:
+        """تحويل تاريخ الإنشاء (UTC) إلى timestamp"""
+        if created_at is None:
+            return time.time()
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return created_at.timestamp()
+
+    def interval_for(self, age_seconds: float) -> float:
+        """حساب فترة الفحص التالية حسب عمر الصفقة"""
+        steps = max(0, int(age_seconds // self.backoff_step))
+        # تجنب الأعداد الكبيرة جداً للصفقات القديمة
+        steps = min(steps, 32)
+        return min(self.base_interval * (2 ** steps), self.max_interval)
+
+    def _push(self, deal_id: str, due: float):
+        """إضافة موعد فحص إلى الطابور (يجب استدعاؤها مع القفل)"""
+        self._entries[deal_id]['due'] = due
+        heapq.heappush(self._heap, (due, next(self._counter), deal_id))
+
+    def add(self, deal_id: str, created_at: Optional[datetime] = None):
+        """إضافة صفقة للجدولة (تُفحص فوراً إذا كانت جديدة على الجدول)"""
+        with self._lock:
+            if deal_id in self._entries:
+                return
+            self._entries[deal_id] = {
+                'created_at': self._to_timestamp(created_at),
+                'checks': 0,
+                'due': 0.0
+            }
+            self._push(deal_id, time.time())
+
+    def sync(self, deals: Iterable[Tuple[str, Optional[datetime]]]):
+        """مزامنة الجدول مع قائمة الصفقات المعلقة الحالية"""
+        current = {}
+        for deal_id, created_at in deals:
+            current[deal_id] = created_at
+
+        with self._lock:
+            # حذف الصفقات التي لم تعد معلقة
+            for deal_id in list(self._entries.keys()):
+                if deal_id not in current:
+                    del self._entries[deal_id]
+
+        for deal_id, created_at in current.items():
+            self.add(deal_id, created_at)
+
+    def prioritize(self, deal_id: str, created_at: Optional[datetime] = None):
+        """نقل صفقة إلى بداية الطابور لفحصها في الدورة القادمة"""
+        with self._lock:
+            if deal_id not in self._entries:
+                self._entries[deal_id] = {
+                    'created_at': self._to_timestamp(created_at),
+                    'checks': 0,
+                    'due': 0.0
+                }
+            self._push(deal_id, 0.0)
+
+    def reschedule(self, deal_id: str):
+        """جدولة الفحص التالي لصفقة بعد فحصها"""
+        with self._lock:
+            entry = self._entries.get(deal_id)
+            if not entry:
+                return
+            entry['checks'] += 1
+            # لا نؤجل صفقة تم تقديمها أثناء فحصها
+            if entry['due'] is not None:
+                return
+            now = time.time()
+            self._push(deal_id, now + self.interval_for(now - entry['created_at']))
+
+    def remove(self, deal_id: str):
+        """إزالة صفقة من الجدول"""
+        with self._lock:
+            self._entries.pop(deal_id, None)
+
+    def pop_due(self, limit: Optional[int] = None, now: Optional[float] = None) -> List[str]:
+        """إرجاع الصفقات التي حان موعد فحصها"""
+        now = time.time() if now is None else now
+        due_ids = []
+
+        with self._lock:
+            while self._heap and (limit is None or len(due_ids) < limit):
+                due, _, deal_id = self._heap[0]
+                if due > now:
+                    break
+                heapq.heappop(self._heap)
+
+                entry = self._entries.get(deal_id)
+                # تجاهل المواعيد القديمة أو الصفقات المحذوفة
+                if not entry or entry['due'] != due:
+                    continue
+
+                # الصفقة قيد الفحص حتى يتم استدعاء reschedule
+                entry['due'] = None
+                due_ids.append(deal_id)
+
+        return due_ids
+
+    def next_due_in(self) -> Optional[float]:
+        """عدد الثواني حتى موعد الفحص القادم"""
+        with self._lock:
+            while self._heap:
+                due, _, deal_id = self._heap[0]
+                entry = self._entries.get(deal_id)
+                if entry and entry['due'] == due:
+                    return max(0.0, due - time.time())
+                heapq.heappop(self._heap)
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, deal_id):
+        return deal_id in self._entries
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الجدولة"""
+        next_due = self.next_due_in()
+        with self._lock:
+            return {
+                'scheduled_deals': len(self._entries),
+                'queue_entries': len(self._heap),
+                'next_check_in': round(next_due, 3) if next_due is not None else None,
+                'base_interval': self.base_interval,
+                'max_interval': self.max_interval
+            }
@@ -0,0 +1,193 @@
+import json
+import logging
+from typing import Dict, Any, Callable, Optional, Tuple
+from src.models.deal import Deal, db
+from src.services.ccpayment import get_ccpayment_service, get_async_ccpayment_service, DEFAULT_COINS
+
+logger = logging.getLogger(__name__)
+
+class _PaymentServiceBase:
+    """المنطق المشترك لإنشاء المدفوعات بين مسارات Flask والبوت
+
+    النتيجة قاموس فيه 'success'، وعند الفشل 'error' و 'status_code' المناسب
+    لاستجابة HTTP. خطوات قاعدة البيانات تحتاج app context.
+    """
+
+    def __init__(self, address_pool=None, payment_monitor=None):
+        self.address_pool = address_pool
+        self.payment_monitor = payment_monitor
+
+    @staticmethod
+    def _error(message: str, status_code: int) -> Dict[str, Any]:
+        return {
+            'success': False,
+            'error': message,
+            'status_code': status_code
+        }
+
+    def _validate_deal(self, deal: Optional[Deal]) -> Optional[Dict[str, Any]]:
+        if not deal:
+            return self._error('Deal not found', 404)
+        if deal.status != 'pending':
+            return self._error('Deal is not available for payment', 400)
+        return None
+
+    def _validate_payment(self, deal: Optional[Deal], coin_type: str, network: str) -> Optional[Dict[str, Any]]:
+        error = self._validate_deal(deal)
+        if error:
+            return error
+
+        coin_info = DEFAULT_COINS.get(coin_type)
+        if not coin_info:
+            return self._error('Unsupported coin type', 400)
+        if network not in coin_info['networks']:
+            return self._error('Unsupported network for this coin', 400)
+        return None
+
+    def _payment_created(self, deal: Deal, payment_info: Dict[str, Any]) -> Dict[str, Any]:
+        # جدولة الصفقة للفحص المكثف فور إنشاء عنوان الدفع
+        if self.payment_monitor:
+            self.payment_monitor.prioritize(deal.id)
+
+        return {
+            'success': True,
+            'payment_info': payment_info,
+            'deal_id': deal.id
+        }
+
+    def _prepare_payment(self, deal_id: str, coin_type: str,
+                         network: str) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        """التحقق وربط عنوان من المجمع إن وُجد
+
+        ترجع (نتيجة نهائية، None) أو (None، المبلغ المطلوب إنشاء عنوان له).
+        """
+        deal = Deal.query.get(deal_id)
+        error = self._validate_payment(deal, coin_type, network)
+        if error:
+            return error, None
+
+        # ربط عنوان جاهز من المجمع دون انتظار CCPayment
+        if self.address_pool:
+            payment_info = self.address_pool.acquire(deal, coin_type, network)
+            if payment_info:
+                return self._payment_created(deal, payment_info), None
+
+        return None, deal.total_price
+
+    def _apply_deposit_address(self, deal_id: str, coin_type: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        if not result['success']:
+            return self._error(result['error'], 500)
+
+        # تحديث الصفقة بمعلومات الدفع
+        payment_info = {
+            'address': result['address'],
+            'amount': result['amount'],
+            'coin_name': result['coin_name'],
+            'network': result['network'],
+            'coin_type': coin_type
+        }
+
+        deal = Deal.query.get(deal_id)
+        deal.payment_id = json.dumps(payment_info)
+        db.session.commit()
+
+        return self._payment_created(deal, payment_info)
+
+    def _prepare_checkout(self, deal_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        deal = Deal.query.get(deal_id)
+        error = self._validate_deal(deal)
+        if error:
+            return error, None
+        return None, deal.total_price
+
+    @staticmethod
+    def _apply_checkout_page(deal_id: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        if not result['success']:
+            return _PaymentServiceBase._error(result['error'], 500)
+
+        return {
+            'success': True,
+            'checkout_url': result['checkout_url'],
+            'deal_id': deal_id
+        }
+
+
+class PaymentService(_PaymentServiceBase):
+    """إنشاء المدفوعات من مسارات Flask (داخل app context الطلب)"""
+
+    def create_payment(self, deal_id: str, coin_type: str = 'USDT',
+                       network: str = 'POLYGON') -> Dict[str, Any]:
+        """إنشاء عنوان دفع لصفقة"""
+        done, amount = self._prepare_payment(deal_id, coin_type, network)
+        if done:
+            return done
+
+        result = get_ccpayment_service().create_deposit_address(
+            order_id=deal_id,
+            coin_id=DEFAULT_COINS[coin_type]['coin_id'],
+            amount=amount,
+            chain=network
+        )
+        return self._apply_deposit_address(deal_id, coin_type, result)
+
+    def create_checkout(self, deal_id: str, return_url: str = None,
+                        cancel_url: str = None) -> Dict[str, Any]:
+        """إنشاء صفحة دفع مع خيار اختيار العملة"""
+        done, amount = self._prepare_checkout(deal_id)
+        if done:
+            return done
+
+        result = get_ccpayment_service().create_checkout_page(
+            order_id=deal_id,
+            amount=amount,
+            return_url=return_url,
+            cancel_url=cancel_url
+        )
+        return self._apply_checkout_page(deal_id, result)
+
+
+class AsyncPaymentService(_PaymentServiceBase):
+    """إنشاء المدفوعات داخل event loop البوت دون استدعاء HTTP لنفس العملية
+
+    خطوات قاعدة البيانات تعمل عبر run_db (مثل BotRepository.run) إن وُجدت،
+    وإلا تعمل مباشرة داخل app context الحالي.
+    """
+
+    def __init__(self, address_pool=None, payment_monitor=None, run_db: Optional[Callable] = None):
+        super().__init__(address_pool, payment_monitor)
+        self.run_db = run_db
+
+    async def _db(self, fn: Callable, *args):
+        if self.run_db:
+            return await self.run_db(fn, *args)
+        return fn(*args)
+
+    async def create_payment(self, deal_id: str, coin_type: str = 'USDT',
+                             network: str = 'POLYGON') -> Dict[str, Any]:
+        """إنشاء عنوان دفع لصفقة"""
+        done, amount = await self._db(self._prepare_payment, deal_id, coin_type, network)
+        if done:
+            return done
+
+        result = await get_async_ccpayment_service().create_deposit_address(
+            order_id=deal_id,
+            coin_id=DEFAULT_COINS[coin_type]['coin_id'],
+            amount=amount,
+            chain=network
+        )
+        return await self._db(self._apply_deposit_address, deal_id, coin_type, result)
+
+    async def create_checkout(self, deal_id: str, return_url: str = None,
+                              cancel_url: str = None) -> Dict[str, Any]:
+        """إنشاء صفحة دفع مع خيار اختيار العملة"""
+        done, amount = await self._db(self._prepare_checkout, deal_id)
+        if done:
+            return done
+
+        result = await get_async_ccpayment_service().create_checkout_page(
+            order_id=deal_id,
+            amount=amount,
+            return_url=return_url,
+            cancel_url=cancel_url
+        )
+        return self._apply_checkout_page(deal_id, result)
@@ -0,0 +1,193 @@
+import time
+import asyncio
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Any, Callable, Coroutine, Optional, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# قيمة rate_limit_args للرسائل الجماعية، وأي قيمة أخرى تُعامل كإشعار فوري
+BULK_PRIORITY = 'bulk'
+
+# الطلبات التي تخضع لحدود الإرسال في Telegram
+LIMITED_ENDPOINT_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, needed: float = 1.0) -> float:
+        """الوقت حتى توفر needed من الرموز (بعد refill)"""
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """محدد معدل لكل طلبات البوت الصادرة إلى Telegram
+
+    - token bucket عام (~30 رسالة/ثانية) وآخر لكل محادثة (الخاصة ~1/ثانية،
+      والمجموعات ~20/دقيقة)
+    - الرسائل الجماعية (rate_limit_args=BULK_PRIORITY) لا تستخدم آخر
+      bulk_reserve من الرموز العامة ولا تُرسل ما دام هناك إشعار فوري ينتظر
+    - عند RetryAfter يتوقف الإرسال كله للمدة المطلوبة ثم يُعاد الطلب
+
+    الحالة محمية بقفل thread لأن مراقب المدفوعات يرسل من event loop آخر.
+    """
+
+    def __init__(self, overall_rate: float = 30, overall_burst: float = 30,
+                 private_rate: float = 1, private_burst: float = 5,
+                 group_rate: float = 20 / 60, group_burst: float = 3,
+                 bulk_reserve: float = 5, max_retries: int = 3):
+        self.overall = _TokenBucket(overall_rate, overall_burst)
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.bulk_reserve = bulk_reserve
+        self.max_retries = max_retries
+
+        self._chats: Dict[Any, _TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._waiting_priority = 0
+
+        self.sent_count = 0
+        self.bulk_count = 0
+        self.delayed_count = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.retry_after_count = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # المجموعات والقنوات معرفاتها سالبة أو @username
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = _TokenBucket(self.group_rate if is_group else self.private_rate,
+                                  self.group_burst if is_group else self.private_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > 10000:
+                self._prune(bucket.updated)
+        return bucket
+
+    def _prune(self, now: float):
+        """حذف buckets المحادثات الممتلئة (لا تختلف عن bucket جديد)"""
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+
+    def _try_acquire(self, chat_id, bulk: bool) -> float:
+        """أخذ رمز عام ورمز المحادثة، أو إرجاع وقت الانتظار قبل المحاولة التالية"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self.overall.refill(now)
+            needed = 1 + self.bulk_reserve if bulk else 1
+            wait = self.overall.wait_time(needed)
+            if bulk and self._waiting_priority:
+                wait = max(wait, 1 / self.overall.rate)
+
+            chat_bucket = None
+            if chat_id is not None:
+                chat_bucket = self._chat_bucket(chat_id)
+                chat_bucket.refill(now)
+                wait = max(wait, chat_bucket.wait_time())
+
+            if wait > 0:
+                return wait
+
+            self.overall.tokens -= 1
+            if chat_bucket:
+                chat_bucket.tokens -= 1
+            return 0.0
+
+    async def _acquire(self, chat_id, bulk: bool):
+        started = time.monotonic()
+        waiting = False
+        try:
+            while True:
+                wait = self._try_acquire(chat_id, bulk)
+                if wait <= 0:
+                    break
+                if not bulk and not waiting:
+                    waiting = True
+                    with self._lock:
+                        self._waiting_priority += 1
+                await asyncio.sleep(wait)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiting_priority -= 1
+
+        delay = time.monotonic() - started
+        with self._lock:
+            self.sent_count += 1
+            if bulk:
+                self.bulk_count += 1
+            if delay > 0.001:
+                self.delayed_count += 1
+                self.total_delay += delay
+                self.max_delay = max(self.max_delay, delay)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], list]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[str],
+    ):
+        limited = endpoint.startswith(LIMITED_ENDPOINT_PREFIXES)
+        bulk = rate_limit_args == BULK_PRIORITY
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                await self._acquire(data.get('chat_id'), bulk)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Telegram flood limit on {endpoint}, retrying after {seconds}s")
+                with self._lock:
+                    self.retry_after_count += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+                if not limited:
+                    await asyncio.sleep(seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            delayed = self.delayed_count
+            return {
+                'sent_count': self.sent_count,
+                'bulk_count': self.bulk_count,
+                'delayed_count': delayed,
+                'avg_delay': round(self.total_delay / delayed, 4) if delayed else 0.0,
+                'max_delay': round(self.max_delay, 4),
+                'retry_after_count': self.retry_after_count,
+                'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 2),
+                'tracked_chats': len(self._chats)
+            }
@@ -0,0 +1,97 @@
+import logging
+import time
+from typing import Dict, Any, List
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from src.models.deal import Deal, db
+# استيراد النماذج يسجل جداولها وفهارسها في db.metadata
+from src.models.dispute import Dispute, UserRating, SecurityLog, UserBan
+from src.models.deposit_address import DepositAddress
+from src.models.telegram_update import TelegramUpdateInbox
+
+logger = logging.getLogger(__name__)
+
+def explain_query_plan(statement) -> List[str]:
+    """خطة تنفيذ SQLite لاستعلام SQLAlchemy (عمود detail من EXPLAIN QUERY PLAN)"""
+    compiled = statement.compile(db.engine, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup or ())
+    rows = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+    return [row[-1] for row in rows]
+
+def find_full_scans(plan: List[str]) -> List[str]:
+    """خطوات الخطة التي تقرأ جدولاً كاملاً بدون فهرس"""
+    return [step for step in plan if step.startswith('SCAN ') and ' USING ' not in step]
+
+class SchemaMigrator:
+    """ترحيل مخطط قاعدة البيانات لقواعد البيانات الموجودة
+
+    db.create_all() ينشئ الجداول الجديدة بفهارسها لكنه لا يضيف عموداً أو فهرساً
+    جديداً إلى جدول موجود. هنا تُضاف الأعمدة الناقصة (القابلة لـ NULL أو ذات
+    server_default) بـ ALTER TABLE ADD COLUMN، وتُنشأ الفهارس الناقصة باستخدام
+    CREATE INDEX IF NOT EXISTS، لذلك يمكن تشغيله أكثر من مرة.
+    """
+
+    def __init__(self, flask_app=None):
+        self.flask_app = flask_app
+
+    def missing_columns(self) -> List:
+        """(داخل app_context) الأعمدة المعرفة في النماذج وغير الموجودة في جداول قاعدة البيانات"""
+        inspector = inspect(db.engine)
+        existing_tables = set(inspector.get_table_names())
+
+        missing = []
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing.extend(column for column in table.columns if column.name not in existing)
+        return missing
+
+    def missing_indexes(self) -> List:
+        """(داخل app_context) الفهارس المعرفة في النماذج وغير الموجودة في قاعدة البيانات"""
+        inspector = inspect(db.engine)
+        existing_tables = set(inspector.get_table_names())
+
+        missing = []
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            missing.extend(index for index in sorted(table.indexes, key=lambda index: index.name)
+                           if index.name not in existing)
+        return missing
+
+    def migrate(self) -> Dict[str, Any]:
+        """إنشاء الجداول والفهارس الناقصة"""
+        started = time.monotonic()
+        added = []
+        created = []
+
+        with self.flask_app.app_context():
+            # الجداول الجديدة تُنشأ مع فهارسها
+            db.create_all()
+
+            for column in self.missing_columns():
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(f"Cannot add NOT NULL column {column.table.name}.{column.name}")
+                logger.info(f"Adding column {column.name} to {column.table.name}")
+                db.session.execute(db.text(
+                    f"ALTER TABLE {column.table.name} ADD COLUMN {CreateColumn(column).compile(db.engine)}"
+                ))
+                added.append(f"{column.table.name}.{column.name}")
+
+            for index in self.missing_indexes():
+                logger.info(f"Creating index {index.name} on {index.table.name}")
+                db.session.execute(CreateIndex(index, if_not_exists=True))
+                created.append(index.name)
+
+            if created:
+                # تحديث إحصائيات المخطط حتى يختار المحسن الفهارس الجديدة
+                db.session.execute(db.text('ANALYZE'))
+            db.session.commit()
+
+        return {
+            'added_columns': added,
+            'created': created,
+            'elapsed': round(time.monotonic() - started, 3)
+        }
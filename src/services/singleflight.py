@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Awaitable, Hashable, Optional
+
+class _Flight:
+    """طلب جارٍ ينتظره عدة مستدعين"""
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """دمج الاستدعاءات المتزامنة المتطابقة (threads)
+
+    أول مستدعٍ لمفتاح معين ينفذ الطلب، وبقية المستدعين لنفس المفتاح
+    ينتظرون ويحصلون على نفس النتيجة بدلاً من إرسال طلب مكرر.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+        self.executed_count = 0
+        self.shared_count = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.executed_count += 1
+            else:
+                self.shared_count += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+        return flight.result
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._flights),
+            'executed': self.executed_count,
+            'shared': self.shared_count
+        }
+
+class AsyncSingleFlight:
+    """دمج الاستدعاءات المتطابقة داخل event loop
+
+    الطلب يعمل كـ task مستقلة، لذلك إلغاء أحد المنتظرين (مثلاً بسبب المهلة)
+    لا يلغي الطلب على بقية المنتظرين. المفاتيح منفصلة لكل event loop.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.executed_count = 0
+        self.shared_count = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+
+        with self._lock:
+            task = self._tasks.get(flight_key)
+            if task is None:
+                task = loop.create_task(fn())
+                self._tasks[flight_key] = task
+                task.add_done_callback(lambda _: self._forget(flight_key))
+                self.executed_count += 1
+            else:
+                self.shared_count += 1
+
+        return await asyncio.shield(task)
+
+    def _forget(self, flight_key):
+        with self._lock:
+            self._tasks.pop(flight_key, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._tasks),
+            'executed': self.executed_count,
+            'shared': self.shared_count
+        }
+
+class ResultCache:
+    """ذاكرة مؤقتة قصيرة العمر للنتائج مع حد أقصى للحجم
+
+    الإبطال يزيد رقم الجيل، والنتائج التي بدأ جلبها قبل الإبطال لا تُحفظ،
+    حتى لا تعود نتيجة قديمة بعد وصول webhook مثلاً.
+    """
+
+    def __init__(self, ttl: float = 5, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, key: Hashable, value: Dict[str, Any], generation: Optional[int] = None):
+        """حفظ نتيجة، مع تجاهلها إذا حدث إبطال منذ الجيل المعطى"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, dict(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses
+            }
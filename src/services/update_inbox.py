@@ -0,0 +1,122 @@
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any
+from sqlalchemy.dialects import sqlite, postgresql
+from telegram import Update
+from src.models.deal import db
+from src.models.telegram_update import TelegramUpdateInbox
+
+logger = logging.getLogger(__name__)
+
+def store_telegram_update(data: Dict[str, Any]) -> bool:
+    """حفظ تحديث في صندوق الوارد داخل المعاملة الحالية (بدون commit)
+
+    يُستخدم في عملية المستقبل المنفصلة. يرجع False إذا كان التحديث محفوظاً من قبل.
+    """
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    result = db.session.execute(insert(TelegramUpdateInbox.__table__).on_conflict_do_nothing(
+        index_elements=['update_id']
+    ).values(
+        update_id=int(data['update_id']),
+        payload=json.dumps(data),
+        received_at=datetime.utcnow()
+    ))
+    return result.rowcount == 1
+
+class UpdateInboxReader:
+    """نقل تحديثات صندوق الوارد إلى طابور تحديثات البوت في عملية المعالجات
+
+    يسحب فقط بقدر المساحة الفارغة في الطابور المحدود، فعند انشغال المعالجات
+    تبقى التحديثات في قاعدة البيانات بدلاً من الذاكرة. التحديث يصبح claimed
+    عند نقله إلى الطابور، أي أن توقف العملية يفقد ما في الطابور فقط كما في
+    المستقبل داخل نفس العملية، ويبقى صفه retention_days حتى يرفض المستقبل
+    إعادة إرسال Telegram لنفس التحديث. يجب تشغيل عملية معالجات واحدة فقط
+    حتى يبقى ترتيب تحديثات كل محادثة محفوظاً.
+    """
+
+    def __init__(self, application, repository, batch_size: int = 100, poll_interval: float = 0.2,
+                 retention_days: int = 1):
+        self.application = application
+        self.repository = repository
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+
+        self._task = None
+        self._last_purge = 0.0
+
+        self.moved_count = 0
+        self.invalid_count = 0
+        self.errors_count = 0
+        self.full_queue_count = 0
+
+    def start(self):
+        """بدء النقل على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.pump_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading Telegram update inbox: {e}")
+                self.errors_count += 1
+                moved = 0
+
+            if time.monotonic() - self._last_purge > 3600:
+                self._last_purge = time.monotonic()
+                try:
+                    await self.repository.purge_telegram_updates(
+                        datetime.utcnow() - timedelta(days=self.retention_days)
+                    )
+                except Exception as e:
+                    logger.error(f"Error purging claimed Telegram updates: {e}")
+
+            if moved == 0:
+                await asyncio.sleep(self.poll_interval)
+
+    async def pump_once(self) -> int:
+        """نقل دفعة من التحديثات بقدر المساحة الفارغة في الطابور وإرجاع عددها"""
+        queue = self.application.update_queue
+        free = queue.maxsize - queue.qsize() if queue.maxsize else self.batch_size
+        if free <= 0:
+            self.full_queue_count += 1
+            return 0
+
+        payloads = await self.repository.claim_telegram_updates(min(free, self.batch_size))
+        for payload in payloads:
+            try:
+                update = Update.de_json(json.loads(payload), self.application.bot)
+            except Exception as e:
+                logger.warning(f"Dropping invalid Telegram update from inbox: {e}")
+                self.invalid_count += 1
+                continue
+            await queue.put(update)
+            self.moved_count += 1
+
+        return len(payloads)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'is_running': bool(self._task and not self._task.done()),
+            'moved_count': self.moved_count,
+            'invalid_count': self.invalid_count,
+            'errors_count': self.errors_count,
+            'full_queue_count': self.full_queue_count
+        }
@@ -0,0 +1,114 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Awaitable, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """معالجة تحديثات البوت بالتوازي مع الحفاظ على الترتيب داخل كل محادثة
+
+    تحديثات المحادثات المختلفة تعمل في نفس الوقت، أما تحديثات نفس المحادثة
+    (أو نفس المستخدم إذا لم توجد محادثة) فتُنفذ واحداً تلو الآخر بترتيب
+    وصولها، حتى لا تتسابق خطوات مثل context.user_data['deal_step'].
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256, max_pending_updates: int = 10000):
+        # حد BaseUpdateProcessor يُطبق قبل do_process_update، فهو يشمل التحديثات التي
+        # تنتظر دور محادثتها. حد التوازي الفعلي يُطبق بعد قفل المحادثة بـ semaphore
+        # خاص، فتحديثات محادثة مشغولة لا تحجز أماكن باقي المحادثات
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.max_running_updates = max_concurrent_updates
+        self._running_slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_depths: Dict[Hashable, int] = {}
+
+        self.running_updates = 0
+        self.processed_count = 0
+        self.max_chat_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_handler_time = 0.0
+
+    @staticmethod
+    def _ordering_key(update: object) -> Optional[Hashable]:
+        """مفتاح الترتيب: المحادثة، وإلا المستخدم"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        return None
+
+    async def _run_in_slot(self, coroutine: Awaitable[Any], queued_at: float) -> None:
+        async with self._running_slots:
+            started = time.monotonic()
+            wait_time = started - queued_at
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.running_updates += 1
+
+            try:
+                await coroutine
+            finally:
+                self.running_updates -= 1
+                self.total_handler_time += time.monotonic() - started
+                self.processed_count += 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run_in_slot(coroutine, time.monotonic())
+            return
+
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+
+        depth = self._chat_depths.get(key, 0) + 1
+        self._chat_depths[key] = depth
+        self.max_chat_depth = max(self.max_chat_depth, depth)
+        queued_at = time.monotonic()
+
+        try:
+            # asyncio.Lock يحترم ترتيب الانتظار، فتُنفذ تحديثات المحادثة بترتيب وصولها،
+            # ومكان التوازي يؤخذ فقط بعد أن يحين دور التحديث في محادثته
+            async with lock:
+                await self._run_in_slot(coroutine, queued_at)
+        finally:
+            remaining = self._chat_depths[key] - 1
+            if remaining:
+                self._chat_depths[key] = remaining
+            else:
+                # حذف القفل عند فراغ المحادثة حتى لا تنمو الذاكرة مع عدد المستخدمين
+                del self._chat_depths[key]
+                del self._chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def get_stats(self, top: int = 5) -> Dict[str, Any]:
+        """عمق طوابير المحادثات وأزمنة الانتظار والمعالجة"""
+        # نسخة من القاموس لأن الدالة قد تُستدعى من thread آخر (Flask)
+        depths = dict(self._chat_depths)
+        busiest = sorted(depths.items(), key=lambda item: item[1], reverse=True)[:top]
+        processed = self.processed_count
+
+        return {
+            'max_concurrent_updates': self.max_running_updates,
+            'active_updates': self.running_updates,
+            'active_chats': len(depths),
+            'queued_updates': sum(depths.values()),
+            'busiest_chats': [{'chat': key[1], 'depth': depth} for key, depth in busiest],
+            'max_chat_depth': self.max_chat_depth,
+            'processed_count': processed,
+            'avg_wait_time': round(self.total_wait_time / processed, 4) if processed else 0.0,
+            'max_wait_time': round(self.max_wait_time, 4),
+            'avg_handler_time': round(self.total_handler_time / processed, 4) if processed else 0.0
+        }
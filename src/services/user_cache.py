@@ -0,0 +1,136 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Profile = Tuple[Optional[str], Optional[str], Optional[str]]  # (username, first_name, last_name)
+
+class KnownUserCache:
+    """ذاكرة مؤقتة لمستخدمي Telegram المعروفين
+
+    المستخدم العائد بنفس بياناته لا يكلف أي استعلام. عند عدم وجوده في الذاكرة
+    يتم upsert واحد، وتغييرات الاسم أو المعرف تُجمع وتُكتب دفعة واحدة بشكل دوري.
+    """
+
+    def __init__(self, repository, max_entries: int = 50000, ttl: float = 3600,
+                 flush_interval: float = 30):
+        self.repository = repository
+        self.max_entries = max_entries
+        self.ttl = ttl  # ثانية - بعدها يتم التحقق من المستخدم في قاعدة البيانات من جديد
+        self.flush_interval = flush_interval  # ثانية - فترة كتابة تغييرات البيانات
+
+        self._entries = OrderedDict()  # telegram_id -> (expires_at, profile)
+        self._dirty: Dict[int, Profile] = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    @staticmethod
+    def _profile(user) -> Profile:
+        return (user.username, user.first_name, user.last_name)
+
+    def _remember(self, telegram_id: int, profile: Profile):
+        """حفظ مستخدم في الذاكرة (يجب استدعاؤها مع القفل)"""
+        self._entries[telegram_id] = (time.monotonic() + self.ttl, profile)
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def check(self, telegram_id: int, profile: Profile) -> str:
+        """تصنيف المستخدم: hit أو changed (تمت جدولة الكتابة) أو miss (يحتاج upsert)"""
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return 'miss'
+
+            if entry[1] == profile:
+                self._entries.move_to_end(telegram_id)
+                self.hits += 1
+                return 'hit'
+
+            self._remember(telegram_id, profile)
+            self._dirty[telegram_id] = profile
+            self.changes += 1
+            return 'changed'
+
+    async def ensure_user(self, user) -> str:
+        """تسجيل مستخدم Telegram عند الحاجة فقط"""
+        profile = self._profile(user)
+        result = self.check(user.id, profile)
+
+        if result == 'miss':
+            await self.repository.upsert_users({user.id: profile})
+            with self._lock:
+                self._remember(user.id, profile)
+                # الـ upsert كتب أحدث البيانات
+                self._dirty.pop(user.id, None)
+
+        return result
+
+    def invalidate(self, telegram_id: int):
+        """حذف مستخدم من الذاكرة (مثلاً بعد تعديل بياناته من مكان آخر)"""
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+
+    async def flush(self) -> int:
+        """كتابة تغييرات البيانات المتراكمة دفعة واحدة"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        if not dirty:
+            return 0
+
+        try:
+            await self.repository.upsert_users(dirty)
+        except Exception as e:
+            logger.error(f"Error flushing user profile changes: {e}")
+            with self._lock:
+                # إعادة التغييرات غير المكتوبة دون استبدال الأحدث منها
+                for telegram_id, profile in dirty.items():
+                    self._dirty.setdefault(telegram_id, profile)
+            return 0
+
+        self.flushes += 1
+        self.flushed_rows += len(dirty)
+        return len(dirty)
+
+    def start(self):
+        """بدء الكتابة الدورية على الـ event loop الحالي"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف الكتابة الدورية وكتابة ما تبقى"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses + self.changes
+            return {
+                'entries': len(self._entries),
+                'pending_changes': len(self._dirty),
+                'hits': self.hits,
+                'misses': self.misses,
+                'changes': self.changes,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows
+            }
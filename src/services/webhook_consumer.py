@@ -0,0 +1,214 @@
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from sqlalchemy import func
+from src.models.deal import Deal, db
+from src.models.webhook_inbox import WebhookInbox
+from src.services.payment_events import confirm_payment, load_deals_by_order_ids
+
+logger = logging.getLogger(__name__)
+
+class WebhookConsumer:
+    """مستهلك صندوق وارد webhooks في الخلفية
+
+    يسحب الأحداث المعلقة على دفعات ويطبقها على الصفقات مع commit واحد لكل دفعة،
+    بدلاً من الكتابة في قاعدة البيانات داخل طلب HTTP الخاص بكل webhook.
+    """
+
+    def __init__(self, flask_app, batch_size: int = 100, idle_interval: float = 5,
+                 max_attempts: int = 5):
+        self.flask_app = flask_app
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval  # ثانية - الانتظار عند فراغ الصندوق
+        self.max_attempts = max_attempts
+
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.is_running = False
+
+        self.processed_count = 0
+        self.failed_count = 0
+        self.duplicate_count = 0
+        self.batches_count = 0
+        self.last_batch_size = 0
+        self.last_batch_at = None
+
+    def start(self):
+        """تشغيل المستهلك في thread منفصل (مرة واحدة فقط)"""
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self.is_running = True
+            self._thread = threading.Thread(target=self._run, name='webhook-consumer', daemon=True)
+            self._thread.start()
+            logger.info("Webhook consumer started")
+
+    def stop(self):
+        """إيقاف المستهلك"""
+        self.is_running = False
+        self._wakeup.set()
+
+    def notify(self):
+        """تنبيه المستهلك بوصول حدث جديد"""
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while self.is_running:
+            # المسح قبل الدفعة لا بعد الانتظار: notify أثناء الدفعة يوقظ الدورة التالية فوراً
+            self._wakeup.clear()
+            try:
+                drained = self.drain_once()
+            except Exception as e:
+                logger.error(f"Error in webhook consumer loop: {e}")
+                drained = 0
+
+            # الاستمرار مباشرة إذا كانت الدفعة ممتلئة
+            if drained < self.batch_size:
+                self._wakeup.wait(self.idle_interval)
+
+    def drain_once(self) -> int:
+        """معالجة دفعة واحدة من الأحداث المعلقة وإرجاع عددها"""
+        with self.flask_app.app_context():
+            entries = WebhookInbox.query.filter_by(status='pending').order_by(
+                WebhookInbox.id
+            ).limit(self.batch_size).all()
+
+            if not entries:
+                return 0
+
+            payloads = {}
+            for entry in entries:
+                try:
+                    payloads[entry.id] = json.loads(entry.payload)
+                except ValueError:
+                    payloads[entry.id] = None
+
+            # تحميل جميع الصفقات المطلوبة دفعة واحدة
+            deals = load_deals_by_order_ids(p.get('orderId') for p in payloads.values() if p and p.get('orderId'))
+
+            now = datetime.utcnow()
+            outcomes = [self._apply_entry(entry, payloads[entry.id], deals, now) for entry in entries]
+
+            try:
+                # commit واحد للدفعة كاملة
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error committing webhook batch, retrying entries one by one: {e}")
+                outcomes = self._drain_one_by_one([entry.id for entry in entries], payloads, now)
+
+            self.processed_count += outcomes.count('processed')
+            self.failed_count += outcomes.count('failed')
+            self.duplicate_count += outcomes.count('duplicate')
+            self.batches_count += 1
+            self.last_batch_size = len(entries)
+            self.last_batch_at = now
+
+            return len(entries)
+
+    def _apply_entry(self, entry: WebhookInbox, payload: Optional[Dict[str, Any]],
+                     deals: Dict[str, Deal], now: datetime) -> str:
+        """تطبيق حدث واحد داخل savepoint وإرجاع نتيجته (processed, duplicate, failed, retry)
+
+        فشل الحدث يتراجع عن تغييراته وحده (سجل الحدث وتحديث الصفقة والإشعارات)
+        دون باقي الدفعة، فتبقى إعادة المحاولة ممكنة ولا يُعتبر الحدث مكرراً.
+        """
+        entry.attempts = (entry.attempts or 0) + 1
+        try:
+            with db.session.begin_nested():
+                applied = self.apply_event(payload, deals)
+        except Exception as e:
+            entry.error = str(e)
+            logger.warning(f"Failed to process webhook {entry.id}: {e}")
+            if entry.attempts >= self.max_attempts or isinstance(e, (KeyError, ValueError)):
+                entry.status = 'failed'
+                return 'failed'
+            return 'retry'
+
+        entry.status = 'processed' if applied else 'duplicate'
+        entry.processed_at = now
+        entry.error = None
+        return entry.status
+
+    def _drain_one_by_one(self, entry_ids: List[int], payloads: Dict[int, Any], now: datetime) -> List[str]:
+        """معالجة الدفعة حدثاً حدثاً بعد فشل commit الدفعة
+
+        حدث يفشل commit الخاص به يُحفظ له عدد المحاولات والخطأ فقط، حتى يصل إلى
+        max_attempts ويُعلَّم failed بدلاً من إعاقة الصندوق إلى الأبد.
+        """
+        outcomes = []
+        for entry_id in entry_ids:
+            entry = WebhookInbox.query.get(entry_id)
+            if not entry or entry.status != 'pending':
+                continue
+
+            payload = payloads[entry_id]
+            order_id = payload.get('orderId') if isinstance(payload, dict) else None
+            deals = load_deals_by_order_ids([order_id]) if order_id else {}
+
+            outcome = self._apply_entry(entry, payload, deals, now)
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error committing webhook {entry_id}: {e}")
+
+                entry = WebhookInbox.query.get(entry_id)
+                entry.attempts = (entry.attempts or 0) + 1
+                entry.error = str(e)
+                outcome = 'retry'
+                if entry.attempts >= self.max_attempts:
+                    entry.status = 'failed'
+                    outcome = 'failed'
+                try:
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error saving webhook {entry_id} attempt: {e}")
+                    outcome = 'retry'
+
+            outcomes.append(outcome)
+        return outcomes
+
+    def apply_event(self, payload: Optional[Dict[str, Any]], deals: Dict[str, Deal]) -> bool:
+        """تسجيل حدث webhook وتطبيقه على الصفقة، وإرجاع False إذا كان مكرراً"""
+        if not payload:
+            raise ValueError('Invalid webhook payload')
+
+        order_id = payload.get('orderId')
+        deal = deals.get(order_id)
+        if not deal:
+            raise KeyError(f'Deal not found for order_id: {order_id}')
+
+        # يُستدعى داخل savepoint حتى لا يبقى سجل الحدث إذا فشل تطبيقه
+        return confirm_payment(deal, payload, source='webhook') != 'duplicate'
+
+    def get_stats(self) -> Dict[str, Any]:
+        """إحصائيات الصندوق: العمق والتأخير"""
+        with self.flask_app.app_context():
+            depth, oldest = db.session.query(
+                func.count(WebhookInbox.id),
+                func.min(WebhookInbox.received_at)
+            ).filter(WebhookInbox.status == 'pending').one()
+
+            failed_total = WebhookInbox.query.filter_by(status='failed').count()
+
+        lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+
+        return {
+            'is_running': bool(self._thread and self._thread.is_alive()),
+            'queue_depth': depth,
+            'lag_seconds': round(lag, 3),
+            'failed_total': failed_total,
+            'processed_count': self.processed_count,
+            'failed_count': self.failed_count,
+            'duplicate_count': self.duplicate_count,
+            'batches_count': self.batches_count,
+            'last_batch_size': self.last_batch_size,
+            'last_batch_at': self.last_batch_at.isoformat() if self.last_batch_at else None,
+            'batch_size': self.batch_size
+        }
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+class WebhookReplayGuard:
+    """حماية webhooks من إعادة الإرسال (replay)
+
+    يرفض الطلبات التي يقع توقيتها خارج نافذة زمنية محددة، ويحتفظ بذاكرة محدودة
+    الحجم للتوقيعات التي وصلت مؤخراً حتى انتهاء صلاحيتها. كل ذلك يتم في الذاكرة
+    قبل أي وصول لقاعدة البيانات.
+    """
+
+    def __init__(self, max_age: int = 300, max_entries: int = 10000, clock_skew: int = 30):
+        self.max_age = max_age  # ثانية - أقصى عمر مقبول للـ webhook
+        self.max_entries = max_entries  # الحد الأقصى للتوقيعات المحفوظة
+        self.clock_skew = clock_skew  # ثانية - السماح بفرق بسيط في الساعة
+
+        self._seen = OrderedDict()  # signature -> وقت انتهاء الصلاحية
+        self._lock = threading.Lock()
+
+        self.accepted_count = 0
+        self.replay_hits = 0
+        self.out_of_window_count = 0
+        self.missing_timestamp_count = 0
+        self.expired_evictions = 0
+        self.capacity_evictions = 0
+
+    def _evict_expired(self, now: float):
+        """حذف التوقيعات المنتهية من بداية القائمة (يجب استدعاؤها مع القفل)"""
+        while self._seen:
+            signature, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            self._seen.popitem(last=False)
+            self.expired_evictions += 1
+
+    def check(self, signature: str, timestamp: Any) -> Tuple[bool, Optional[str]]:
+        """فحص webhook، وإرجاع (مقبول، سبب الرفض)"""
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            with self._lock:
+                self.missing_timestamp_count += 1
+            return False, 'missing_timestamp'
+
+        now = time.time()
+        if timestamp < now - self.max_age or timestamp > now + self.clock_skew:
+            with self._lock:
+                self.out_of_window_count += 1
+            return False, 'out_of_window'
+
+        with self._lock:
+            self._evict_expired(now)
+
+            if signature in self._seen:
+                self.replay_hits += 1
+                return False, 'replayed'
+
+            # التوقيع يبقى محفوظاً حتى يخرج توقيته من النافذة الزمنية
+            self._seen[signature] = timestamp + self.max_age
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self.capacity_evictions += 1
+
+            self.accepted_count += 1
+
+        return True, None
+
+    def forget(self, signature: str):
+        """حذف توقيع (مثلاً عند فشل حفظ الحدث حتى يقبل إعادة المحاولة)"""
+        with self._lock:
+            self._seen.pop(signature, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """عدادات الحماية لنقاط المراقبة"""
+        with self._lock:
+            return {
+                'cached_signatures': len(self._seen),
+                'max_entries': self.max_entries,
+                'max_age': self.max_age,
+                'accepted': self.accepted_count,
+                'replay_hits': self.replay_hits,
+                'out_of_window': self.out_of_window_count,
+                'missing_timestamp': self.missing_timestamp_count,
+                'expired_evictions': self.expired_evictions,
+                'capacity_evictions': self.capacity_evictions
+            }
+
+# نسخة مشتركة على مستوى العملية
+webhook_replay_guard = WebhookReplayGuard()
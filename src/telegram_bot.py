@@ -1,13 +1,31 @@
 import os
 import sys
 import json
+import asyncio
 import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from flask_sqlalchemy import SQLAlchemy
 from models.telegram_user import TelegramUser, db as user_db
 from models.deal import Deal, db as deal_db
+from services.payment_service import AsyncPaymentService
+from services.update_processor import ChatOrderedUpdateProcessor
+from services.bot_repository import BotRepository, LoopLagMonitor
+from services.user_cache import KnownUserCache
+from services.callback_router import CallbackRouter
+from services.callback_codec import callback_codec, encode_callback
+from services.conversation_store import ConversationStore
+from services.media_groups import MediaGroupCollector, MAX_MEDIA_GROUP_SIZE
+from services.rate_limiter import PriorityRateLimiter
+from services.broadcast import BroadcastEngine
+from services.outbox import NotificationDispatcher
+from services.message_cache import RenderedMessageCache, render_digest
+from services.update_inbox import UpdateInboxReader
+from routes.monitoring import get_address_pool, get_payment_monitor
 
 # إعداد التسجيل
 logging.basicConfig(
@@ -19,13 +37,113 @@ logger = logging.getLogger(__name__)
 # إعداد قاعدة البيانات
 DATABASE_URL = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 
+def parse_dispute_reason(rest):
+    """dispute_reason_<reason>_<deal_id>: السبب قد يحتوي على _ لذلك يُفصل من اليمين"""
+    reason, deal_id = rest.rsplit('_', 1)
+    if not reason or not deal_id:
+        raise ValueError("Invalid dispute reason callback")
+    return reason, deal_id
+
+def parse_rating(rest):
+    """rating_<rating>_<rated_user_id>_<deal_id>"""
+    rating, rated_user_id, deal_id = rest.split('_', 2)
+    return int(rating), int(rated_user_id), deal_id
+
+def parse_dispute_reason_action(deal_id, params):
+    """الشكل المرمز: المعامل الوحيد هو السبب"""
+    reason, = params
+    return reason, deal_id
+
+def parse_rating_action(deal_id, params):
+    """الشكل المرمز: المعاملات هي التقييم ثم المستخدم المقيَّم"""
+    rating, rated_user_id = params
+    return int(rating), int(rated_user_id), deal_id
+
+# لوحات أزرار القوائم الثابتة تُبنى مرة واحدة (كائنات telegram غير قابلة للتعديل)
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🆕 إنشاء صفقة جديدة", callback_data="create_deal")],
+    [InlineKeyboardButton("📋 صفقاتي", callback_data="my_deals")],
+    [InlineKeyboardButton("💰 محفظتي", callback_data="wallet")],
+    [InlineKeyboardButton("❓ المساعدة", callback_data="help")]
+])
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]
+])
+CREATE_DEAL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 بدء إنشاء الصفقة", callback_data="start_deal_creation")],
+    [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]
+])
+HOME_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]
+])
+
 class OTCBot:
-    def __init__(self, token, flask_app=None):
+    def __init__(self, token, flask_app=None, update_queue_size=1000, max_concurrent_updates=256):
         self.token = token
         self.flask_app = flask_app
-        self.application = Application.builder().token(token).build()
+        # طابور محدود الحجم: عند امتلائه ينتظر مستقبل webhooks بدلاً من تراكم التحديثات في الذاكرة
+        self.update_queue_size = update_queue_size
+        # معالجة متوازية بين المحادثات مع الحفاظ على الترتيب داخل كل محادثة
+        self.update_processor = ChatOrderedUpdateProcessor(max_concurrent_updates)
+        # كل الرسائل الصادرة (من البوت والإشعارات) تمر بمحدد معدل واحد
+        self.rate_limiter = PriorityRateLimiter()
+        self.application = Application.builder().token(token).rate_limiter(self.rate_limiter).update_queue(
+            asyncio.Queue(maxsize=update_queue_size)
+        ).concurrent_updates(self.update_processor).post_init(self._post_init).post_shutdown(
+            self._post_shutdown
+        ).build()
+        # عمليات قاعدة البيانات تعمل على thread pool خارج الـ event loop
+        self.repository = BotRepository(flask_app) if flask_app else None
+        # المستخدمون المعروفون لا يكلفون استعلاماً عند كل /start
+        self.user_cache = KnownUserCache(self.repository) if self.repository else None
+        self.loop_lag_monitor = LoopLagMonitor()
+        self.mode = None
+        self.loop = None
+        self.webhook_secret = None
+        # عملية معالجات منفصلة تقرأ التحديثات من صندوق وارد تكتبه عملية المستقبل
+        self.update_inbox = None
+        self.updates_accepted = 0
+        self.updates_rejected = 0
+        # حالات المستخدمين في خطوات إنشاء الصفقة والنزاع (تستمر بعد إعادة التشغيل)
+        self.conversations = ConversationStore(self.repository)
+        # أجزاء الألبوم تصل كتحديثات منفصلة ويتم تجميعها قبل إنشاء الصفقة
+        self.media_groups = MediaGroupCollector()
+        self.callback_router = CallbackRouter(callback_codec)
+        # آخر محتوى لكل رسالة حتى لا تُرسل تعديلات بنفس المحتوى
+        self.rendered_messages = RenderedMessageCache()
+        # حملات البث تُرسل في الخلفية وتُستأنف بعد إعادة التشغيل
+        self.broadcasts = BroadcastEngine(
+            self.application.bot, self.repository,
+            on_blocked=self.user_cache.invalidate
+        ) if self.repository else None
+        # إشعارات صندوق الصادر (من البوت والمراقب و webhooks والنزاعات)
+        self.notifications = NotificationDispatcher(
+            self.application.bot, self.repository
+        ) if self.repository else None
         self.setup_handlers()
         
+    async def _post_init(self, application):
+        """بعد تهيئة البوت: بدء قياس تأخر الـ event loop والكتابة الدورية وإرسال الإشعارات وحملات البث"""
+        self.loop_lag_monitor.start()
+        self.conversations.start_writer()
+        if self.user_cache:
+            self.user_cache.start()
+        if self.notifications:
+            self.notifications.start()
+        if self.broadcasts:
+            self.broadcasts.start()
+    
+    async def _post_shutdown(self, application):
+        """عند إيقاف البوت: كتابة تغييرات المستخدمين المتبقية"""
+        self.loop_lag_monitor.stop()
+        if self.broadcasts:
+            await self.broadcasts.stop()
+        if self.notifications:
+            await self.notifications.stop()
+        await self.conversations.stop()
+        if self.user_cache:
+            await self.user_cache.stop()
+    
     def setup_handlers(self):
         """إعداد معالجات الأوامر"""
         self.application.add_handler(CommandHandler("start", self.start))
@@ -33,40 +151,51 @@ class OTCBot:
         self.application.add_handler(CommandHandler("create_deal", self.create_deal))
         self.application.add_handler(CallbackQueryHandler(self.button_handler))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        self.application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO, self.handle_media))
+        self.setup_callback_routes()
+    
+    def setup_callback_routes(self):
+        """جدول توجيه الأزرار: callback_data ثابتة أو بادئة + deal_id"""
+        router = self.callback_router
+        router.add("main_menu", lambda query, context: self.show_main_menu(query))
+        router.add("create_deal", self.create_deal_callback)
+        router.add("start_deal_creation", self.start_deal_creation)
+        router.add("my_deals", self.show_my_deals)
+        router.add("wallet", self.show_wallet)
+        router.add("help", lambda query, context: self.show_help(query))
         
+        # أزرار الصفقات: الشكل المرمز (callback_codec)، والشكل النصي القديم
+        # للأزرار التي أُرسلت قبل الترميز وما زالت في المحادثات
+        deal_routes = {
+            "view_deal": self.show_deal_callback,
+            "buy_deal": self.initiate_purchase,
+            "confirm_payment": self.confirm_payment_process,
+            "release_funds": self.release_funds_process,
+            "dispute": self.create_dispute_process,
+            "confirm_delivery": self.confirm_delivery_process,
+            "pay_usdt_polygon": lambda query, context, deal_id: self.process_payment(query, context, deal_id, "USDT", "POLYGON"),
+            "pay_usdt_eth": lambda query, context, deal_id: self.process_payment(query, context, deal_id, "USDT", "ETH"),
+            "pay_btc": lambda query, context, deal_id: self.process_payment(query, context, deal_id, "BTC", "BTC"),
+            "pay_checkout": self.create_checkout_page
+        }
+        for action, handler in deal_routes.items():
+            router.add_action(action, handler)
+            router.add_prefix(f"{action}_", handler)
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالج أمر /start"""
         user = update.effective_user
         
+        # حفظ بيانات المستخدم (بدون استعلام إذا كان معروفاً ولم تتغير بياناته)
+        if self.user_cache:
+            await self.user_cache.ensure_user(user)
+        
         # التحقق من وجود رابط صفقة في الأمر
         if context.args and context.args[0].startswith('deal_'):
             deal_id = context.args[0].replace('deal_', '')
             await self.show_deal_details(update, context, deal_id)
             return
         
-        # حفظ أو تحديث بيانات المستخدم
-        if self.flask_app:
-            with self.flask_app.app_context():
-                telegram_user = TelegramUser.query.filter_by(telegram_id=user.id).first()
-                if not telegram_user:
-                    telegram_user = TelegramUser(
-                        telegram_id=user.id,
-                        username=user.username,
-                        first_name=user.first_name,
-                        last_name=user.last_name
-                    )
-                    user_db.session.add(telegram_user)
-                    user_db.session.commit()
-        
-        # إنشاء لوحة التحكم الرئيسية
-        keyboard = [
-            [InlineKeyboardButton("🆕 إنشاء صفقة جديدة", callback_data="create_deal")],
-            [InlineKeyboardButton("📋 صفقاتي", callback_data="my_deals")],
-            [InlineKeyboardButton("💰 محفظتي", callback_data="wallet")],
-            [InlineKeyboardButton("❓ المساعدة", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         welcome_text = f"""
 🔥 مرحباً بك في بوت OTC للوساطة الآمنة! 🔥
 
@@ -84,7 +213,7 @@ class OTCBot:
 اختر من القائمة أدناه للبدء:
         """
         
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+        await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU_MARKUP)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالج أمر المساعدة"""
@@ -121,19 +250,10 @@ class OTCBot:
 للمساعدة الإضافية، تواصل مع الدعم الفني.
         """
         
-        keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(help_text, reply_markup=reply_markup)
+        await update.message.reply_text(help_text, reply_markup=BACK_TO_MENU_MARKUP)
     
     async def create_deal(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """بدء عملية إنشاء صفقة جديدة"""
-        keyboard = [
-            [InlineKeyboardButton("📝 بدء إنشاء الصفقة", callback_data="start_deal_creation")],
-            [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         text = """
 🆕 إنشاء صفقة جديدة
 
@@ -148,79 +268,63 @@ class OTCBot:
 اضغط "بدء إنشاء الصفقة" للمتابعة.
         """
         
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.message.reply_text(text, reply_markup=CREATE_DEAL_MARKUP)
     
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالج الأزرار"""
         query = update.callback_query
         await query.answer()
+        await self.callback_router.dispatch(query, context)
+    
+    async def edit_message(self, query, text, reply_markup=None, parse_mode=None, **kwargs):
+        """تعديل رسالة الزر، مع تجاهل التعديل إذا كان المحتوى لم يتغير
+
+        يرجع False إذا لم يُرسل طلب (أو رفضه Telegram لأن الرسالة لم تتغير).
+        """
+        message = query.message
+        key = (message.chat.id, message.message_id) if message else None
+        digest = render_digest(text, reply_markup, parse_mode)
+        
+        if key:
+            current = self.rendered_messages.get(key)
+            if current is None and isinstance(getattr(message, 'text', None), str):
+                # أول تعديل لهذه الرسالة: المقارنة بمحتواها الحالي المرفق مع الزر
+                markup = getattr(message, 'reply_markup', None)
+                current = render_digest(message.text, markup if isinstance(markup, InlineKeyboardMarkup) else None)
+            if current == digest:
+                self.rendered_messages.skipped += 1
+                self.rendered_messages.remember(key, digest)
+                return False
+        
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+        except BadRequest as e:
+            if 'message is not modified' not in str(e).lower():
+                if key:
+                    self.rendered_messages.forget(key)
+                raise
+            self.rendered_messages.skipped += 1
+            if key:
+                self.rendered_messages.remember(key, digest)
+            return False
         
-        if query.data == "main_menu":
-            await self.show_main_menu(query)
-        elif query.data == "create_deal":
-            await self.create_deal_callback(query, context)
-        elif query.data == "start_deal_creation":
-            await self.start_deal_creation(query, context)
-        elif query.data == "my_deals":
-            await self.show_my_deals(query, context)
-        elif query.data == "wallet":
-            await self.show_wallet(query, context)
-        elif query.data == "help":
-            await self.show_help(query)
-        elif query.data.startswith("buy_deal_"):
-            deal_id = query.data.replace("buy_deal_", "")
-            await self.initiate_purchase(query, context, deal_id)
-        elif query.data.startswith("confirm_payment_"):
-            deal_id = query.data.replace("confirm_payment_", "")
-            await self.confirm_payment_process(query, context, deal_id)
-        elif query.data.startswith("release_funds_"):
-            deal_id = query.data.replace("release_funds_", "")
-            await self.release_funds_process(query, context, deal_id)
-        elif query.data.startswith("dispute_"):
-            deal_id = query.data.replace("dispute_", "")
-            await self.create_dispute_process(query, context, deal_id)
-        elif query.data.startswith("confirm_delivery_"):
-            deal_id = query.data.replace("confirm_delivery_", "")
-            await self.confirm_delivery_process(query, context, deal_id)
-        elif query.data.startswith("pay_usdt_polygon_"):
-            deal_id = query.data.replace("pay_usdt_polygon_", "")
-            await self.process_payment(query, context, deal_id, "USDT", "POLYGON")
-        elif query.data.startswith("pay_usdt_eth_"):
-            deal_id = query.data.replace("pay_usdt_eth_", "")
-            await self.process_payment(query, context, deal_id, "USDT", "ETH")
-        elif query.data.startswith("pay_btc_"):
-            deal_id = query.data.replace("pay_btc_", "")
-            await self.process_payment(query, context, deal_id, "BTC", "BTC")
-        elif query.data.startswith("pay_checkout_"):
-            deal_id = query.data.replace("pay_checkout_", "")
-            await self.create_checkout_page(query, context, deal_id)
+        self.rendered_messages.edited += 1
+        if key:
+            self.rendered_messages.remember(key, digest)
+        return True
     
     async def show_main_menu(self, query):
         """عرض القائمة الرئيسية"""
-        keyboard = [
-            [InlineKeyboardButton("🆕 إنشاء صفقة جديدة", callback_data="create_deal")],
-            [InlineKeyboardButton("📋 صفقاتي", callback_data="my_deals")],
-            [InlineKeyboardButton("💰 محفظتي", callback_data="wallet")],
-            [InlineKeyboardButton("❓ المساعدة", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         text = """
 🏠 القائمة الرئيسية
 
 اختر الخدمة المطلوبة:
         """
         
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await self.edit_message(query, text, reply_markup=MAIN_MENU_MARKUP)
     
     async def create_deal_callback(self, query, context):
         """معالج إنشاء صفقة من الزر"""
-        keyboard = [
-            [InlineKeyboardButton("📝 بدء إنشاء الصفقة", callback_data="start_deal_creation")],
-            [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         text = """
 🆕 إنشاء صفقة جديدة
 
@@ -235,12 +339,11 @@ class OTCBot:
 اضغط "بدء إنشاء الصفقة" للمتابعة.
         """
         
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await self.edit_message(query, text, reply_markup=CREATE_DEAL_MARKUP)
     
     async def start_deal_creation(self, query, context):
         """بدء عملية إنشاء الصفقة"""
-        context.user_data['creating_deal'] = True
-        context.user_data['deal_step'] = 'title'
+        self.conversations.start(query.from_user.id, 'deal_creation', 'title')
         
         text = """
 📝 إنشاء صفقة جديدة - الخطوة 1/4
@@ -249,37 +352,32 @@ class OTCBot:
 (مثال: بيع حساب إنستغرام - 10K متابع)
         """
         
-        await query.edit_message_text(text)
+        await self.edit_message(query, text)
     
     async def show_my_deals(self, query, context):
         """عرض صفقات المستخدم"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deals = Deal.query.filter_by(seller_id=user_id).all()
-                
-                if not deals:
-                    text = "📋 لا توجد صفقات حالياً"
-                else:
-                    text = f"📋 صفقاتك ({len(deals)} صفقة):\n\n"
-                    for deal in deals[:5]:  # عرض أول 5 صفقات
-                        status_emoji = {
-                            'pending': '⏳',
-                            'paid': '💰',
-                            'confirmed': '✅',
-                            'completed': '🎉',
-                            'disputed': '⚠️'
-                        }.get(deal.status, '❓')
-                        
-                        text += f"{status_emoji} {deal.title}\n"
-                        text += f"   السعر: ${deal.price} | الإجمالي: ${deal.total_price}\n"
-                        text += f"   الحالة: {deal.status}\n\n"
-        
-        keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = "📋 لا توجد صفقات حالياً"
+        if self.repository:
+            total, deals = await self.repository.get_seller_deals(user_id, limit=5)  # عرض أول 5 صفقات
+            
+            if deals:
+                text = f"📋 صفقاتك ({total} صفقة):\n\n"
+                for deal in deals:
+                    status_emoji = {
+                        'pending': '⏳',
+                        'paid': '💰',
+                        'confirmed': '✅',
+                        'completed': '🎉',
+                        'disputed': '⚠️'
+                    }.get(deal.status, '❓')
+                    
+                    text += f"{status_emoji} {deal.title}\n"
+                    text += f"   السعر: ${deal.price} | الإجمالي: ${deal.total_price}\n"
+                    text += f"   الحالة: {deal.status}\n\n"
         
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await self.edit_message(query, text, reply_markup=BACK_TO_MENU_MARKUP)
     
     async def show_wallet(self, query, context):
         """عرض معلومات المحفظة"""
@@ -293,10 +391,7 @@ class OTCBot:
 • إعدادات الدفع
         """
         
-        keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await self.edit_message(query, text, reply_markup=BACK_TO_MENU_MARKUP)
     
     async def show_help(self, query):
         """عرض المساعدة"""
@@ -328,33 +423,29 @@ class OTCBot:
 للمساعدة الإضافية، تواصل مع الدعم الفني.
         """
         
-        keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="main_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(help_text, reply_markup=reply_markup)
+        await self.edit_message(query, help_text, reply_markup=BACK_TO_MENU_MARKUP)
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """معالج الرسائل النصية"""
-        if context.user_data.get('creating_deal'):
-            await self.handle_deal_creation(update, context)
+        conversation = await self.conversations.get(update.effective_user.id)
+        if conversation and conversation.flow == 'deal_creation':
+            await self.handle_deal_creation(update, context, conversation)
+        elif conversation and conversation.flow == 'dispute':
+            await self.handle_text_message(update, context, conversation)
         else:
             # رسالة افتراضية
-            keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await update.message.reply_text(
                 "استخدم الأزرار للتنقل في البوت، أو اكتب /start للعودة للقائمة الرئيسية.",
-                reply_markup=reply_markup
+                reply_markup=HOME_MARKUP
             )
     
-    async def handle_deal_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_deal_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE, conversation):
         """معالج إنشاء الصفقة خطوة بخطوة"""
-        step = context.user_data.get('deal_step')
+        step = conversation.step
         user_id = update.effective_user.id
         
         if step == 'title':
-            context.user_data['deal_title'] = update.message.text
-            context.user_data['deal_step'] = 'description'
+            self.conversations.update(user_id, 'description', title=update.message.text)
             
             await update.message.reply_text("""
 📝 إنشاء صفقة جديدة - الخطوة 2/4
@@ -364,8 +455,7 @@ class OTCBot:
             """)
             
         elif step == 'description':
-            context.user_data['deal_description'] = update.message.text
-            context.user_data['deal_step'] = 'price'
+            self.conversations.update(user_id, 'price', description=update.message.text)
             
             await update.message.reply_text("""
 💰 إنشاء صفقة جديدة - الخطوة 3/4
@@ -386,10 +476,8 @@ class OTCBot:
                 commission = price * 0.05
                 total_price = price + commission
                 
-                context.user_data['deal_price'] = price
-                context.user_data['deal_commission'] = commission
-                context.user_data['deal_total_price'] = total_price
-                context.user_data['deal_step'] = 'media'
+                self.conversations.update(user_id, 'media', price=price, commission=commission,
+                                          total_price=total_price)
                 
                 await update.message.reply_text(f"""
 📸 إنشاء صفقة جديدة - الخطوة 4/4
@@ -398,7 +486,7 @@ class OTCBot:
 العمولة (5%): ${commission:.2f}
 السعر الإجمالي: ${total_price:.2f}
 
-أرسل صور أو فيديوهات للمنتج (اختياري)
+أرسل صور أو فيديوهات للمنتج (اختياري، حتى 10 في ألبوم واحد)
 أو اكتب "تخطي" للمتابعة بدون وسائط.
                 """)
                 
@@ -406,49 +494,63 @@ class OTCBot:
                 await update.message.reply_text("يرجى إدخال رقم صحيح للسعر.")
                 
         elif step == 'media':
-            if update.message.text and update.message.text.lower() == 'تخطي':
-                context.user_data['deal_media'] = None
-            else:
-                # معالجة الوسائط (الصور والفيديوهات)
-                media_info = []
-                if update.message.photo:
-                    photo = update.message.photo[-1]  # أعلى جودة
-                    media_info.append({
-                        'type': 'photo',
-                        'file_id': photo.file_id
-                    })
-                elif update.message.video:
-                    media_info.append({
-                        'type': 'video',
-                        'file_id': update.message.video.file_id
-                    })
-                
-                context.user_data['deal_media'] = json.dumps(media_info) if media_info else None
+            # الصور والفيديوهات تصل إلى handle_media، وأي نص هنا يعني المتابعة بدون وسائط
+            await self.complete_deal_creation(context, update.effective_chat.id, user_id, None)
+    
+    async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """معالج الصور والفيديوهات في خطوة الوسائط، مع تجميع أجزاء الألبوم"""
+        user_id = update.effective_user.id
+        conversation = await self.conversations.get(user_id)
+        if not conversation or conversation.flow != 'deal_creation' or conversation.step != 'media':
+            return
+        
+        message = update.message
+        if message.photo:
+            item = {'type': 'photo', 'file_id': message.photo[-1].file_id}  # أعلى جودة
+        else:
+            item = {'type': 'video', 'file_id': message.video.file_id}
+        
+        chat_id = update.effective_chat.id
+        
+        async def complete(media_info):
+            await self.complete_deal_creation(context, chat_id, user_id, json.dumps(media_info))
+        
+        if message.media_group_id:
+            self.media_groups.add((user_id, message.media_group_id), item, complete)
+        else:
+            await complete([item])
+    
+    async def complete_deal_creation(self, context, chat_id, user_id, media_files):
+        """إنشاء الصفقة في نهاية الخطوات"""
+        conversation = await self.conversations.get(user_id)
+        if not conversation or conversation.flow != 'deal_creation' or conversation.step != 'media':
+            return
+        
+        data = dict(conversation.data)
+        # مسح بيانات إنشاء الصفقة قبل الإنشاء حتى لا تُنشأ مرتين (رسالة وألبوم معاً مثلاً)
+        self.conversations.finish(user_id)
+        
+        # إنشاء الصفقة في قاعدة البيانات
+        if self.repository:
+            deal = await self.repository.create_deal(
+                seller_id=user_id,
+                title=data['title'],
+                description=data['description'],
+                price=data['price'],
+                commission=data['commission'],
+                total_price=data['total_price'],
+                media_files=media_files
+            )
             
-            # إنشاء الصفقة في قاعدة البيانات
-            if self.flask_app:
-                with self.flask_app.app_context():
-                    deal = Deal(
-                        seller_id=user_id,
-                        title=context.user_data['deal_title'],
-                        description=context.user_data['deal_description'],
-                        price=context.user_data['deal_price'],
-                        commission=context.user_data['deal_commission'],
-                        total_price=context.user_data['deal_total_price'],
-                        media_files=context.user_data.get('deal_media')
-                    )
-                    deal_db.session.add(deal)
-                    deal_db.session.commit()
-                    
-                    deal_link = f"https://t.me/{context.bot.username}?start=deal_{deal.id}"
-                    
-                    keyboard = [
-                        [InlineKeyboardButton("📋 عرض صفقاتي", callback_data="my_deals")],
-                        [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    success_text = f"""
+            deal_link = f"https://t.me/{context.bot.username}?start=deal_{deal.id}"
+            
+            keyboard = [
+                [InlineKeyboardButton("📋 عرض صفقاتي", callback_data="my_deals")],
+                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            success_text = f"""
 ✅ تم إنشاء الصفقة بنجاح!
 
 📋 تفاصيل الصفقة:
@@ -456,130 +558,115 @@ class OTCBot:
 السعر الأساسي: ${deal.price:.2f}
 العمولة: ${deal.commission:.2f}
 السعر الإجمالي: ${deal.total_price:.2f}
+📸 الوسائط: {len(json.loads(media_files)) if media_files else 0}
 
 🔗 رابط الصفقة:
 {deal_link}
 
 شارك هذا الرابط مع المشتري لإتمام الصفقة.
-                    """
-                    
-                    await update.message.reply_text(success_text, reply_markup=reply_markup)
+            """
             
-            # مسح بيانات إنشاء الصفقة
-            context.user_data.pop('creating_deal', None)
-            context.user_data.pop('deal_step', None)
-            for key in list(context.user_data.keys()):
-                if key.startswith('deal_'):
-                    context.user_data.pop(key, None)
+            await context.bot.send_message(chat_id=chat_id, text=success_text, reply_markup=reply_markup)
     
     async def show_deal_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE, deal_id: str):
         """عرض تفاصيل الصفقة للمشتري المحتمل"""
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await update.message.reply_text("❌ الصفقة غير موجودة أو تم حذفها.")
-                    return
-                
-                seller = TelegramUser.query.filter_by(telegram_id=deal.seller_id).first()
-                seller_name = seller.first_name if seller else "غير معروف"
-                
-                # تحديد حالة الصفقة
-                status_text = {
-                    'pending': '⏳ في انتظار المشتري',
-                    'paid': '💰 تم الدفع - في انتظار التأكيد',
-                    'confirmed': '✅ تم التأكيد - في انتظار التحرير',
-                    'completed': '🎉 مكتملة',
-                    'disputed': '⚠️ نزاع مفتوح'
-                }.get(deal.status, '❓ غير معروف')
-                
-                deal_text = f"""
-📦 تفاصيل الصفقة
-
-🏷️ العنوان: {deal.title}
-📝 الوصف: {deal.description}
-
-💰 السعر الأساسي: ${deal.price:.2f}
-💵 العمولة (5%): ${deal.commission:.2f}
-💳 السعر الإجمالي: ${deal.total_price:.2f}
-
-👤 البائع: {seller_name}
-📊 الحالة: {status_text}
-📅 تاريخ الإنشاء: {deal.created_at.strftime('%Y-%m-%d %H:%M') if deal.created_at else 'غير محدد'}
-                """
-                
-                keyboard = []
-                user_id = update.effective_user.id
-                
-                # إذا كان المستخدم هو البائع
-                if user_id == deal.seller_id:
-                    if deal.status == 'paid':
-                        keyboard.append([InlineKeyboardButton("✅ تأكيد إرسال المنتج", callback_data=f"confirm_delivery_{deal_id}")])
-                    keyboard.append([InlineKeyboardButton("📋 إدارة الصفقة", callback_data="my_deals")])
-                
-                # إذا كان المستخدم مشتري محتمل أو المشتري الحالي
-                elif deal.status == 'pending':
-                    keyboard.append([InlineKeyboardButton("🛒 شراء الآن", callback_data=f"buy_deal_{deal_id}")])
-                elif user_id == deal.buyer_id:
-                    if deal.status == 'paid':
-                        keyboard.append([InlineKeyboardButton("⏳ في انتظار تأكيد البائع", callback_data="waiting")])
-                    elif deal.status == 'confirmed':
-                        keyboard.append([InlineKeyboardButton("💰 تحرير الأموال", callback_data=f"release_funds_{deal_id}")])
-                        keyboard.append([InlineKeyboardButton("⚠️ فتح نزاع", callback_data=f"dispute_{deal_id}")])
-                
-                keyboard.append([InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # إرسال الوسائط إذا كانت متوفرة
-                if deal.media_files:
-                    try:
-                        media_data = json.loads(deal.media_files)
-                        for media in media_data:
-                            if media['type'] == 'photo':
-                                await context.bot.send_photo(
-                                    chat_id=update.effective_chat.id,
-                                    photo=media['file_id']
-                                )
-                            elif media['type'] == 'video':
-                                await context.bot.send_video(
-                                    chat_id=update.effective_chat.id,
-                                    video=media['file_id']
-                                )
-                    except:
-                        pass
-                
-                await update.message.reply_text(deal_text, reply_markup=reply_markup)
+        if self.repository:
+            # البطاقة (النص والوسائط واسم البائع) تأتي من الذاكرة المؤقتة للصفقات المشهورة
+            card = await self.repository.get_deal_card(deal_id)
+            if not card:
+                await update.message.reply_text("❌ الصفقة غير موجودة أو تم حذفها.")
+                return
+            
+            keyboard = []
+            user_id = update.effective_user.id
+            
+            # إذا كان المستخدم هو البائع
+            if user_id == card.seller_id:
+                if card.status == 'paid':
+                    keyboard.append([InlineKeyboardButton("✅ تأكيد إرسال المنتج", callback_data=encode_callback("confirm_delivery", deal_id))])
+                keyboard.append([InlineKeyboardButton("📋 إدارة الصفقة", callback_data="my_deals")])
+            
+            # إذا كان المستخدم مشتري محتمل أو المشتري الحالي
+            elif card.status == 'pending':
+                keyboard.append([InlineKeyboardButton("🛒 شراء الآن", callback_data=encode_callback("buy_deal", deal_id))])
+            elif user_id == card.buyer_id:
+                if card.status == 'paid':
+                    keyboard.append([InlineKeyboardButton("⏳ في انتظار تأكيد البائع", callback_data="waiting")])
+                elif card.status == 'confirmed':
+                    keyboard.append([InlineKeyboardButton("💰 تحرير الأموال", callback_data=encode_callback("release_funds", deal_id))])
+                    keyboard.append([InlineKeyboardButton("⚠️ فتح نزاع", callback_data=encode_callback("dispute", deal_id))])
+            
+            keyboard.append([InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            # إرسال الوسائط: الألبوم كاملاً في طلب واحد بدلاً من طلب لكل عنصر
+            try:
+                await self.send_deal_media(context.bot, update.effective_chat.id, card.media)
+            except Exception as e:
+                logger.warning(f"Error sending deal media: {e}")
+            
+            await update.message.reply_text(card.text, reply_markup=reply_markup)
+    
+    @staticmethod
+    async def send_deal_media(bot, chat_id, media):
+        """إرسال وسائط الصفقة: send_media_group للألبوم، أو طلب واحد لعنصر واحد"""
+        if not media:
+            return
+        
+        if len(media) == 1:
+            media_type, file_id = media[0]
+            if media_type == 'photo':
+                await bot.send_photo(chat_id=chat_id, photo=file_id)
+            elif media_type == 'video':
+                await bot.send_video(chat_id=chat_id, video=file_id)
+            return
+        
+        album = [
+            InputMediaPhoto(file_id) if media_type == 'photo' else InputMediaVideo(file_id)
+            for media_type, file_id in media[:MAX_MEDIA_GROUP_SIZE]
+            if media_type in ('photo', 'video')
+        ]
+        await bot.send_media_group(chat_id=chat_id, media=album)
+    
+    async def show_deal_callback(self, query, context, deal_id):
+        """عرض بطاقة الصفقة من زر (مثل إلغاء فتح النزاع)"""
+        if self.repository:
+            card = await self.repository.get_deal_card(deal_id)
+            if not card:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            await self.edit_message(query, card.text, reply_markup=HOME_MARKUP)
     
     async def initiate_purchase(self, query, context, deal_id):
         """بدء عملية الشراء"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                if deal.status != 'pending':
-                    await query.edit_message_text("❌ هذه الصفقة غير متاحة للشراء حالياً.")
-                    return
-                
-                if user_id == deal.seller_id:
-                    await query.edit_message_text("❌ لا يمكنك شراء صفقتك الخاصة.")
-                    return
-                
-                # إنشاء أزرار اختيار طريقة الدفع
-                keyboard = [
-                    [InlineKeyboardButton("💳 USDT (Polygon)", callback_data=f"pay_usdt_polygon_{deal_id}")],
-                    [InlineKeyboardButton("💳 USDT (Ethereum)", callback_data=f"pay_usdt_eth_{deal_id}")],
-                    [InlineKeyboardButton("₿ Bitcoin", callback_data=f"pay_btc_{deal_id}")],
-                    [InlineKeyboardButton("🔄 صفحة دفع متقدمة", callback_data=f"pay_checkout_{deal_id}")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                purchase_text = f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            if deal.status != 'pending':
+                await self.edit_message(query, "❌ هذه الصفقة غير متاحة للشراء حالياً.")
+                return
+            
+            if user_id == deal.seller_id:
+                await self.edit_message(query, "❌ لا يمكنك شراء صفقتك الخاصة.")
+                return
+            
+            # إنشاء أزرار اختيار طريقة الدفع
+            keyboard = [
+                [InlineKeyboardButton("💳 USDT (Polygon)", callback_data=encode_callback("pay_usdt_polygon", deal_id))],
+                [InlineKeyboardButton("💳 USDT (Ethereum)", callback_data=encode_callback("pay_usdt_eth", deal_id))],
+                [InlineKeyboardButton("₿ Bitcoin", callback_data=encode_callback("pay_btc", deal_id))],
+                [InlineKeyboardButton("🔄 صفحة دفع متقدمة", callback_data=encode_callback("pay_checkout", deal_id))],
+                [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            purchase_text = f"""
 🛒 تأكيد الشراء
 
 📦 المنتج: {deal.title}
@@ -593,28 +680,30 @@ class OTCBot:
 • أموالك محمية في محفظة آمنة
 • لن يتم تحرير الأموال إلا بعد تأكيد الاستلام
 • يمكنك فتح نزاع في حالة وجود مشكلة
-                """
-                
-                await query.edit_message_text(purchase_text, reply_markup=reply_markup)
+            """
+            
+            await self.edit_message(query, purchase_text, reply_markup=reply_markup)
     
     async def confirm_payment_process(self, query, context, deal_id):
         """تأكيد الدفع من المشتري"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                # تحديث الصفقة
-                deal.buyer_id = user_id
-                deal.status = 'paid'
-                deal_db.session.commit()
-                
-                # إشعار المشتري
-                await query.edit_message_text(f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            # تحديث الصفقة وإشعار البائع في نفس المعاملة
+            deal = await self.repository.update_deal(deal_id, buyer_id=user_id, status='paid',
+                                                     notify=('seller_payment_received',))
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            self.notifications.wake()
+            
+            # إشعار المشتري
+            await self.edit_message(query, f"""
 ✅ تم تأكيد الدفع بنجاح!
 
 📦 الصفقة: {deal.title}
@@ -624,61 +713,35 @@ class OTCBot:
 سيتم إشعارك عند تأكيد الإرسال.
 
 🔒 أموالك محمية في محفظة البوت حتى تأكيد الاستلام.
-                """)
-                
-                # إشعار البائع
-                try:
-                    seller = TelegramUser.query.filter_by(telegram_id=deal.seller_id).first()
-                    buyer = TelegramUser.query.filter_by(telegram_id=user_id).first()
-                    buyer_name = buyer.first_name if buyer else "مشتري"
-                    
-                    seller_keyboard = [
-                        [InlineKeyboardButton("✅ تأكيد الإرسال", callback_data=f"confirm_delivery_{deal_id}")],
-                        [InlineKeyboardButton("📋 عرض الصفقة", callback_data="my_deals")]
-                    ]
-                    seller_reply_markup = InlineKeyboardMarkup(seller_keyboard)
-                    
-                    await context.bot.send_message(
-                        chat_id=deal.seller_id,
-                        text=f"""
-🔔 إشعار جديد - تم الدفع!
-
-📦 الصفقة: {deal.title}
-👤 المشتري: {buyer_name}
-💰 المبلغ: ${deal.total_price:.2f}
-
-✅ تم تأكيد الدفع من المشتري.
-يرجى إرسال المنتج/الخدمة ثم الضغط على "تأكيد الإرسال".
-                        """,
-                        reply_markup=seller_reply_markup
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending notification to seller: {e}")
+            """)
     
     async def release_funds_process(self, query, context, deal_id):
         """تحرير الأموال من المشتري"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                if deal.buyer_id != user_id:
-                    await query.edit_message_text("❌ غير مصرح لك بهذا الإجراء.")
-                    return
-                
-                if deal.status != 'confirmed':
-                    await query.edit_message_text("❌ لا يمكن تحرير الأموال في هذه المرحلة.")
-                    return
-                
-                # تحديث حالة الصفقة
-                deal.status = 'completed'
-                deal_db.session.commit()
-                
-                await query.edit_message_text(f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            if deal.buyer_id != user_id:
+                await self.edit_message(query, "❌ غير مصرح لك بهذا الإجراء.")
+                return
+            
+            if deal.status != 'confirmed':
+                await self.edit_message(query, "❌ لا يمكن تحرير الأموال في هذه المرحلة.")
+                return
+            
+            # تحديث حالة الصفقة (فقط إذا لم تتغير حالتها منذ القراءة)
+            deal = await self.repository.update_deal(deal_id, expected_status='confirmed', status='completed',
+                                                     notify=('seller_funds_released',))
+            if not deal:
+                await self.edit_message(query, "❌ لا يمكن تحرير الأموال في هذه المرحلة.")
+                return
+            self.notifications.wake()
+            
+            await self.edit_message(query, f"""
 🎉 تم تحرير الأموال بنجاح!
 
 📦 الصفقة: {deal.title}
@@ -687,46 +750,31 @@ class OTCBot:
 
 ✅ تم إتمام الصفقة بنجاح.
 شكراً لاستخدام خدمة الوساطة الآمنة!
-                """)
-                
-                # إشعار البائع
-                try:
-                    await context.bot.send_message(
-                        chat_id=deal.seller_id,
-                        text=f"""
-🎉 تهانينا! تم إتمام الصفقة بنجاح
-
-📦 الصفقة: {deal.title}
-💰 المبلغ المستلم: ${deal.price:.2f}
-💵 العمولة المخصومة: ${deal.commission:.2f}
-
-✅ تم تحرير الأموال من المشتري.
-المبلغ سيصل إلى محفظتك قريباً.
-                        """
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending completion notification to seller: {e}")
+            """)
     
     async def create_dispute_process(self, query, context, deal_id):
         """فتح نزاع على الصفقة"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                if user_id != deal.seller_id and user_id != deal.buyer_id:
-                    await query.edit_message_text("❌ غير مصرح لك بهذا الإجراء.")
-                    return
-                
-                # تحديث حالة الصفقة
-                deal.status = 'disputed'
-                deal_db.session.commit()
-                
-                await query.edit_message_text(f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            if user_id != deal.seller_id and user_id != deal.buyer_id:
+                await self.edit_message(query, "❌ غير مصرح لك بهذا الإجراء.")
+                return
+            
+            # تحديث حالة الصفقة وإشعار الطرف الآخر
+            deal = await self.repository.update_deal(deal_id, status='disputed', notify=('dispute_created',),
+                                                     notify_params={'reporter_id': user_id})
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            self.notifications.wake()
+            
+            await self.edit_message(query, f"""
 ⚠️ تم فتح نزاع على الصفقة
 
 📦 الصفقة: {deal.title}
@@ -736,50 +784,35 @@ class OTCBot:
 سيتم التواصل معك من فريق الدعم قريباً.
 
 📞 للمساعدة العاجلة، تواصل مع الدعم الفني.
-                """)
-                
-                # إشعار الطرف الآخر
-                other_party_id = deal.seller_id if user_id == deal.buyer_id else deal.buyer_id
-                try:
-                    await context.bot.send_message(
-                        chat_id=other_party_id,
-                        text=f"""
-⚠️ تم فتح نزاع على إحدى صفقاتك
-
-📦 الصفقة: {deal.title}
-💰 المبلغ: ${deal.total_price:.2f}
-
-🔒 تم تجميد الأموال حتى حل النزاع.
-سيتم التواصل معك من فريق الدعم قريباً.
-                        """
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending dispute notification: {e}")
+            """)
     
     async def confirm_delivery_process(self, query, context, deal_id):
         """تأكيد التسليم من البائع"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                if deal.seller_id != user_id:
-                    await query.edit_message_text("❌ غير مصرح لك بهذا الإجراء.")
-                    return
-                
-                if deal.status != 'paid':
-                    await query.edit_message_text("❌ لا يمكن تأكيد التسليم في هذه المرحلة.")
-                    return
-                
-                # تحديث حالة الصفقة
-                deal.status = 'confirmed'
-                deal_db.session.commit()
-                
-                await query.edit_message_text(f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            if deal.seller_id != user_id:
+                await self.edit_message(query, "❌ غير مصرح لك بهذا الإجراء.")
+                return
+            
+            if deal.status != 'paid':
+                await self.edit_message(query, "❌ لا يمكن تأكيد التسليم في هذه المرحلة.")
+                return
+            
+            # تحديث حالة الصفقة (فقط إذا لم تتغير حالتها منذ القراءة)
+            deal = await self.repository.update_deal(deal_id, expected_status='paid', status='confirmed',
+                                                     notify=('delivery_confirmed',))
+            if not deal:
+                await self.edit_message(query, "❌ لا يمكن تأكيد التسليم في هذه المرحلة.")
+                return
+            self.notifications.wake()
+            
+            await self.edit_message(query, f"""
 ✅ تم تأكيد التسليم بنجاح!
 
 📦 الصفقة: {deal.title}
@@ -787,66 +820,28 @@ class OTCBot:
 
 ⏳ تم إشعار المشتري بالتسليم.
 في انتظار تأكيد الاستلام وتحرير الأموال.
-                """)
-                
-                # إشعار المشتري
-                try:
-                    buyer_keyboard = [
-                        [InlineKeyboardButton("💰 تحرير الأموال", callback_data=f"release_funds_{deal_id}")],
-                        [InlineKeyboardButton("⚠️ فتح نزاع", callback_data=f"dispute_{deal_id}")]
-                    ]
-                    buyer_reply_markup = InlineKeyboardMarkup(buyer_keyboard)
-                    
-                    await context.bot.send_message(
-                        chat_id=deal.buyer_id,
-                        text=f"""
-📦 تم تأكيد إرسال المنتج!
-
-🏷️ الصفقة: {deal.title}
-💰 المبلغ: ${deal.total_price:.2f}
-
-✅ أكد البائع إرسال المنتج/الخدمة.
-يرجى التحقق من الاستلام ثم:
-
-• إذا كان كل شيء صحيح: اضغط "تحرير الأموال"
-• إذا كان هناك مشكلة: اضغط "فتح نزاع"
-
-🔒 أموالك محمية حتى تأكيد الاستلام.
-                        """,
-                        reply_markup=buyer_reply_markup
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending delivery confirmation to buyer: {e}")
+            """)
     
     async def process_payment(self, query, context, deal_id, coin_type, network):
         """معالجة الدفع بعملة محددة"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            try:
+                # إنشاء عنوان الدفع مباشرة داخل نفس العملية
+                payment_service = AsyncPaymentService(get_address_pool(), get_payment_monitor(),
+                                                      run_db=self.repository.run)
+                result = await payment_service.create_payment(deal_id, coin_type, network)
                 
-                try:
-                    # استدعاء API لإنشاء عنوان الدفع
-                    import requests
+                if result.get('success'):
+                    payment_info = result['payment_info']
                     
-                    api_url = f"http://localhost:5000/api/payments/create"
-                    payload = {
-                        'deal_id': deal_id,
-                        'coin_type': coin_type,
-                        'network': network
-                    }
-                    
-                    response = requests.post(api_url, json=payload, timeout=10)
-                    result = response.json()
-                    
-                    if result.get('success'):
-                        payment_info = result['payment_info']
-                        
-                        payment_text = f"""
+                    payment_text = f"""
 💳 تفاصيل الدفع - {coin_type} ({network})
 
 📦 الصفقة: {deal.title}
@@ -862,51 +857,47 @@ class OTCBot:
 4. اضغط "تأكيد الدفع" بعد الإرسال
 
 🔒 أموالك محمية حتى تأكيد الاستلام!
-                        """
-                        
-                        keyboard = [
-                            [InlineKeyboardButton("✅ تأكيد الدفع", callback_data=f"confirm_payment_{deal_id}")],
-                            [InlineKeyboardButton("🔄 طريقة دفع أخرى", callback_data=f"buy_deal_{deal_id}")],
-                            [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        await query.edit_message_text(payment_text, reply_markup=reply_markup, parse_mode='Markdown')
-                        
-                    else:
-                        await query.edit_message_text(f"❌ خطأ في إنشاء عنوان الدفع: {result.get('error', 'خطأ غير معروف')}")
-                        
-                except Exception as e:
-                    logger.error(f"Error processing payment: {e}")
-                    await query.edit_message_text("❌ خطأ في معالجة الدفع. يرجى المحاولة مرة أخرى.")
+                    """
+                    
+                    keyboard = [
+                        [InlineKeyboardButton("✅ تأكيد الدفع", callback_data=encode_callback("confirm_payment", deal_id))],
+                        [InlineKeyboardButton("🔄 طريقة دفع أخرى", callback_data=encode_callback("buy_deal", deal_id))],
+                        [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
+                    ]
+                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    
+                    await self.edit_message(query, payment_text, reply_markup=reply_markup, parse_mode='Markdown')
+                    
+                else:
+                    await self.edit_message(query, f"❌ خطأ في إنشاء عنوان الدفع: {result.get('error', 'خطأ غير معروف')}")
+                    
+            except Exception as e:
+                logger.error(f"Error processing payment: {e}")
+                await self.edit_message(query, "❌ خطأ في معالجة الدفع. يرجى المحاولة مرة أخرى.")
     
     async def create_checkout_page(self, query, context, deal_id):
         """إنشاء صفحة دفع متقدمة"""
         user_id = query.from_user.id
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            try:
+                # إنشاء صفحة الدفع مباشرة داخل نفس العملية
+                bot_username = context.bot.username
+                result = await AsyncPaymentService(run_db=self.repository.run).create_checkout(
+                    deal_id,
+                    return_url=f"https://t.me/{bot_username}/success",
+                    cancel_url=f"https://t.me/{bot_username}/cancel"
+                )
                 
-                try:
-                    # استدعاء API لإنشاء صفحة الدفع
-                    import requests
-                    
-                    api_url = f"http://localhost:5000/api/payments/checkout"
-                    payload = {
-                        'deal_id': deal_id
-                    }
+                if result.get('success'):
+                    checkout_url = result['checkout_url']
                     
-                    response = requests.post(api_url, json=payload, timeout=10)
-                    result = response.json()
-                    
-                    if result.get('success'):
-                        checkout_url = result['checkout_url']
-                        
-                        checkout_text = f"""
+                    checkout_text = f"""
 🔄 صفحة الدفع المتقدمة
 
 📦 الصفقة: {deal.title}
@@ -918,101 +909,179 @@ class OTCBot:
 • الحصول على أسعار صرف محدثة
 
 👆 اضغط على الرابط أدناه لإتمام الدفع:
-                        """
-                        
-                        keyboard = [
-                            [InlineKeyboardButton("💳 فتح صفحة الدفع", url=checkout_url)],
-                            [InlineKeyboardButton("✅ تأكيد الدفع", callback_data=f"confirm_payment_{deal_id}")],
-                            [InlineKeyboardButton("🔙 العودة", callback_data=f"buy_deal_{deal_id}")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        await query.edit_message_text(checkout_text, reply_markup=reply_markup)
-                        
-                    else:
-                        await query.edit_message_text(f"❌ خطأ في إنشاء صفحة الدفع: {result.get('error', 'خطأ غير معروف')}")
-                        
-                except Exception as e:
-                    logger.error(f"Error creating checkout page: {e}")
-                    await query.edit_message_text("❌ خطأ في إنشاء صفحة الدفع. يرجى المحاولة مرة أخرى.")
+                    """
+                    
+                    keyboard = [
+                        [InlineKeyboardButton("💳 فتح صفحة الدفع", url=checkout_url)],
+                        [InlineKeyboardButton("✅ تأكيد الدفع", callback_data=encode_callback("confirm_payment", deal_id))],
+                        [InlineKeyboardButton("🔙 العودة", callback_data=encode_callback("buy_deal", deal_id))]
+                    ]
+                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    
+                    await self.edit_message(query, checkout_text, reply_markup=reply_markup)
+                    
+                else:
+                    await self.edit_message(query, f"❌ خطأ في إنشاء صفحة الدفع: {result.get('error', 'خطأ غير معروف')}")
+                    
+            except Exception as e:
+                logger.error(f"Error creating checkout page: {e}")
+                await self.edit_message(query, "❌ خطأ في إنشاء صفحة الدفع. يرجى المحاولة مرة أخرى.")
     
-    def run(self):
-        """تشغيل البوت"""
+    def run(self, mode='polling', webhook_url=None, webhook_secret=None, from_inbox=False):
+        """تشغيل البوت (polling أو webhook)
+
+        from_inbox: التحديثات تصل إلى عملية مستقبل منفصلة وتُقرأ من صندوق الوارد.
+        """
+        if mode == 'webhook':
+            self.run_webhook(webhook_url, webhook_secret, from_inbox)
+            return
+        
         logger.info("بدء تشغيل البوت...")
-        self.application.run_polling()
+        self.mode = 'polling'
+        # إشارات الإيقاف متاحة فقط في الـ thread الرئيسي
+        if threading.current_thread() is threading.main_thread():
+            self.application.run_polling()
+        else:
+            self.application.run_polling(stop_signals=None)
+    
+    def run_webhook(self, webhook_url, webhook_secret, from_inbox=False):
+        """تشغيل معالجات البوت على طابور التحديثات، والتحديثات تصل عبر مسار webhook في Flask
 
-if __name__ == "__main__":
-    # يجب وضع توكن البوت هنا
-    BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
+        مع from_inbox يعمل المسار في عملية أخرى ويحفظ التحديثات في صندوق الوارد،
+        وهنا تُنقل إلى الطابور بقدر المساحة الفارغة فيه.
+        """
+        logger.info(f"بدء تشغيل البوت بوضع webhook: {webhook_url}")
+        self.mode = 'webhook'
+        self.webhook_secret = webhook_secret
+        if from_inbox and self.repository:
+            self.update_inbox = UpdateInboxReader(self.application, self.repository)
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.loop = loop
+        
+        try:
+            loop.run_until_complete(self._start_webhook(webhook_url))
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(self._stop_webhook())
+            loop.close()
     
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("يرجى وضع توكن البوت في المتغير BOT_TOKEN")
-        sys.exit(1)
+    async def _start_webhook(self, webhook_url):
+        await self.application.initialize()
+        await self._post_init(self.application)
+        await self.application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=self.webhook_secret,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await self.application.start()
+        if self.update_inbox:
+            self.update_inbox.start()
     
-    bot = OTCBot(BOT_TOKEN)
-    bot.run()
-
+    async def _stop_webhook(self):
+        if self.update_inbox:
+            await self.update_inbox.stop()
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        await self._post_shutdown(self.application)
+    
+    def stop_webhook(self):
+        """إيقاف وضع webhook من thread آخر"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+    
+    def is_accepting_updates(self):
+        """هل يمكن استقبال تحديثات webhook الآن"""
+        return self.mode == 'webhook' and self.loop is not None and self.application.running
+    
+    def submit_update(self, data, timeout=5.0):
+        """إضافة تحديث webhook إلى طابور البوت من thread آخر
 
-    async def handle_dispute(self, query, context):
+        ينتظر حتى timeout إذا كان الطابور ممتلئاً، ويرجع False إذا بقي ممتلئاً
+        حتى يرد المسار بخطأ ويعيد Telegram إرسال التحديث لاحقاً.
+        """
+        update = Update.de_json(data, self.application.bot)
+        future = asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+        try:
+            future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self.updates_rejected += 1
+            return False
+        
+        self.updates_accepted += 1
+        return True
+    
+    def get_update_queue_stats(self):
+        """حالة طابور التحديثات"""
+        return {
+            'mode': self.mode,
+            'queue_size': self.application.update_queue.qsize(),
+            'max_size': self.update_queue_size,
+            'accepted': self.updates_accepted,
+            'rejected': self.updates_rejected,
+            'update_inbox': self.update_inbox.get_stats() if self.update_inbox else None,
+            'processor': self.update_processor.get_stats(),
+            'loop_lag': self.loop_lag_monitor.get_stats(),
+            'repository': self.repository.get_stats() if self.repository else None,
+            'user_cache': self.user_cache.get_stats() if self.user_cache else None,
+            'deal_cards': self.repository.get_deal_card_stats() if self.repository else None,
+            'conversations': self.conversations.get_stats(),
+            'media_groups': self.media_groups.get_stats(),
+            'rate_limiter': self.rate_limiter.get_stats(),
+            'broadcasts': self.broadcasts.get_stats() if self.broadcasts else None,
+            'notifications': self.notifications.get_stats() if self.notifications else None,
+            'rendered_messages': self.rendered_messages.get_stats()
+        }
+    
+    async def handle_dispute(self, query, context, deal_id):
         """معالج فتح النزاعات"""
         user_id = query.from_user.id
-        deal_id = query.data.split('_')[1]
         
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.get(deal_id)
-                if not deal:
-                    await query.edit_message_text("❌ الصفقة غير موجودة.")
-                    return
-                
-                # التحقق من أن المستخدم طرف في الصفقة
-                if user_id not in [deal.seller_id, deal.buyer_id]:
-                    await query.edit_message_text("❌ غير مسموح لك بفتح نزاع على هذه الصفقة.")
-                    return
-                
-                # عرض أسباب النزاع
-                keyboard = [
-                    [InlineKeyboardButton("لم أستلم المنتج", callback_data=f"dispute_reason_not_received_{deal_id}")],
-                    [InlineKeyboardButton("المنتج مختلف", callback_data=f"dispute_reason_wrong_item_{deal_id}")],
-                    [InlineKeyboardButton("المنتج تالف", callback_data=f"dispute_reason_damaged_item_{deal_id}")],
-                    [InlineKeyboardButton("المنتج مزيف", callback_data=f"dispute_reason_fake_item_{deal_id}")],
-                    [InlineKeyboardButton("مشكلة في الدفع", callback_data=f"dispute_reason_payment_issue_{deal_id}")],
-                    [InlineKeyboardButton("البائع لا يرد", callback_data=f"dispute_reason_seller_unresponsive_{deal_id}")],
-                    [InlineKeyboardButton("محاولة احتيال", callback_data=f"dispute_reason_scam_attempt_{deal_id}")],
-                    [InlineKeyboardButton("أخرى", callback_data=f"dispute_reason_other_{deal_id}")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data=f"view_deal_{deal_id}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                dispute_text = f"""
+        if self.repository:
+            deal = await self.repository.get_deal(deal_id)
+            if not deal:
+                await self.edit_message(query, "❌ الصفقة غير موجودة.")
+                return
+            
+            # التحقق من أن المستخدم طرف في الصفقة
+            if user_id not in [deal.seller_id, deal.buyer_id]:
+                await self.edit_message(query, "❌ غير مسموح لك بفتح نزاع على هذه الصفقة.")
+                return
+            
+            # عرض أسباب النزاع
+            keyboard = [
+                [InlineKeyboardButton("لم أستلم المنتج", callback_data=encode_callback("dispute_reason", deal_id, "not_received"))],
+                [InlineKeyboardButton("المنتج مختلف", callback_data=encode_callback("dispute_reason", deal_id, "wrong_item"))],
+                [InlineKeyboardButton("المنتج تالف", callback_data=encode_callback("dispute_reason", deal_id, "damaged_item"))],
+                [InlineKeyboardButton("المنتج مزيف", callback_data=encode_callback("dispute_reason", deal_id, "fake_item"))],
+                [InlineKeyboardButton("مشكلة في الدفع", callback_data=encode_callback("dispute_reason", deal_id, "payment_issue"))],
+                [InlineKeyboardButton("البائع لا يرد", callback_data=encode_callback("dispute_reason", deal_id, "seller_unresponsive"))],
+                [InlineKeyboardButton("محاولة احتيال", callback_data=encode_callback("dispute_reason", deal_id, "scam_attempt"))],
+                [InlineKeyboardButton("أخرى", callback_data=encode_callback("dispute_reason", deal_id, "other"))],
+                [InlineKeyboardButton("❌ إلغاء", callback_data=encode_callback("view_deal", deal_id))]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            dispute_text = f"""
 ⚠️ فتح نزاع
 
 📦 الصفقة: {deal.title}
 💰 المبلغ: ${deal.total_price:.2f}
 
 اختر سبب النزاع:
-                """
-                
-                await query.edit_message_text(dispute_text, reply_markup=reply_markup)
+            """
+            
+            await self.edit_message(query, dispute_text, reply_markup=reply_markup)
     
-    async def handle_dispute_reason(self, query, context):
+    async def handle_dispute_reason(self, query, context, reason, deal_id):
         """معالج اختيار سبب النزاع"""
         user_id = query.from_user.id
-        data_parts = query.data.split('_')
-        reason = data_parts[2]
-        deal_id = data_parts[3]
         
         # حفظ بيانات النزاع في حالة المستخدم
-        if not hasattr(self, 'user_states'):
-            self.user_states = {}
-        
-        self.user_states[user_id] = {
-            'state': 'waiting_dispute_description',
-            'data': {
-                'deal_id': deal_id,
-                'reason': reason
-            }
-        }
+        self.conversations.start(user_id, 'dispute', 'description', deal_id=deal_id, reason=reason)
         
         reason_names = {
             'not_received': 'لم أستلم المنتج/الخدمة',
@@ -1026,7 +1095,7 @@ if __name__ == "__main__":
             'other': 'أخرى'
         }
         
-        await query.edit_message_text(f"""
+        await self.edit_message(query, f"""
 ⚠️ فتح نزاع
 
 السبب المختار: {reason_names.get(reason, 'غير معروف')}
@@ -1039,30 +1108,27 @@ if __name__ == "__main__":
 اكتب رسالة نصية مع التفاصيل.
         """)
     
-    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """معالج الرسائل النصية"""
+    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, conversation):
+        """معالج وصف النزاع"""
         user_id = update.effective_user.id
         
-        # فحص حالة المستخدم
-        if hasattr(self, 'user_states') and user_id in self.user_states:
-            user_state = self.user_states[user_id]
+        if conversation.step == 'description':
+            # إنشاء النزاع
+            description = update.message.text
+            deal_id = conversation.data['deal_id']
+            reason = conversation.data['reason']
             
-            if user_state['state'] == 'waiting_dispute_description':
-                # إنشاء النزاع
-                description = update.message.text
-                deal_id = user_state['data']['deal_id']
-                reason = user_state['data']['reason']
+            if self.repository and hasattr(self, 'dispute_manager'):
+                result = await self.repository.run(
+                    self.dispute_manager.create_dispute,
+                    deal_id=deal_id,
+                    reporter_id=user_id,
+                    reason=reason,
+                    description=description
+                )
                 
-                if self.flask_app and hasattr(self, 'dispute_manager'):
-                    result = self.dispute_manager.create_dispute(
-                        deal_id=deal_id,
-                        reporter_id=user_id,
-                        reason=reason,
-                        description=description
-                    )
-                    
-                    if result['success']:
-                        await update.message.reply_text(f"""
+                if result['success']:
+                    await update.message.reply_text(f"""
 ✅ تم فتح النزاع بنجاح!
 
 📋 رقم النزاع: {result['dispute_id']}
@@ -1072,68 +1138,54 @@ if __name__ == "__main__":
 سيتم التواصل معك قريباً من فريق الدعم.
 
 💬 يمكنك أيضاً محاولة التواصل مع الطرف الآخر لحل المشكلة ودياً.
-                        """)
-                    else:
-                        await update.message.reply_text(f"❌ خطأ في فتح النزاع: {result['error']}")
-                
-                # مسح حالة المستخدم
-                del self.user_states[user_id]
-                return
+                    """)
+                else:
+                    await update.message.reply_text(f"❌ خطأ في فتح النزاع: {result['error']}")
         
-        # معالجة رسائل إنشاء الصفقة (الكود الموجود مسبقاً)
-        # ... باقي الكود
+        # مسح حالة المستخدم
+        self.conversations.finish(user_id)
     
-    async def handle_rate_user(self, query, context):
+    async def handle_rate_user(self, query, context, rated_user_id):
         """معالج تقييم المستخدمين"""
         user_id = query.from_user.id
-        rated_user_id = int(query.data.split('_')[2])
         
         # البحث عن صفقة مكتملة بين المستخدمين
-        if self.flask_app:
-            with self.flask_app.app_context():
-                deal = Deal.query.filter(
-                    ((Deal.seller_id == user_id) & (Deal.buyer_id == rated_user_id)) |
-                    ((Deal.seller_id == rated_user_id) & (Deal.buyer_id == user_id)),
-                    Deal.status == 'completed'
-                ).first()
-                
-                if not deal:
-                    await query.edit_message_text("❌ لا توجد صفقات مكتملة مع هذا المستخدم.")
-                    return
-                
-                # عرض خيارات التقييم
-                keyboard = [
-                    [InlineKeyboardButton("⭐⭐⭐⭐⭐ ممتاز", callback_data=f"rating_5_{rated_user_id}_{deal.id}")],
-                    [InlineKeyboardButton("⭐⭐⭐⭐ جيد جداً", callback_data=f"rating_4_{rated_user_id}_{deal.id}")],
-                    [InlineKeyboardButton("⭐⭐⭐ جيد", callback_data=f"rating_3_{rated_user_id}_{deal.id}")],
-                    [InlineKeyboardButton("⭐⭐ مقبول", callback_data=f"rating_2_{rated_user_id}_{deal.id}")],
-                    [InlineKeyboardButton("⭐ ضعيف", callback_data=f"rating_1_{rated_user_id}_{deal.id}")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                rated_user = TelegramUser.query.filter_by(telegram_id=rated_user_id).first()
-                rated_user_name = rated_user.first_name if rated_user else "المستخدم"
-                
-                await query.edit_message_text(f"""
+        if self.repository:
+            deal = await self.repository.get_completed_deal_between(user_id, rated_user_id)
+            if not deal:
+                await self.edit_message(query, "❌ لا توجد صفقات مكتملة مع هذا المستخدم.")
+                return
+            
+            # عرض خيارات التقييم
+            keyboard = [
+                [InlineKeyboardButton("⭐⭐⭐⭐⭐ ممتاز", callback_data=encode_callback("rating", deal.id, 5, rated_user_id))],
+                [InlineKeyboardButton("⭐⭐⭐⭐ جيد جداً", callback_data=encode_callback("rating", deal.id, 4, rated_user_id))],
+                [InlineKeyboardButton("⭐⭐⭐ جيد", callback_data=encode_callback("rating", deal.id, 3, rated_user_id))],
+                [InlineKeyboardButton("⭐⭐ مقبول", callback_data=encode_callback("rating", deal.id, 2, rated_user_id))],
+                [InlineKeyboardButton("⭐ ضعيف", callback_data=encode_callback("rating", deal.id, 1, rated_user_id))],
+                [InlineKeyboardButton("❌ إلغاء", callback_data="main_menu")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            rated_user = await self.repository.get_user(rated_user_id)
+            rated_user_name = rated_user.first_name if rated_user else "المستخدم"
+            
+            await self.edit_message(query, f"""
 ⭐ تقييم المستخدم
 
 👤 المستخدم: {rated_user_name}
 📦 الصفقة: {deal.title}
 
 اختر التقييم المناسب:
-                """, reply_markup=reply_markup)
+            """, reply_markup=reply_markup)
     
-    async def handle_rating_selection(self, query, context):
+    async def handle_rating_selection(self, query, context, rating, rated_user_id, deal_id):
         """معالج اختيار التقييم"""
         user_id = query.from_user.id
-        data_parts = query.data.split('_')
-        rating = int(data_parts[1])
-        rated_user_id = int(data_parts[2])
-        deal_id = data_parts[3]
         
-        if self.flask_app and hasattr(self, 'dispute_manager'):
-            result = self.dispute_manager.add_user_rating(
+        if self.repository and hasattr(self, 'dispute_manager'):
+            result = await self.repository.run(
+                self.dispute_manager.add_user_rating,
                 deal_id=deal_id,
                 rater_id=user_id,
                 rated_id=rated_user_id,
@@ -1141,7 +1193,7 @@ if __name__ == "__main__":
             )
             
             if result['success']:
-                await query.edit_message_text(f"""
+                await self.edit_message(query, f"""
 ✅ تم إضافة التقييم بنجاح!
 
 ⭐ التقييم: {rating}/5
@@ -1150,15 +1202,20 @@ if __name__ == "__main__":
 شكراً لك على تقييمك، هذا يساعد في تحسين جودة الخدمة.
                 """)
             else:
-                await query.edit_message_text(f"❌ خطأ في إضافة التقييم: {result['error']}")
+                await self.edit_message(query, f"❌ خطأ في إضافة التقييم: {result['error']}")
     
     def setup_dispute_handlers(self):
         """إعداد معالجات النزاعات والتقييمات"""
-        # إضافة معالجات النزاعات والتقييمات
-        self.application.add_handler(CallbackQueryHandler(self.handle_dispute, pattern=r'^dispute_\d+$'))
-        self.application.add_handler(CallbackQueryHandler(self.handle_dispute_reason, pattern=r'^dispute_reason_'))
-        self.application.add_handler(CallbackQueryHandler(self.handle_rate_user, pattern=r'^rate_user_'))
-        self.application.add_handler(CallbackQueryHandler(self.handle_rating_selection, pattern=r'^rating_'))
+        # مسارات النزاعات والتقييمات في جدول الأزرار (أطول بادئة تفوز)
+        # فتح النزاع يمر باختيار السبب وإنشاء سجل نزاع بدلاً من تغيير الحالة مباشرة
+        router = self.callback_router
+        router.add_action("dispute", self.handle_dispute)
+        router.add_prefix("dispute_", self.handle_dispute)
+        router.add_action("dispute_reason", self.handle_dispute_reason, parse_dispute_reason_action)
+        router.add_prefix("dispute_reason_", self.handle_dispute_reason, parse_dispute_reason)
+        router.add_prefix("rate_user_", self.handle_rate_user, lambda rest: (int(rest),))
+        router.add_action("rating", self.handle_rating_selection, parse_rating_action)
+        router.add_prefix("rating_", self.handle_rating_selection, parse_rating)
         
         # إعداد مدير النزاعات
         from services.dispute_manager import DisputeManager
@@ -1166,7 +1223,14 @@ if __name__ == "__main__":
         
         self.dispute_manager = DisputeManager(self.flask_app, self)
         set_dispute_manager(self.dispute_manager)
-        
-        # تهيئة حالات المستخدمين
-        self.user_states = {}
 
+if __name__ == "__main__":
+    # يجب وضع توكن البوت هنا
+    BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
+    
+    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+        print("يرجى وضع توكن البوت في المتغير BOT_TOKEN")
+        sys.exit(1)
+    
+    bot = OTCBot(BOT_TOKEN)
+    bot.run()
@@ -9,8 +9,9 @@ import sys
 import json
 import time
 import asyncio
+import tempfile
 import unittest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
 from datetime import datetime, timedelta
 
 # إضافة مسار المشروع
@@ -20,20 +21,77 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 from src.models.telegram_user import TelegramUser, db as user_db
 from src.models.deal import Deal, db as deal_db
 from src.models.dispute import Dispute, UserRating, SecurityLog, UserBan, db as dispute_db
+from src.models.webhook_inbox import WebhookInbox
+from src.models.payment_event import PaymentEvent
+from src.models.deposit_address import DepositAddress
+from src.models.telegram_update import TelegramUpdateInbox
 from src.services.dispute_manager import DisputeManager
 from src.services.payment_monitor import PaymentMonitor
-from src.services.ccpayment import CCPaymentService
-from src.telegram_bot import OTCBot
+from src.services.payment_scheduler import PaymentScheduler
+from src.services.webhook_consumer import WebhookConsumer
+from src.services.payment_events import PaymentEventStore, confirm_payment
+from src.services.webhook_guard import WebhookReplayGuard
+from src.services.address_pool import DepositAddressPool
+from src.services.payment_service import AsyncPaymentService
+from src.services.update_processor import ChatOrderedUpdateProcessor
+from src.services.bot_repository import BotRepository, LoopLagMonitor
+from src.services.update_inbox import UpdateInboxReader
+from src.services.user_cache import KnownUserCache
+from src.services.deal_cards import deal_card_cache
+from src.services.callback_router import CallbackRouter
+from src.services.conversation_store import ConversationStore
+from src.services.media_groups import MediaGroupCollector
+from src.services.rate_limiter import PriorityRateLimiter, BULK_PRIORITY
+from src.services.broadcast import BroadcastEngine
+from src.models.broadcast import BroadcastCampaign, BroadcastRecipient
+from src.models.notification_outbox import NotificationOutbox
+from src.services.outbox import NotificationDispatcher, PAYMENT_CONFIRMED, enqueue_notification
+from src.services.schema_migrations import SchemaMigrator, explain_query_plan, find_full_scans
+from src.services.callback_codec import CallbackCodec, encode_callback
+from src.services.ccpayment import CCPaymentService, AsyncCCPaymentService, CCPaymentRegistry, deposit_record_cache
+from src.services.singleflight import SingleFlight
+from src.telegram_bot import OTCBot, MAIN_MENU_MARKUP
+from src.routes.telegram_webhook import set_telegram_bot, set_update_forwarding
+from flask import Flask
 from src.main import app
 
+
+def create_test_app(test_case):
+    """تطبيق Flask منفصل بقاعدة بيانات SQLite مؤقتة خاصة بالاختبار
+
+    تغيير SQLALCHEMY_DATABASE_URI في app بعد db.init_app لا يغير محركه، فكانت
+    الاختبارات تنشئ الجداول وتحذفها في database/app.db. قاعدة البيانات ملف مؤقت
+    وليست :memory: لأن BotRepository يستخدمها من عدة threads.
+    """
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    test_app = Flask(__name__)
+    test_app.config.update(
+        TESTING=True,
+        SECRET_KEY='test',
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}",
+        SQLALCHEMY_TRACK_MODIFICATIONS=False
+    )
+    for blueprint in app.iter_blueprints():
+        test_app.register_blueprint(blueprint, url_prefix='/api')
+    deal_db.init_app(test_app)
+
+    def cleanup():
+        with test_app.app_context():
+            deal_db.session.remove()
+            deal_db.engine.dispose()
+        os.remove(path)
+
+    test_case.addCleanup(cleanup)
+    return test_app
+
 class TestOTCBot(unittest.TestCase):
     """اختبارات البوت الأساسية"""
     
     def setUp(self):
         """إعداد البيئة للاختبار"""
-        self.app = app
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app = create_test_app(self)
         
         with self.app.app_context():
             user_db.create_all()
@@ -275,8 +333,9 @@ class TestCCPaymentIntegration(unittest.TestCase):
             app_id="test_app_id",
             app_secret="test_app_secret"
         )
+        deposit_record_cache.clear()
     
-    @patch('requests.post')
+    @patch('httpx.Client.post')
     def test_create_deposit_address(self, mock_post):
         """اختبار إنشاء عنوان الإيداع"""
         # محاكاة استجابة API
@@ -303,7 +362,7 @@ class TestCCPaymentIntegration(unittest.TestCase):
         self.assertTrue(result['success'])
         self.assertIn('address', result)
     
-    @patch('requests.post')
+    @patch('httpx.Client.post')
     def test_get_deposit_record(self, mock_post):
         """اختبار الحصول على سجل الإيداع"""
         # محاكاة استجابة API
@@ -325,95 +384,1820 @@ class TestCCPaymentIntegration(unittest.TestCase):
         self.assertTrue(result['success'])
         self.assertEqual(result['status'], 'success')
 
-class TestPerformance(unittest.TestCase):
-    """اختبارات الأداء"""
+    def test_async_client_matches_sync_normalisation(self):
+        """اختبار أن العميل غير المتزامن يوحد الاستجابات بنفس طريقة العميل المتزامن"""
+        ccpayment_async = AsyncCCPaymentService(
+            app_id="test_app_id",
+            app_secret="test_app_secret"
+        )
+        mock_response = Mock()
+        mock_response.json.return_value = {
+            'code': 10000,
+            'msg': 'success',
+            'data': {'status': 'success', 'amount': 100.0, 'txId': '0xabc'}
+        }
+        
+        with patch('httpx.AsyncClient.post', new=AsyncMock(return_value=mock_response)) as mock_post:
+            result = asyncio.run(ccpayment_async.get_deposit_record("test_order_123"))
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['tx_id'], '0xabc')
+        sent = mock_post.call_args.kwargs['json']
+        self.assertEqual(sent['appId'], 'test_app_id')
+        self.assertTrue(self.ccpayment.verify_webhook(
+            {k: v for k, v in sent.items() if k != 'sign'}, sent['sign']
+        ))
+
+    def test_registry_shares_service_and_reloads_credentials(self):
+        """اختبار مشاركة نسخة واحدة من الخدمة واستبدالها عند تغيير بيانات الاعتماد"""
+        registry = CCPaymentRegistry()
+        
+        with patch.dict(os.environ, {'CCPAYMENT_APP_ID': 'id_1', 'CCPAYMENT_APP_SECRET': 'secret_1'}):
+            first = registry.get()
+            self.assertIs(registry.get(), first)
+            self.assertFalse(registry.reload())
+        
+        with patch.dict(os.environ, {'CCPAYMENT_APP_ID': 'id_2', 'CCPAYMENT_APP_SECRET': 'secret_2'}):
+            self.assertTrue(registry.reload())
+        
+        second = registry.get()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.app_id, 'id_2')
+        self.assertEqual(first.app_id, 'id_1')
+        self.assertEqual(registry.get_async().app_id, 'id_2')
+
+    def test_reload_endpoint_reads_rotated_credentials_file(self):
+        """اختبار أن إعادة التحميل تقرأ المفاتيح الجديدة من ملف بيانات الاعتماد"""
+        from src.services import ccpayment
+        handle, path = tempfile.mkstemp(suffix='.env')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+
+        def write_credentials(app_id, app_secret):
+            with open(path, 'w') as credentials_file:
+                credentials_file.write(f"# CCPayment\nCCPAYMENT_APP_ID={app_id}\nexport CCPAYMENT_APP_SECRET=\"{app_secret}\"\n")
+
+        registry = CCPaymentRegistry()
+        client = create_test_app(self).test_client()
+        write_credentials('id_1', 'secret_1')
+        with patch.dict(os.environ, {'CCPAYMENT_CREDENTIALS_FILE': path}), \
+                patch.object(ccpayment, 'ccpayment_registry', registry), \
+                patch('src.routes.monitoring.ccpayment_registry', registry):
+            self.assertEqual(registry.get().app_secret, 'secret_1')
+
+            write_credentials('id_2', 'secret_2')
+            response = client.post('/api/monitoring/ccpayment/reload')
+            self.assertTrue(response.get_json()['changed'])
+            self.assertEqual((registry.get().app_id, registry.get().app_secret), ('id_2', 'secret_2'))
+
+            response = client.post('/api/monitoring/ccpayment/reload')
+            self.assertFalse(response.get_json()['changed'])
+
+    def test_get_deposit_records_returns_per_order_results(self):
+        """اختبار جلب سجلات عدة طلبات مع خطأ خاص بكل طلب"""
+        def get_deposit_record(order_id):
+            if order_id == 'bad_order':
+                return {'success': False, 'error': 'Order not found'}
+            return {'success': True, 'status': 'success', 'tx_id': order_id}
+        
+        with patch.object(self.ccpayment, 'get_deposit_record', side_effect=get_deposit_record) as mock_get:
+            order_ids = [f'order_{i}' for i in range(25)] + ['bad_order', 'order_0']
+            records = self.ccpayment.get_deposit_records(order_ids, chunk_size=10)
+        
+        self.assertEqual(len(records), 26)
+        self.assertEqual(mock_get.call_count, 26)
+        self.assertTrue(records['order_24']['success'])
+        self.assertEqual(records['bad_order']['error'], 'Order not found')
+
+    def test_single_flight_shares_concurrent_calls(self):
+        """اختبار مشاركة طلب واحد بين الاستدعاءات المتزامنة لنفس المفتاح"""
+        import threading
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        
+        def fetch():
+            calls.append(1)
+            release.wait(2)
+            return {'success': True}
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', fetch))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.get_stats()['shared'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(flights.get_stats()['in_flight'], 0)
+
+    def test_flight_key_covers_all_request_params(self):
+        """اختبار عدم دمج طلبات نفس orderId إذا اختلفت باقي المعاملات"""
+        service = self.ccpayment
+        key_of = lambda request: service._flight_key(*request[:2])
+        key = key_of(service._deposit_address_request("order_1", 1280, 100.0))
+        
+        self.assertEqual(key, key_of(service._deposit_address_request("order_1", 1280, 100.0)))
+        self.assertNotEqual(key, key_of(service._deposit_address_request("order_1", 1282, 100.0)))
+        self.assertNotEqual(key, key_of(service._deposit_address_request("order_1", 1280, 50.0)))
+        self.assertNotEqual(
+            key_of(service._withdrawal_request(1280, 'POLYGON', '0xaaa', 10.0, "order_1")),
+            key_of(service._withdrawal_request(1280, 'POLYGON', '0xbbb', 10.0, "order_1"))
+        )
+        
+        # التوقيت والتوقيع يتغيران مع كل إرسال ولا يدخلان في المفتاح
+        endpoint, data, _ = service._deposit_address_request("order_1", 1280, 100.0)
+        self.assertEqual(key, service._flight_key(endpoint, dict(data, appId='app', timestamp=1, sign='abc')))
+    
+    @patch('httpx.Client.post')
+    def test_deposit_record_cache_and_invalidation(self, mock_post):
+        """اختبار خدمة فحوصات الحالة المتكررة من الذاكرة المؤقتة"""
+        mock_response = Mock()
+        mock_response.json.return_value = {
+            'code': 10000,
+            'msg': 'success',
+            'data': {'status': 'pending', 'amount': 100.0}
+        }
+        mock_post.return_value = mock_response
+        
+        self.ccpayment.get_deposit_record("cached_order")
+        result = self.ccpayment.get_deposit_record("cached_order")
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(mock_post.call_count, 1)
+        
+        deposit_record_cache.invalidate("cached_order")
+        self.ccpayment.get_deposit_record("cached_order")
+        self.assertEqual(mock_post.call_count, 2)
+
+class TestPaymentMonitor(unittest.TestCase):
+    """اختبارات مراقب المدفوعات"""
     
     def setUp(self):
         """إعداد البيئة للاختبار"""
-        self.app = app
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app = create_test_app(self)
         
         with self.app.app_context():
-            user_db.create_all()
             deal_db.create_all()
-            dispute_db.create_all()
+        
+        self.monitor = PaymentMonitor(self.app)
     
-    def test_database_performance(self):
-        """اختبار أداء قاعدة البيانات"""
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
         with self.app.app_context():
-            # قياس وقت إنشاء 100 صفقة
-            start_time = time.time()
-            
-            for i in range(100):
-                deal = Deal(
-                    seller_id=123456789 + i,
-                    title=f"Product {i}",
-                    description=f"Description {i}",
-                    price=100.0 + i,
-                    commission=5.0,
-                    total_price=105.0 + i
-                )
-                deal_db.session.add(deal)
-            
-            deal_db.session.commit()
-            end_time = time.time()
-            
-            creation_time = end_time - start_time
-            print(f"وقت إنشاء 100 صفقة: {creation_time:.2f} ثانية")
-            
-            # يجب أن يكون الوقت أقل من ثانية واحدة
-            self.assertLess(creation_time, 1.0)
+            deal_db.drop_all()
     
-    def test_query_performance(self):
-        """اختبار أداء الاستعلامات"""
+    def _create_pending_deals(self, count):
+        """إنشاء صفقات معلقة لها معلومات دفع"""
+        deal_ids = []
         with self.app.app_context():
-            # إنشاء بيانات للاختبار
-            for i in range(1000):
+            for i in range(count):
                 deal = Deal(
-                    seller_id=123456789 + (i % 10),
+                    seller_id=123456789,
                     title=f"Product {i}",
-                    description=f"Description {i}",
-                    price=100.0 + i,
+                    description="Test Description",
+                    price=100.0,
                     commission=5.0,
-                    total_price=105.0 + i,
-                    status='pending' if i % 2 == 0 else 'completed'
+                    total_price=105.0,
+                    payment_id=json.dumps({'address': '0xabc'})
                 )
                 deal_db.session.add(deal)
-            
+                deal_db.session.commit()
+                deal_ids.append(deal.id)
+        return deal_ids
+    
+    def test_stuck_call_does_not_block_batch(self):
+        """اختبار أن استدعاء عالق لا يوقف باقي الدفعة"""
+        deal_ids = self._create_pending_deals(3)
+        stuck_id = deal_ids[0]
+        
+        async def get_deposit_record(order_id):
+            if order_id == stuck_id:
+                await asyncio.sleep(1)
+            return {'success': True, 'status': 'success', 'amount': 105.0, 'tx_id': '0x1'}
+        
+        self.monitor.ccpayment = AsyncCCPaymentService("test_app_id", "test_app_secret")
+        self.monitor.ccpayment.get_deposit_record = get_deposit_record
+        self.monitor.check_timeout = 0.2
+        
+        asyncio.run(self.monitor.sync_pending_deals())
+        report = asyncio.run(self.monitor.check_pending_payments())
+        
+        self.assertEqual(report['checked'], 3)
+        self.assertEqual(report['confirmed'], 2)
+        self.assertEqual(report['timed_out'], 1)
+        self.assertLess(report['elapsed'], 1.0)
+        self.assertEqual(self.monitor.get_monitoring_stats()['last_cycle'], report)
+        
+        # الصفقات المؤكدة تخرج من الجدول، والعالقة تُعاد جدولتها
+        self.assertEqual(len(self.monitor.scheduler), 1)
+        self.assertIn(stuck_id, self.monitor.scheduler)
+
+    def test_reconcile_confirms_missed_payments(self):
+        """اختبار أن المطابقة تؤكد الدفعات التي فاتت المراقب"""
+        deal_ids = self._create_pending_deals(2)
+        paid_id = deal_ids[1]
+        
+        async def get_deposit_record(order_id):
+            status = 'success' if order_id == paid_id else 'pending'
+            return {'success': True, 'status': status, 'amount': 105.0, 'tx_id': '0x2'}
+        
+        self.monitor.ccpayment = AsyncCCPaymentService("test_app_id", "test_app_secret")
+        self.monitor.ccpayment.get_deposit_record = get_deposit_record
+        
+        report = asyncio.run(self.monitor.reconcile_payments())
+        
+        self.assertEqual(report['checked'], 2)
+        self.assertEqual(report['fixed'], 1)
+        with self.app.app_context():
+            self.assertEqual(Deal.query.get(paid_id).status, 'paid')
+            self.assertEqual(Deal.query.get(deal_ids[0]).status, 'pending')
+
+class TestPaymentScheduler(unittest.TestCase):
+    """اختبارات جدولة فحص المدفوعات"""
+    
+    def setUp(self):
+        self.scheduler = PaymentScheduler(base_interval=10, max_interval=1800, backoff_step=600)
+    
+    def test_backoff_grows_with_age(self):
+        """اختبار تضاعف فترة الفحص مع تقدم عمر الصفقة"""
+        self.assertEqual(self.scheduler.interval_for(0), 10)
+        self.assertEqual(self.scheduler.interval_for(601), 20)
+        self.assertEqual(self.scheduler.interval_for(1300), 40)
+        self.assertEqual(self.scheduler.interval_for(24 * 3600), 1800)
+    
+    def test_new_deal_is_due_and_old_deal_backs_off(self):
+        """اختبار أن الصفقة الجديدة تُفحص فوراً ثم تؤجل حسب عمرها"""
+        old_created = datetime.utcnow() - timedelta(hours=5)
+        self.scheduler.add('new_deal')
+        self.scheduler.add('old_deal', old_created)
+        
+        due = self.scheduler.pop_due()
+        self.assertCountEqual(due, ['new_deal', 'old_deal'])
+        
+        self.scheduler.reschedule('new_deal')
+        self.scheduler.reschedule('old_deal')
+        
+        self.assertEqual(self.scheduler.pop_due(now=time.time() + 11), ['new_deal'])
+        self.assertEqual(self.scheduler.pop_due(now=time.time() + 11), [])
+        self.assertEqual(self.scheduler.pop_due(now=time.time() + 1801), ['old_deal'])
+    
+    def test_prioritize_jumps_queue(self):
+        """اختبار تقديم صفقة إلى بداية الطابور"""
+        self.scheduler.add('deal_a')
+        self.scheduler.add('deal_b')
+        self.scheduler.pop_due()
+        self.scheduler.reschedule('deal_a')
+        self.scheduler.reschedule('deal_b')
+        
+        self.scheduler.prioritize('deal_b')
+        
+        self.assertEqual(self.scheduler.pop_due(), ['deal_b'])
+    
+    def test_sync_drops_resolved_deals(self):
+        """اختبار حذف الصفقات التي لم تعد معلقة عند المزامنة"""
+        self.scheduler.sync([('deal_a', None), ('deal_b', None)])
+        self.scheduler.sync([('deal_b', None)])
+        
+        self.assertNotIn('deal_a', self.scheduler)
+        self.assertEqual(self.scheduler.pop_due(), ['deal_b'])
+
+class TestWebhookConsumer(unittest.TestCase):
+    """اختبارات معالجة صندوق وارد webhooks"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            deal_db.create_all()
+        
+        self.consumer = WebhookConsumer(self.app, batch_size=10)
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        with self.app.app_context():
+            deal_db.drop_all()
+    
+    def test_drain_applies_batch_in_one_pass(self):
+        """اختبار تطبيق دفعة من الأحداث وتسجيل الأحداث الفاشلة"""
+        with self.app.app_context():
+            deal = Deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0,
+                payment_id=json.dumps({'address': '0xabc'})
+            )
+            deal_db.session.add(deal)
             deal_db.session.commit()
+            deal_id = deal.id
             
-            # قياس وقت الاستعلام
-            start_time = time.time()
-            
-            # استعلام معقد
-            results = Deal.query.filter(
-                Deal.status == 'pending',
-                Deal.price > 500.0
-            ).order_by(Deal.created_at.desc()).limit(50).all()
+            deal_db.session.add(WebhookInbox(payload=json.dumps({
+                'orderId': deal_id, 'status': 'success', 'amount': 105.0, 'txId': '0xtx'
+            })))
+            deal_db.session.add(WebhookInbox(payload=json.dumps({
+                'orderId': 'missing_deal', 'status': 'success'
+            })))
+            deal_db.session.commit()
+        
+        self.assertEqual(self.consumer.get_stats()['queue_depth'], 2)
+        self.assertEqual(self.consumer.drain_once(), 2)
+        
+        with self.app.app_context():
+            deal = Deal.query.get(deal_id)
+            self.assertEqual(deal.status, 'paid')
+            self.assertEqual(json.loads(deal.payment_id)['tx_id'], '0xtx')
+            statuses = sorted(entry.status for entry in WebhookInbox.query.all())
+            self.assertEqual(statuses, ['failed', 'processed'])
+        
+        stats = self.consumer.get_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['batches_count'], 1)
+
+    def test_duplicate_events_are_rejected_and_replayable(self):
+        """اختبار رفض الأحداث المكررة وإعادة تطبيق الأحداث المخزنة"""
+        with self.app.app_context():
+            deal = Deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0,
+                payment_id=json.dumps({'address': '0xabc'})
+            )
+            deal_db.session.add(deal)
+            deal_db.session.commit()
+            deal_id = deal.id
             
-            end_time = time.time()
-            query_time = end_time - start_time
+            event = {'orderId': deal_id, 'status': 'success', 'amount': 105.0, 'txId': '0xtx'}
+            for _ in range(3):
+                deal_db.session.add(WebhookInbox(payload=json.dumps(event)))
+            deal_db.session.commit()
+        
+        self.consumer.drain_once()
+        
+        with self.app.app_context():
+            self.assertEqual(PaymentEvent.query.count(), 1)
+            statuses = sorted(entry.status for entry in WebhookInbox.query.all())
+            self.assertEqual(statuses, ['duplicate', 'duplicate', 'processed'])
             
-            print(f"وقت الاستعلام المعقد: {query_time:.4f} ثانية")
-            print(f"عدد النتائج: {len(results)}")
+            # محاكاة فقدان الحالة بعد نشر خاطئ
+            deal = Deal.query.get(deal_id)
+            deal.status = 'pending'
+            deal_db.session.commit()
+        
+        stats = PaymentEventStore(self.app).replay()
+        
+        self.assertEqual(stats['events'], 1)
+        self.assertEqual(stats['confirmed'], 1)
+        with self.app.app_context():
+            self.assertEqual(Deal.query.get(deal_id).status, 'paid')
+
+    def _create_paid_event(self, count=1):
+        with self.app.app_context():
+            deal = Deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0,
+                payment_id=json.dumps({'address': '0xabc'})
+            )
+            deal_db.session.add(deal)
+            deal_db.session.commit()
             
-            # يجب أن يكون الوقت أقل من 0.1 ثانية
-            self.assertLess(query_time, 0.1)
+            for i in range(count):
+                deal_db.session.add(WebhookInbox(payload=json.dumps({
+                    'orderId': deal.id, 'status': 'success', 'amount': 105.0, 'txId': f'0xtx{i}'
+                })))
+            deal_db.session.commit()
+            return deal.id
+    
+    def test_notify_during_batch_is_not_lost(self):
+        """اختبار أن التنبيه أثناء معالجة دفعة يبدأ الدفعة التالية بدون انتظار idle_interval"""
+        import threading
+        consumer = WebhookConsumer(self.app, batch_size=10, idle_interval=5)
+        second_batch = threading.Event()
+        calls = []
 
-def run_tests():
-    """تشغيل جميع الاختبارات"""
-    print("🧪 بدء اختبارات بوت OTC")
-    print("=" * 50)
+        def drain_once():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                # حدث جديد يصل أثناء الدفعة الأولى
+                consumer.notify()
+            else:
+                second_batch.set()
+            return 0
+
+        with patch.object(consumer, 'drain_once', side_effect=drain_once):
+            consumer.start()
+            self.assertTrue(second_batch.wait(2))
+            consumer.stop()
+        self.assertLess(calls[1] - calls[0], 1)
     
-    # إنشاء مجموعة الاختبارات
-    test_suite = unittest.TestSuite()
+    def test_all_confirm_paths_leave_same_deal_state(self):
+        """اختبار أن webhook والمراقب و/payments/status تؤكد الدفع بنفس الحالة النهائية"""
+        webhook_deal, monitor_deal, status_deal = [self._create_paid_event(count=0) for _ in range(3)]
+        record = {'success': True, 'status': 'success', 'amount': 105.0, 'tx_id': '0xtx0'}
+
+        with self.app.app_context():
+            deal_db.session.add(WebhookInbox(payload=json.dumps({
+                'orderId': webhook_deal, 'status': 'success', 'amount': 105.0, 'txId': '0xtx0'
+            })))
+            deal_db.session.commit()
+        self.consumer.drain_once()
+
+        with self.app.app_context():
+            monitor = PaymentMonitor(self.app)
+            self.assertEqual(asyncio.run(monitor.apply_deposit_record(Deal.query.get(monitor_deal), record)), 'confirmed')
+
+        ccpayment = Mock()
+        ccpayment.get_deposit_record.return_value = record
+        with patch('src.routes.payments.get_ccpayment_service', return_value=ccpayment):
+            response = self.app.test_client().get(f'/api/payments/status/{status_deal}')
+        self.assertEqual(response.get_json()['deal_status'], 'paid')
+
+        with self.app.app_context():
+            notifications = set()
+            for deal_id, source in ((webhook_deal, 'webhook'), (monitor_deal, 'monitor'), (status_deal, 'status')):
+                deal = Deal.query.get(deal_id)
+                payment_info = json.loads(deal.payment_id)
+                self.assertEqual(deal.status, 'paid')
+                self.assertEqual((payment_info['tx_id'], payment_info['confirmed_amount']), ('0xtx0', 105.0))
+                self.assertIn('confirmation_time', payment_info)
+                self.assertEqual(PaymentEvent.query.filter_by(order_id=deal_id).one().source, source)
+                notifications.add(NotificationOutbox.query.filter_by(deal_id=deal_id).count())
+            # الصفقة بدون مشترٍ: إشعار البائع فقط
+            self.assertEqual(notifications, {1})
     
-    # إضافة اختبارات البوت الأساسية
-    test_suite.addTest(unittest.makeSuite(TestOTCBot))
+    def test_failed_entry_does_not_keep_event_record(self):
+        """اختبار التراجع عن سجل الحدث عند فشل تطبيقه حتى تنجح إعادة المحاولة"""
+        deal_id = self._create_paid_event()
+        
+        with patch('src.services.payment_events.enqueue_notification', side_effect=RuntimeError('outbox down')):
+            self.consumer.drain_once()
+        
+        with self.app.app_context():
+            self.assertEqual(PaymentEvent.query.count(), 0)
+            self.assertEqual(Deal.query.get(deal_id).status, 'pending')
+            entry = WebhookInbox.query.one()
+            self.assertEqual((entry.status, entry.attempts), ('pending', 1))
+        
+        self.consumer.drain_once()
+        
+        with self.app.app_context():
+            self.assertEqual(WebhookInbox.query.one().status, 'processed')
+            self.assertEqual(Deal.query.get(deal_id).status, 'paid')
     
-    # إضافة اختبارات CCPayments
-    test_suite.addTest(unittest.makeSuite(TestCCPaymentIntegration))
+    def test_batch_commit_failure_falls_back_to_single_entries(self):
+        """اختبار حفظ المحاولات ونتائج الأحداث عند فشل commit الدفعة"""
+        deal_id = self._create_paid_event(count=2)
+        
+        commit = deal_db.session.commit
+        calls = []
+        
+        def failing_commit():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            return commit()
+        
+        with patch.object(deal_db.session, 'commit', side_effect=failing_commit):
+            self.assertEqual(self.consumer.drain_once(), 2)
+        
+        with self.app.app_context():
+            entries = WebhookInbox.query.order_by(WebhookInbox.id).all()
+            self.assertEqual([(entry.status, entry.attempts) for entry in entries],
+                             [('processed', 1), ('processed', 1)])
+            self.assertEqual(PaymentEvent.query.count(), 2)
+            self.assertEqual(Deal.query.get(deal_id).status, 'paid')
+        self.assertEqual(self.consumer.processed_count, 2)
+        
+    
+    def test_entry_failing_to_commit_is_marked_failed(self):
+        """اختبار تعليم الحدث الذي يفشل commit الخاص به failed بدلاً من إعاقة الصندوق"""
+        deal_id = self._create_paid_event()
+        consumer = WebhookConsumer(self.app, batch_size=10, max_attempts=1)
+        
+        commit = deal_db.session.commit
+        calls = []
+        
+        def failing_commit():
+            # commit الدفعة ثم commit الحدث وحده يفشلان، وحفظ المحاولة ينجح
+            calls.append(1)
+            if len(calls) <= 2:
+                raise RuntimeError('disk I/O error')
+            return commit()
+        
+        with patch.object(deal_db.session, 'commit', side_effect=failing_commit):
+            consumer.drain_once()
+        
+        with self.app.app_context():
+            entry = WebhookInbox.query.one()
+            self.assertEqual((entry.status, entry.attempts, entry.error), ('failed', 1, 'disk I/O error'))
+            self.assertEqual(PaymentEvent.query.count(), 0)
+            self.assertEqual(Deal.query.get(deal_id).status, 'pending')
+        self.assertEqual(consumer.failed_count, 1)
+
+class TestWebhookReplayGuard(unittest.TestCase):
+    """اختبارات الحماية من إعادة إرسال webhooks"""
+    
+    def test_replayed_signature_is_rejected(self):
+        """اختبار رفض التوقيع المكرر"""
+        guard = WebhookReplayGuard(max_age=300)
+        now = int(time.time())
+        
+        self.assertEqual(guard.check('sig_1', now), (True, None))
+        self.assertEqual(guard.check('sig_1', now), (False, 'replayed'))
+        self.assertEqual(guard.get_stats()['replay_hits'], 1)
+    
+    def test_out_of_window_and_missing_timestamp(self):
+        """اختبار رفض الطلبات القديمة أو بدون توقيت"""
+        guard = WebhookReplayGuard(max_age=300)
+        
+        self.assertEqual(guard.check('sig_old', int(time.time()) - 301), (False, 'out_of_window'))
+        self.assertEqual(guard.check('sig_future', int(time.time()) + 3600), (False, 'out_of_window'))
+        self.assertEqual(guard.check('sig_none', None), (False, 'missing_timestamp'))
+    
+    def test_webhook_route_ignores_unsigned_timestamp(self):
+        """اختبار رفض webhook بدون توقيت في الجسم الموقع حتى مع وجود توقيت في الـ headers"""
+        ccpayment = Mock()
+        ccpayment.verify_webhook.return_value = True
+        
+        with patch('src.routes.payments.get_ccpayment_service', return_value=ccpayment):
+            response = app.test_client().post(
+                '/api/payments/webhook',
+                json={'orderId': 'deal_1', 'status': 'success'},
+                headers={'X-CC-Signature': 'sig_header_only', 'X-CC-Timestamp': str(int(time.time()))}
+            )
+        
+        self.assertEqual(response.status_code, 401)
+    
+    def test_cache_is_bounded(self):
+        """اختبار أن الذاكرة محدودة الحجم"""
+        guard = WebhookReplayGuard(max_age=300, max_entries=10)
+        now = int(time.time())
+        
+        for i in range(25):
+            guard.check(f'sig_{i}', now)
+        
+        stats = guard.get_stats()
+        self.assertEqual(stats['cached_signatures'], 10)
+        self.assertEqual(stats['capacity_evictions'], 15)
+    
+    def test_forget_allows_retry(self):
+        """اختبار قبول إعادة المحاولة بعد فشل الحفظ"""
+        guard = WebhookReplayGuard()
+        now = int(time.time())
+        
+        guard.check('sig_1', now)
+        guard.forget('sig_1')
+        
+        self.assertEqual(guard.check('sig_1', now), (True, None))
+
+class TestDepositAddressPool(unittest.TestCase):
+    """اختبارات مجمع عناوين الإيداع الجاهزة"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            deal_db.create_all()
+        
+        self.pool = DepositAddressPool(self.app, target_size=3, low_watermark=2)
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        with self.app.app_context():
+            deal_db.drop_all()
+    
+    def _create_deal(self):
+        deal = Deal(
+            seller_id=123456789,
+            title="Test Product",
+            description="Test Description",
+            price=100.0,
+            commission=5.0,
+            total_price=105.0
+        )
+        deal_db.session.add(deal)
+        deal_db.session.commit()
+        return deal
+    
+    def test_acquire_binds_address_and_webhook_resolves_deal(self):
+        """اختبار ربط عنوان جاهز بالصفقة وتأكيد الدفع عبر رقم طلب المجمع"""
+        with patch.object(self.pool, 'request_refill') as mock_refill:
+            with self.app.app_context():
+                deal_db.session.add(DepositAddress(
+                    order_ref='pool-1', coin_type='USDT', network='POLYGON', address='0xpool1'
+                ))
+                deal_db.session.commit()
+                
+                deal = self._create_deal()
+                payment_info = self.pool.acquire(deal, 'USDT', 'POLYGON')
+                
+                self.assertEqual(payment_info['address'], '0xpool1')
+                self.assertEqual(json.loads(deal.payment_id)['order_id'], 'pool-1')
+                self.assertEqual(DepositAddress.query.filter_by(order_ref='pool-1').first().deal_id, deal.id)
+                
+                # المجمع فارغ الآن
+                self.assertIsNone(self.pool.acquire(self._create_deal(), 'USDT', 'POLYGON'))
+                deal_id = deal.id
+                
+                deal_db.session.add(WebhookInbox(payload=json.dumps({
+                    'orderId': 'pool-1', 'status': 'success', 'amount': 105.0, 'txId': '0xtx'
+                })))
+                deal_db.session.commit()
+            
+            self.assertTrue(mock_refill.called)
+        
+        WebhookConsumer(self.app).drain_once()
+        
+        with self.app.app_context():
+            self.assertEqual(Deal.query.get(deal_id).status, 'paid')
+        
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+    
+    def test_repeated_payment_reuses_bound_address(self):
+        """اختبار إعادة نفس العنوان المربوط عند تكرار طلب الدفع لنفس العملة والشبكة"""
+        with self.app.app_context():
+            for i in (1, 2):
+                deal_db.session.add(DepositAddress(
+                    order_ref=f'pool-{i}', coin_type='USDT', network='POLYGON', address=f'0xpool{i}'
+                ))
+            deal_db.session.commit()
+            
+            with patch.object(self.pool, 'request_refill'):
+                deal = self._create_deal()
+                first = self.pool.acquire(deal, 'USDT', 'POLYGON')
+                second = self.pool.acquire(deal, 'USDT', 'POLYGON')
+            
+            self.assertEqual(first, second)
+            self.assertEqual(json.loads(deal.payment_id)['order_id'], 'pool-1')
+            self.assertEqual(self.pool.available_count('USDT', 'POLYGON'), 1)
+    
+    def test_underpaid_pool_payment_is_not_confirmed_on_any_path(self):
+        """اختبار أن دفع مبلغ أقل لعنوان من المجمع لا يؤكد الصفقة عبر webhook أو المراقب أو /payments/status"""
+        deals = {}
+        with self.app.app_context():
+            for path in ('webhook', 'monitor', 'status'):
+                deal_db.session.add(DepositAddress(
+                    order_ref=f'pool-{path}', coin_type='USDT', network='POLYGON', address=f'0x{path}'
+                ))
+            deal_db.session.commit()
+            
+            with patch.object(self.pool, 'request_refill'):
+                for path in ('webhook', 'monitor', 'status'):
+                    deal = self._create_deal()
+                    self.pool.acquire(deal, 'USDT', 'POLYGON')
+                    deals[path] = deal.id
+            self.assertEqual(DepositAddress.query.filter_by(order_ref='pool-webhook').one().expected_amount, 105.0)
+            
+            deal_db.session.add(WebhookInbox(payload=json.dumps({
+                'orderId': 'pool-webhook', 'status': 'success', 'amount': '0.05', 'txId': '0xtx'
+            })))
+            deal_db.session.commit()
+        WebhookConsumer(self.app).drain_once()
+        
+        record = {'success': True, 'status': 'success', 'amount': '0.05', 'tx_id': '0xtx', 'data': {}}
+        with self.app.app_context():
+            outcome = asyncio.run(PaymentMonitor(self.app).apply_deposit_record(Deal.query.get(deals['monitor']), record))
+            self.assertEqual(outcome, 'underpaid')
+        
+        ccpayment = Mock()
+        ccpayment.get_deposit_record.return_value = record
+        with patch('src.routes.payments.get_ccpayment_service', return_value=ccpayment):
+            response = self.app.test_client().get(f"/api/payments/status/{deals['status']}")
+        self.assertEqual(response.get_json()['deal_status'], 'underpaid')
+        
+        with self.app.app_context():
+            for deal_id in deals.values():
+                self.assertEqual(Deal.query.get(deal_id).status, 'underpaid')
+                self.assertEqual(NotificationOutbox.query.filter_by(deal_id=deal_id).count(), 0)
+            self.assertEqual(SecurityLog.query.filter_by(event_type='payment_underpaid').count(), 3)
+            
+            # العملة الخاطئة لا تؤكد الدفع أيضاً، والمبلغ الكامل يؤكده
+            wrong_coin, paid = self._create_deal(), self._create_deal()
+            with patch.object(self.pool, 'request_refill'):
+                for order_ref, deal in (('pool-coin', wrong_coin), ('pool-paid', paid)):
+                    deal_db.session.add(DepositAddress(
+                        order_ref=order_ref, coin_type='USDT', network='POLYGON', address=f'0x{order_ref}'
+                    ))
+                    deal_db.session.commit()
+                    self.pool.acquire(deal, 'USDT', 'POLYGON')
+            self.assertEqual(confirm_payment(wrong_coin, {
+                'orderId': 'pool-coin', 'status': 'success', 'amount': '105', 'txId': '0xc', 'coinSymbol': 'BTC'
+            }, source='webhook'), 'underpaid')
+            self.assertEqual(confirm_payment(paid, {
+                'orderId': 'pool-paid', 'status': 'success', 'amount': '105', 'txId': '0xp', 'coinSymbol': 'usdt'
+            }, source='webhook'), 'confirmed')
+    
+    def test_refill_tops_up_to_target(self):
+        """اختبار إعادة تعبئة المجمع حتى العدد المطلوب"""
+        service = Mock()
+        service.create_deposit_address.side_effect = lambda order_id, coin_id, amount, chain: {
+            'success': True, 'address': f'0x{order_id}', 'data': {}
+        }
+        
+        with patch('src.services.address_pool.get_ccpayment_service', return_value=service):
+            self.assertEqual(self.pool._refill('USDT', 'POLYGON'), 3)
+            self.assertEqual(self.pool._refill('USDT', 'POLYGON'), 0)
+        
+        # العناوين تُنشأ بدون سعر وعلى شبكة المجمع
+        self.assertIsNone(service.create_deposit_address.call_args.args[2])
+        self.assertEqual(service.create_deposit_address.call_args.kwargs['chain'], 'POLYGON')
+        
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['available']['USDT/POLYGON'], 3)
+        self.assertEqual(stats['addresses_created'], 3)
+        self.assertIsNotNone(stats['avg_refill_latency'])
+
+class TestPaymentService(unittest.TestCase):
+    """اختبارات طبقة إنشاء المدفوعات المشتركة"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            deal_db.create_all()
+            deal = Deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0
+            )
+            deal_db.session.add(deal)
+            deal_db.session.commit()
+            self.deal_id = deal.id
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        with self.app.app_context():
+            deal_db.drop_all()
+    
+    def test_async_create_payment_without_http_loopback(self):
+        """اختبار إنشاء عنوان الدفع مباشرة عبر الخدمة غير المتزامنة"""
+        ccpayment = Mock()
+        ccpayment.create_deposit_address = AsyncMock(return_value={
+            'success': True, 'address': '0xabc', 'amount': 105.0,
+            'coin_name': 'USDT', 'network': 'POLYGON'
+        })
+        monitor = Mock()
+        
+        with patch('src.services.payment_service.get_async_ccpayment_service', return_value=ccpayment):
+            with self.app.app_context():
+                result = asyncio.run(AsyncPaymentService(payment_monitor=monitor).create_payment(self.deal_id, 'USDT', 'POLYGON'))
+                
+                self.assertTrue(result['success'])
+                self.assertEqual(json.loads(Deal.query.get(self.deal_id).payment_id)['address'], '0xabc')
+        
+        self.assertEqual(ccpayment.create_deposit_address.call_args.kwargs['order_id'], self.deal_id)
+        monitor.prioritize.assert_called_once_with(self.deal_id)
+    
+    def test_create_payment_validation_errors(self):
+        """اختبار أخطاء التحقق ورموز HTTP المناسبة"""
+        service = AsyncPaymentService()
+        
+        with self.app.app_context():
+            self.assertEqual(asyncio.run(service.create_payment('missing_deal'))['status_code'], 404)
+            self.assertEqual(asyncio.run(service.create_payment(self.deal_id, 'DOGE'))['status_code'], 400)
+            self.assertEqual(asyncio.run(service.create_payment(self.deal_id, 'USDT', 'SOLANA'))['status_code'], 400)
+
+class TestTelegramWebhook(unittest.TestCase):
+    """اختبارات استقبال تحديثات Telegram بوضع webhook"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        import threading
+        self.app = create_test_app(self)
+        
+        # بوت بطابور سعته تحديث واحد، وevent loop يعمل في thread منفصل
+        self.bot = OTCBot("TEST_TOKEN", self.app, update_queue_size=1)
+        self.bot.mode = 'webhook'
+        self.bot.webhook_secret = 'test_secret'
+        self.bot.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.bot.loop.run_forever, daemon=True).start()
+        set_telegram_bot(self.bot)
+        
+        self.client = self.app.test_client()
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        set_telegram_bot(None)
+        self.bot.stop_webhook()
+    
+    def _post_update(self, update_id, secret='test_secret'):
+        return self.client.post(
+            '/api/telegram/webhook',
+            json={'update_id': update_id},
+            headers={'X-Telegram-Bot-Api-Secret-Token': secret}
+        )
+    
+    @patch('src.routes.telegram_webhook.UPDATE_QUEUE_TIMEOUT', 0.1)
+    def test_secret_token_and_backpressure(self):
+        """اختبار رفض الرمز السري الخاطئ ورفض التحديثات عند امتلاء الطابور"""
+        with patch.object(OTCBot, 'is_accepting_updates', return_value=True):
+            self.assertEqual(self._post_update(1, secret='wrong').status_code, 403)
+            self.assertEqual(self._post_update(1).status_code, 200)
+            self.assertEqual(self._post_update(2).status_code, 503)
+        
+        stats = self.bot.get_update_queue_stats()
+        self.assertEqual(stats['queue_size'], 1)
+        self.assertEqual(stats['accepted'], 1)
+        self.assertEqual(stats['rejected'], 1)
+    
+    def test_rejects_updates_when_not_in_webhook_mode(self):
+        """اختبار رفض التحديثات إذا لم يكن البوت يعمل بوضع webhook"""
+        self.assertEqual(self._post_update(1).status_code, 503)
+
+    def test_receiver_stores_updates_for_separate_handlers_process(self):
+        """اختبار حفظ التحديثات في صندوق الوارد ونقلها بقدر المساحة الفارغة في الطابور"""
+        set_telegram_bot(None)
+        set_update_forwarding('test_secret')
+        self.addCleanup(set_update_forwarding, None)
+        with self.app.app_context():
+            deal_db.create_all()
+
+        self.assertEqual(self._post_update(1, secret='wrong').status_code, 403)
+        for update_id in (1, 2, 3, 1):
+            self.assertEqual(self._post_update(update_id).status_code, 200)
+
+        with self.app.app_context():
+            self.assertEqual(TelegramUpdateInbox.query.count(), 3)
+
+        repository = BotRepository(self.app)
+        self.addCleanup(repository.shutdown)
+        application = Mock()
+        application.update_queue = asyncio.Queue(maxsize=2)
+        reader = UpdateInboxReader(application, repository)
+
+        async def pump():
+            return await reader.pump_once(), await reader.pump_once()
+
+        self.assertEqual(asyncio.run(pump()), (2, 0))
+        queue = application.update_queue
+        self.assertEqual([queue.get_nowait().update_id for _ in range(2)], [1, 2])
+        self.assertEqual(reader.get_stats()['full_queue_count'], 1)
+        with self.app.app_context():
+            rows = TelegramUpdateInbox.query.order_by(TelegramUpdateInbox.update_id).all()
+            self.assertEqual([(row.update_id, row.status) for row in rows],
+                             [(1, 'claimed'), (2, 'claimed'), (3, 'pending')])
+
+        # إعادة إرسال Telegram لتحديث سُحب من قبل لا تُعالج مرة أخرى
+        self.assertEqual(self._post_update(1).status_code, 200)
+        self.assertEqual(asyncio.run(pump()), (1, 0))
+        self.assertEqual([queue.get_nowait().update_id for _ in range(queue.qsize())], [3])
+
+        # حذف التحديثات المسحوبة حسب عمرها فقط
+        self.assertEqual(asyncio.run(repository.purge_telegram_updates(datetime.utcnow() - timedelta(days=1))), 0)
+        self.assertEqual(asyncio.run(repository.purge_telegram_updates(datetime.utcnow() + timedelta(seconds=1))), 3)
+
+    def test_updates_are_ordered_per_chat_and_concurrent_across_chats(self):
+        """اختبار الترتيب داخل المحادثة والتوازي بين المحادثات"""
+        from telegram import Update
+        processor = ChatOrderedUpdateProcessor(max_concurrent_updates=10)
+        events = []
+        
+        def make_update(chat_id):
+            update = Mock(spec=Update)
+            update.effective_chat.id = chat_id
+            return update
+        
+        async def handler(name, delay):
+            events.append(f'start_{name}')
+            await asyncio.sleep(delay)
+            events.append(f'end_{name}')
+        
+        async def run():
+            await asyncio.gather(
+                processor.process_update(make_update(1), handler('a1', 0.05)),
+                processor.process_update(make_update(1), handler('a2', 0)),
+                processor.process_update(make_update(2), handler('b1', 0))
+            )
+        
+        asyncio.run(run())
+        
+        # a2 لا يبدأ قبل انتهاء a1، بينما b1 لا ينتظر a1
+        self.assertLess(events.index('end_a1'), events.index('start_a2'))
+        self.assertLess(events.index('end_b1'), events.index('end_a1'))
+        
+        stats = processor.get_stats()
+        self.assertEqual(stats['processed_count'], 3)
+        self.assertEqual(stats['max_chat_depth'], 2)
+        self.assertEqual(stats['active_chats'], 0)
+
+    def test_busy_chat_does_not_hold_all_concurrency_slots(self):
+        """اختبار أن تحديثات محادثة واحدة تزيد عن حد التوازي لا تؤخر محادثة أخرى"""
+        from telegram import Update
+        processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2)
+        events = []
+
+        def make_update(chat_id):
+            update = Mock(spec=Update)
+            update.effective_chat.id = chat_id
+            return update
+
+        async def handler(name, delay):
+            events.append(f'start_{name}')
+            await asyncio.sleep(delay)
+            events.append(f'end_{name}')
+
+        async def run():
+            busy = [processor.process_update(make_update(1), handler(f'a{i}', 0.02)) for i in range(5)]
+            await asyncio.gather(*busy, processor.process_update(make_update(2), handler('b1', 0)))
+
+        asyncio.run(run())
+
+        # b1 يعمل أثناء التحديث الأول للمحادثة المشغولة بدل انتظار تحديثاتها الخمسة
+        self.assertLess(events.index('end_b1'), events.index('end_a0'))
+        self.assertEqual([event for event in events if event.startswith('start_a')],
+                         [f'start_a{i}' for i in range(5)])
+        self.assertEqual(processor.get_stats()['processed_count'], 6)
+
+    def test_concurrency_limit_applies_across_chats(self):
+        """اختبار أن حد التوازي يبقى مطبقاً عند وصول تحديثات محادثات كثيرة"""
+        from telegram import Update
+        processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2)
+        running = []
+        peak = []
+
+        def make_update(chat_id):
+            update = Mock(spec=Update)
+            update.effective_chat.id = chat_id
+            return update
+
+        async def handler():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        async def run():
+            await asyncio.gather(*[processor.process_update(make_update(chat_id), handler()) for chat_id in range(6)])
+
+        asyncio.run(run())
+
+        self.assertEqual(max(peak), 2)
+        stats = processor.get_stats()
+        self.assertEqual((stats['max_concurrent_updates'], stats['active_updates'], stats['processed_count']), (2, 0, 6))
+
+class TestBotRepository(unittest.TestCase):
+    """اختبارات طبقة الوصول للبيانات الخاصة بالبوت"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            user_db.create_all()
+            deal_db.create_all()
+        
+        self.repository = BotRepository(self.app, max_workers=2)
+        deal_card_cache.clear()
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        self.repository.shutdown()
+        with self.app.app_context():
+            deal_db.drop_all()
+    
+    def test_snapshots_and_conditional_update(self):
+        """اختبار إرجاع نسخ ثابتة والتحديث المشروط بالحالة"""
+        async def run():
+            deal = await self.repository.create_deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0
+            )
+            paid = await self.repository.update_deal(deal.id, buyer_id=987654321, status='paid')
+            # الحالة لم تعد pending، فلا يتم التحديث
+            stale = await self.repository.update_deal(deal.id, expected_status='pending', status='disputed')
+            total, deals = await self.repository.get_seller_deals(123456789)
+            return deal, paid, stale, total, deals
+        
+        deal, paid, stale, total, deals = asyncio.run(run())
+        
+        self.assertEqual(deal.status, 'pending')
+        self.assertEqual(paid.status, 'paid')
+        self.assertEqual(paid.buyer_id, 987654321)
+        self.assertIsNone(stale)
+        self.assertEqual(total, 1)
+        self.assertEqual(deals[0].id, deal.id)
+        with self.assertRaises(Exception):
+            deal.status = 'completed'
+    
+    def test_slow_database_work_does_not_block_loop(self):
+        """اختبار أن عمل قاعدة البيانات البطيء لا يحجز الـ event loop"""
+        monitor = LoopLagMonitor(interval=0.01)
+        
+        async def run():
+            monitor.start()
+            calls = asyncio.gather(*[self.repository.run(time.sleep, 0.1) for _ in range(3)])
+            await asyncio.sleep(0.05)
+            busy = self.repository.get_stats()
+            await calls
+            monitor.stop()
+            return busy
+        
+        busy = asyncio.run(run())
+        
+        stats = monitor.get_stats()
+        self.assertGreater(stats['samples'], 3)
+        self.assertLess(stats['max_lag'], 0.05)
+        # عاملان فقط، فالطلب الثالث ينتظر في الطابور
+        self.assertEqual((busy['in_flight'], busy['running'], busy['queued']), (3, 2, 1))
+        repository_stats = self.repository.get_stats()
+        self.assertEqual(repository_stats['calls_count'], 3)
+        self.assertEqual((repository_stats['in_flight'], repository_stats['queued']), (0, 0))
+    
+    def test_known_user_cache(self):
+        """اختبار تخطي التسجيل للمستخدم المعروف وتجميع تغييرات البيانات"""
+        cache = KnownUserCache(self.repository)
+        user = Mock(id=123456789, username="testuser", first_name="Test", last_name="User")
+        renamed = Mock(id=123456789, username="newname", first_name="Test", last_name="User")
+        
+        async def run():
+            results = [await cache.ensure_user(user) for _ in range(3)]
+            results.append(await cache.ensure_user(renamed))
+            calls_before_flush = self.repository.get_stats()['calls_count']
+            flushed = await cache.flush()
+            return results, calls_before_flush, flushed
+        
+        results, calls_before_flush, flushed = asyncio.run(run())
+        
+        self.assertEqual(results, ['miss', 'hit', 'hit', 'changed'])
+        # upsert واحد فقط قبل كتابة التغييرات
+        self.assertEqual(calls_before_flush, 1)
+        self.assertEqual(flushed, 1)
+        
+        with self.app.app_context():
+            users = TelegramUser.query.filter_by(telegram_id=123456789).all()
+            self.assertEqual(len(users), 1)
+            self.assertEqual(users[0].username, "newname")
+        
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['pending_changes'], 0)
+    
+    def test_deal_card_cache(self):
+        """اختبار أن بطاقة الصفقة المشهورة لا تكلف استعلاماً وتُبطل عند التعديل"""
+        async def create():
+            await self.repository.upsert_users({123456789: ("seller", "Seller", None)})
+            return await self.repository.create_deal(
+                seller_id=123456789,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0,
+                media_files=json.dumps([{'type': 'photo', 'file_id': 'photo_1'}])
+            )
+        
+        deal = asyncio.run(create())
+        
+        async def open_card(times):
+            return [await self.repository.get_deal_card(deal.id) for _ in range(times)]
+        
+        cards = asyncio.run(open_card(3))
+        calls = self.repository.get_stats()['calls_count']
+        cards += asyncio.run(open_card(2))
+        
+        # بعد أول فتح لا توجد أي استعلامات
+        self.assertEqual(self.repository.get_stats()['calls_count'], calls)
+        self.assertIs(cards[0], cards[-1])
+        self.assertIn("Seller", cards[0].text)
+        self.assertEqual(cards[0].media, (('photo', 'photo_1'),))
+        self.assertEqual(deal_card_cache.get_stats()['hits'], 4)
+        # البوت يقرأ إحصائيات نفس الذاكرة التي يملؤها المستودع
+        self.assertEqual(self.repository.get_deal_card_stats(), deal_card_cache.get_stats())
+        
+        # تعديل الحالة عبر ORM يبطل البطاقة
+        with self.app.app_context():
+            Deal.query.get(deal.id).status = 'paid'
+            deal_db.session.commit()
+        self.assertEqual(asyncio.run(open_card(1))[0].status, 'paid')
+        
+        # تغيير اسم البائع يبطل بطاقات صفقاته
+        asyncio.run(self.repository.upsert_users({123456789: ("seller", "Renamed", None)}))
+        self.assertIn("Renamed", asyncio.run(open_card(1))[0].text)
+
+    def test_conversation_store_survives_restart(self):
+        """اختبار استئناف خطوات إنشاء الصفقة بعد إعادة التشغيل وحذف الحالات الخاملة من الذاكرة"""
+        async def run():
+            store = ConversationStore(self.repository)
+            store.start(123456789, 'deal_creation', 'title')
+            store.update(123456789, 'description', title="Test Product")
+            store.start(987654321, 'dispute', 'description', deal_id="deal-1", reason="other")
+            store.finish(987654321)
+            await store.flush()
+            
+            # نسخة جديدة (بعد إعادة التشغيل) تقرأ الحالة من قاعدة البيانات
+            restarted = ConversationStore(self.repository, idle_ttl=0)
+            resumed = await restarted.get(123456789)
+            finished = await restarted.get(987654321)
+            restarted._evict()
+            entries_after_evict = restarted.get_stats()['entries']
+            reloaded = await restarted.get(123456789)
+            return resumed, finished, entries_after_evict, reloaded, restarted.get_stats()
+        
+        resumed, finished, entries_after_evict, reloaded, stats = asyncio.run(run())
+        
+        self.assertEqual((resumed.flow, resumed.step), ('deal_creation', 'description'))
+        self.assertEqual(resumed.data, {'title': "Test Product"})
+        self.assertIsNone(finished)
+        self.assertEqual(entries_after_evict, 0)
+        self.assertEqual(reloaded.data['title'], "Test Product")
+        self.assertEqual(stats['loads'], 3)
+
+class TestCallbackRouter(unittest.TestCase):
+    """اختبارات جدول توجيه الأزرار"""
+    
+    def test_bot_routes(self):
+        """اختبار أطول بادئة مطابقة وتحليل المعاملات ووصول مسارات النزاعات"""
+        bot = OTCBot("TEST_TOKEN", app)
+        bot.setup_dispute_handlers()
+        router = bot.callback_router
+        
+        route, args = router.resolve("main_menu")
+        self.assertEqual((route.name, args), ("main_menu", ()))
+        
+        route, args = router.resolve("dispute_reason_not_received_deal-1")
+        self.assertEqual(route.handler, bot.handle_dispute_reason)
+        self.assertEqual(args, ("not_received", "deal-1"))
+        
+        route, args = router.resolve("dispute_deal-1")
+        self.assertEqual(route.handler, bot.handle_dispute)
+        
+        route, args = router.resolve("rating_5_987654321_deal-1")
+        self.assertEqual(args, (5, 987654321, "deal-1"))
+        
+        self.assertEqual(router.resolve("unknown")[0], None)
+    
+    def test_dispatch_stats(self):
+        """اختبار تسجيل الاستدعاءات والبيانات غير المعروفة أو غير الصالحة"""
+        router = CallbackRouter()
+        handler = AsyncMock()
+        router.add_prefix("buy_deal_", handler)
+        router.add_prefix("rate_user_", AsyncMock(), lambda rest: (int(rest),))
+        
+        async def run():
+            return [
+                await router.dispatch(Mock(data="buy_deal_deal-1"), "context"),
+                await router.dispatch(Mock(data="buy_deal_"), "context"),
+                await router.dispatch(Mock(data="rate_user_abc"), "context"),
+                await router.dispatch(Mock(data="sell_deal_deal-1"), "context")
+            ]
+        
+        self.assertEqual(asyncio.run(run()), [True, False, False, False])
+        handler.assert_awaited_once()
+        self.assertEqual(handler.await_args.args[1:], ("context", "deal-1"))
+        
+        stats = router.get_stats()
+        self.assertEqual(stats['routes']['buy_deal_*']['calls'], 1)
+        self.assertEqual(stats['invalid'], 2)
+        self.assertEqual(stats['unmatched'], 1)
+    
+    def test_encoded_callbacks(self):
+        """اختبار ترميز أزرار الصفقات ووسم HMAC والتوجيه حسب الإجراء"""
+        deal_id = "0f8fad5b-d9cb-469f-a165-70867728950e"
+        codec = CallbackCodec("test_secret")
+        
+        data = codec.encode("pay_usdt_polygon", deal_id)
+        # 53 بايت بالشكل النصي، و 30 مع وسم HMAC
+        self.assertEqual(len(data), 30)
+        self.assertEqual(codec.decode(data), ("pay_usdt_polygon", deal_id, ()))
+        
+        data = codec.encode("rating", deal_id, 5, 987654321)
+        self.assertEqual(codec.decode(data), ("rating", deal_id, ("5", "987654321")))
+        with self.assertRaises(ValueError):
+            codec.decode(data[:-1] + ("A" if data[-1] != "A" else "B"))
+        with self.assertRaises(ValueError):
+            CallbackCodec("other_secret").decode(data)
+        
+        bot = OTCBot("TEST_TOKEN", app)
+        bot.setup_dispute_handlers()
+        route, args = bot.callback_router.resolve(encode_callback("dispute_reason", deal_id, "not_received"))
+        self.assertEqual(route.handler, bot.handle_dispute_reason)
+        self.assertEqual(args, ("not_received", deal_id))
+        route, args = bot.callback_router.resolve(encode_callback("rating", deal_id, 4, 123456789))
+        self.assertEqual(args, (4, 123456789, deal_id))
+
+class TestMediaGroups(unittest.TestCase):
+    """اختبارات تجميع الألبومات وإرسالها"""
+    
+    def test_album_parts_complete_once(self):
+        """اختبار تجميع أجزاء الألبوم واستدعاء الإكمال مرة واحدة"""
+        collector = MediaGroupCollector(window=0.05)
+        completed = []
+        
+        async def on_complete(items):
+            completed.append(items)
+        
+        async def run():
+            for index in range(3):
+                collector.add((123456789, 'album_1'), {'type': 'photo', 'file_id': f'photo_{index}'}, on_complete)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+        
+        asyncio.run(run())
+        
+        self.assertEqual(len(completed), 1)
+        self.assertEqual([item['file_id'] for item in completed[0]], ['photo_0', 'photo_1', 'photo_2'])
+        self.assertEqual(collector.get_stats()['pending_groups'], 0)
+    
+    def test_deal_media_sent_as_one_group(self):
+        """اختبار إرسال وسائط الصفقة في طلب واحد"""
+        bot = AsyncMock()
+        media = (('photo', 'photo_1'), ('video', 'video_1'), ('photo', 'photo_2'))
+        
+        asyncio.run(OTCBot.send_deal_media(bot, 123456789, media))
+        
+        bot.send_media_group.assert_awaited_once()
+        self.assertEqual(len(bot.send_media_group.await_args.kwargs['media']), 3)
+        bot.send_photo.assert_not_awaited()
+        
+        asyncio.run(OTCBot.send_deal_media(bot, 123456789, media[:1]))
+        bot.send_photo.assert_awaited_once()
+
+class TestRenderedMessageCache(unittest.TestCase):
+    """اختبارات تجاهل تعديل الرسائل بنفس المحتوى"""
+    
+    def _query(self, message_id, text=None, reply_markup=None):
+        query = Mock()
+        query.message.chat.id = 123456789
+        query.message.message_id = message_id
+        query.message.text = text
+        query.message.reply_markup = reply_markup
+        query.edit_message_text = AsyncMock()
+        return query
+    
+    def test_identical_edit_is_skipped(self):
+        """اختبار إرسال التعديل مرة واحدة عند تكرار نفس القائمة"""
+        bot = OTCBot("TEST_TOKEN", app)
+        query = self._query(1)
+        
+        async def run():
+            await bot.show_main_menu(query)
+            await bot.show_main_menu(query)
+            await bot.show_help(query)
+        
+        asyncio.run(run())
+        
+        self.assertEqual(query.edit_message_text.await_count, 2)
+        self.assertIs(query.edit_message_text.await_args_list[0].kwargs['reply_markup'], MAIN_MENU_MARKUP)
+        stats = bot.rendered_messages.get_stats()
+        self.assertEqual((stats['edited'], stats['skipped'], stats['entries']), (2, 1, 1))
+    
+    def test_current_message_content_and_not_modified_error(self):
+        """اختبار المقارنة بمحتوى الرسالة الحالي وتجاهل خطأ 'message is not modified'"""
+        from telegram.error import BadRequest
+        bot = OTCBot("TEST_TOKEN", app)
+        
+        # الرسالة تعرض القائمة الرئيسية بالفعل (Telegram يحذف المسافات في الطرفين)
+        shown = self._query(2, "🏠 القائمة الرئيسية\n\nاختر الخدمة المطلوبة:", MAIN_MENU_MARKUP)
+        asyncio.run(bot.show_main_menu(shown))
+        shown.edit_message_text.assert_not_awaited()
+        
+        rejected = self._query(3)
+        rejected.edit_message_text.side_effect = BadRequest("Message is not modified: specified new message content is the same")
+        self.assertFalse(asyncio.run(bot.edit_message(rejected, "text")))
+        # التعديل التالي بنفس المحتوى لا يصل إلى Telegram
+        self.assertFalse(asyncio.run(bot.edit_message(rejected, "text")))
+        self.assertEqual(rejected.edit_message_text.await_count, 1)
+
+class TestRateLimiter(unittest.TestCase):
+    """اختبارات محدد معدل الرسائل الصادرة"""
+    
+    def _send(self, limiter, chat_id, sent, name, priority=None, callback=None):
+        async def default_callback():
+            sent.append(name)
+            return True
+        
+        return limiter.process_request(
+            callback=callback or default_callback, args=(), kwargs={},
+            endpoint='sendMessage', data={'chat_id': chat_id}, rate_limit_args=priority
+        )
+    
+    def test_per_chat_limit_and_priority(self):
+        """اختبار حد المحادثة وتقديم الإشعارات الفورية على الرسائل الجماعية"""
+        limiter = PriorityRateLimiter(overall_rate=20, overall_burst=1, private_rate=10,
+                                      private_burst=1, bulk_reserve=0)
+        sent = []
+        
+        async def run():
+            started = time.monotonic()
+            for index in range(3):
+                await self._send(limiter, 123456789, sent, f"chat_{index}")
+            elapsed = time.monotonic() - started
+            
+            # رسالة جماعية تنتظر الرمز التالي، ثم يصل إشعار فوري
+            bulk = asyncio.ensure_future(self._send(limiter, 1, sent, "bulk", BULK_PRIORITY))
+            await asyncio.sleep(0)
+            await self._send(limiter, 2, sent, "priority")
+            await bulk
+            return elapsed
+        
+        elapsed = asyncio.run(run())
+        
+        self.assertGreaterEqual(elapsed, 0.18)
+        self.assertEqual(sent[3:], ["priority", "bulk"])
+        self.assertEqual(limiter.get_stats()['bulk_count'], 1)
+    
+    def test_retry_after(self):
+        """اختبار إعادة الطلب تلقائياً بعد RetryAfter"""
+        from telegram.error import RetryAfter
+        limiter = PriorityRateLimiter()
+        calls = []
+        
+        async def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RetryAfter(0)
+            return True
+        
+        result = asyncio.run(self._send(limiter, 123456789, [], "flaky", callback=flaky))
+        
+        self.assertTrue(result)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(limiter.get_stats()['retry_after_count'], 1)
+
+class TestNotificationOutbox(unittest.TestCase):
+    """اختبارات صندوق صادر الإشعارات"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            deal_db.create_all()
+            deal = Deal(
+                seller_id=123456789,
+                buyer_id=987654321,
+                title="Test Product",
+                description="Test Description",
+                price=100.0,
+                commission=5.0,
+                total_price=105.0,
+                payment_id=json.dumps({'address': '0xabc'})
+            )
+            deal_db.session.add(deal)
+            deal_db.session.commit()
+            self.deal_id = deal.id
+        
+        self.repository = BotRepository(self.app, max_workers=2)
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        self.repository.shutdown()
+        with self.app.app_context():
+            deal_db.drop_all()
+    
+    def test_webhook_payment_enqueues_notifications_once(self):
+        """اختبار كتابة إشعارات الدفع مع تحديث الصفقة ومنع تكرارها"""
+        consumer = WebhookConsumer(self.app, batch_size=10)
+        payload = json.dumps({'orderId': self.deal_id, 'status': 'success', 'amount': 105.0, 'txId': '0xtx'})
+        
+        with self.app.app_context():
+            deal_db.session.add(WebhookInbox(payload=payload))
+            deal_db.session.add(WebhookInbox(payload=payload))
+            deal_db.session.commit()
+        
+        self.assertEqual(consumer.drain_once(), 2)
+        
+        with self.app.app_context():
+            entries = NotificationOutbox.query.order_by(NotificationOutbox.id).all()
+            self.assertEqual([entry.chat_id for entry in entries], [123456789, 987654321])
+            self.assertEqual({entry.status for entry in entries}, {'pending'})
+            
+            # إعادة نفس الحدث من مصدر آخر لا تضيف إشعارات
+            self.assertEqual(enqueue_notification(Deal.query.get(self.deal_id), *PAYMENT_CONFIRMED), 0)
+    
+    def test_dispatcher_sends_retries_and_fails(self):
+        """اختبار الإرسال وإعادة المحاولة للأخطاء المؤقتة وعدم إعادتها للمستخدم الذي حظر البوت"""
+        from telegram.error import Forbidden, NetworkError
+        
+        with self.app.app_context():
+            deal = Deal.query.get(self.deal_id)
+            enqueue_notification(deal, *PAYMENT_CONFIRMED)
+            enqueue_notification(deal, 'dispute_resolved', key='dispute-1', resolution="Refund")
+            deal_db.session.commit()
+        
+        async def send_message(chat_id, text, reply_markup=None):
+            if chat_id == 987654321 and 'تم حل النزاع' in text:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            if chat_id == 123456789 and 'تم حل النزاع' in text:
+                raise NetworkError("Connection reset")
+        
+        bot = AsyncMock()
+        bot.send_message.side_effect = send_message
+        dispatcher = NotificationDispatcher(bot, self.repository, retry_delay=60)
+        
+        self.assertEqual(asyncio.run(dispatcher.dispatch_once()), 4)
+        # المؤجل لا يُعاد قبل موعده
+        self.assertEqual(asyncio.run(dispatcher.dispatch_once()), 0)
+        
+        with self.app.app_context():
+            statuses = {
+                (entry.kind, entry.chat_id): (entry.status, entry.attempts)
+                for entry in NotificationOutbox.query.all()
+            }
+        self.assertEqual(statuses[('seller_payment_received', 123456789)], ('sent', 1))
+        self.assertEqual(statuses[('dispute_resolved', 987654321)], ('failed', 1))
+        self.assertEqual(statuses[('dispute_resolved', 123456789)], ('pending', 1))
+        self.assertEqual(dispatcher.get_stats()['retried_count'], 1)
+    
+    def test_bot_action_writes_notification_with_deal_update(self):
+        """اختبار كتابة إشعار المشتري مع تأكيد التسليم في نفس المعاملة"""
+        async def run():
+            await self.repository.update_deal(self.deal_id, status='paid')
+            confirmed = await self.repository.update_deal(
+                self.deal_id, expected_status='paid', status='confirmed', notify=('delivery_confirmed',)
+            )
+            stale = await self.repository.update_deal(
+                self.deal_id, expected_status='paid', status='confirmed', notify=('delivery_confirmed',)
+            )
+            return confirmed, stale
+        
+        confirmed, stale = asyncio.run(run())
+        
+        self.assertEqual(confirmed.status, 'confirmed')
+        self.assertIsNone(stale)
+        with self.app.app_context():
+            entries = NotificationOutbox.query.all()
+            self.assertEqual([(entry.kind, entry.chat_id) for entry in entries],
+                             [('delivery_confirmed', 987654321)])
+
+class TestBroadcastEngine(unittest.TestCase):
+    """اختبارات حملات البث القابلة للاستئناف"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            user_db.create_all()
+        
+        self.repository = BotRepository(self.app, max_workers=2)
+        asyncio.run(self.repository.upsert_users({
+            telegram_id: (None, f"user_{telegram_id}", None) for telegram_id in range(1, 6)
+        }))
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        self.repository.shutdown()
+        with self.app.app_context():
+            user_db.drop_all()
+    
+    def _create_campaign(self, **fields):
+        with self.app.app_context():
+            campaign = BroadcastCampaign(message="Test broadcast", **fields)
+            user_db.session.add(campaign)
+            user_db.session.commit()
+            return campaign.id
+    
+    def test_campaign_checkpoints_and_excludes_blocked_users(self):
+        """اختبار الإرسال على دفعات وتسجيل المستخدمين الذين حظروا البوت"""
+        from telegram.error import Forbidden
+        bot = AsyncMock()
+        
+        async def send_message(chat_id, **kwargs):
+            if chat_id == 3:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+        
+        bot.send_message.side_effect = send_message
+        invalidated = []
+        engine = BroadcastEngine(bot, self.repository, batch_size=2, on_blocked=invalidated.append)
+        campaign_id = self._create_campaign()
+        
+        async def run():
+            campaign = await self.repository.claim_broadcast_campaign()
+            return await engine.run_campaign(campaign)
+        
+        self.assertEqual(asyncio.run(run()), 'completed')
+        
+        with self.app.app_context():
+            campaign = BroadcastCampaign.query.get(campaign_id)
+            self.assertEqual((campaign.status, campaign.last_user_id), ('completed', 5))
+            self.assertEqual((campaign.sent_count, campaign.blocked_count), (4, 1))
+            self.assertEqual(BroadcastRecipient.query.filter_by(campaign_id=campaign_id).count(), 5)
+            self.assertFalse(TelegramUser.query.filter_by(telegram_id=3).first().is_active)
+        self.assertEqual(invalidated, [3])
+        self.assertEqual(engine.get_stats()['batches_count'], 3)
+        self.assertEqual(bot.send_message.await_args.kwargs['rate_limit_args'], BULK_PRIORITY)
+    
+    def test_running_campaign_resumes_from_checkpoint(self):
+        """اختبار استئناف حملة جارية بعد إعادة التشغيل من آخر مستخدم محفوظ"""
+        bot = AsyncMock()
+        engine = BroadcastEngine(bot, self.repository, batch_size=2)
+        campaign_id = self._create_campaign(status='running', last_user_id=2, sent_count=2)
+        
+        async def run():
+            campaign = await self.repository.claim_broadcast_campaign()
+            return campaign, await engine.run_campaign(campaign)
+        
+        campaign, result = asyncio.run(run())
+        
+        self.assertEqual((campaign.id, result), (campaign_id, 'completed'))
+        self.assertEqual([call.kwargs['chat_id'] for call in bot.send_message.await_args_list], [3, 4, 5])
+        with self.app.app_context():
+            self.assertEqual(BroadcastCampaign.query.get(campaign_id).sent_count, 5)
+
+    def test_campaign_failing_repeatedly_is_marked_failed(self):
+        """اختبار وضع الحملة failed بعد أخطاء متتالية بدلاً من إعادتها للأبد"""
+        engine = BroadcastEngine(AsyncMock(), self.repository, poll_interval=0.01, max_campaign_errors=3)
+        campaign_id = self._create_campaign()
+
+        async def run():
+            engine.start()
+            for _ in range(200):
+                if engine.get_stats()['campaigns_failed']:
+                    break
+                await asyncio.sleep(0.01)
+            await engine.stop()
+
+        with patch.object(self.repository, 'get_broadcast_recipients', AsyncMock(side_effect=RuntimeError("boom"))):
+            asyncio.run(run())
+
+        stats = engine.get_stats()
+        self.assertEqual((stats['campaigns_failed'], stats['errors_count']), (1, 3))
+        with self.app.app_context():
+            self.assertEqual(BroadcastCampaign.query.get(campaign_id).status, 'failed')
+        self.assertIsNone(asyncio.run(self.repository.claim_broadcast_campaign()))
+
+        # الحملة الفاشلة يمكن استئنافها من الـ API
+        client = self.app.test_client()
+        response = client.post(f'/api/broadcasts/{campaign_id}/resume')
+        self.assertEqual(response.get_json()['campaign']['status'], 'running')
+
+    def test_create_campaign_validates_keyboard(self):
+        """اختبار رفض لوحة أزرار لا يمكن إرسالها عند إنشاء الحملة"""
+        client = self.app.test_client()
+        for keyboard in ([['Button']], [[{'url': 'https://example.com'}]], 'buttons'):
+            response = client.post('/api/broadcasts', json={'message': "Hello", 'keyboard': keyboard})
+            self.assertEqual(response.status_code, 400)
+
+        keyboard = [[{'text': "Open", 'url': 'https://example.com'}]]
+        response = client.post('/api/broadcasts', json={'message': "Hello", 'keyboard': keyboard})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['campaign']['keyboard'], keyboard)
+
+class TestSchemaIndexes(unittest.TestCase):
+    """اختبارات فهارس الاستعلامات المتكررة وترحيلها"""
+    
+    DEALS_COUNT = 20000
+    
+    def setUp(self):
+        """إعداد قاعدة بيانات مرحّلة مع بيانات اصطناعية"""
+        self.app = create_test_app(self)
+        
+        SchemaMigrator(self.app).migrate()
+        
+        with self.app.app_context():
+            self.now = datetime.utcnow()
+            # 10% معلقة، ثلثها فقط لديه عنوان دفع
+            statuses = ['completed'] * 14 + ['cancelled'] * 3 + ['paid', 'pending', 'pending']
+            deals = []
+            for i in range(self.DEALS_COUNT):
+                status = statuses[i % len(statuses)]
+                deals.append({
+                    'id': f"deal-{i}",
+                    'seller_id': 1000 + i % 2000,
+                    'buyer_id': 5000 + i % 3000,
+                    'title': "Product",
+                    'description': "Description",
+                    'price': 100.0,
+                    'commission': 5.0,
+                    'total_price': 105.0,
+                    'status': status,
+                    'payment_id': '{}' if status == 'pending' and i % 3 == 0 else None,
+                    'created_at': self.now - timedelta(minutes=i)
+                })
+            deal_db.session.execute(Deal.__table__.insert(), deals)
+            
+            deal_db.session.execute(UserRating.__table__.insert(), [
+                {'deal_id': f"deal-{i}", 'rater_id': 5000 + i % 3000, 'rated_id': 1000 + i % 2000,
+                 'rating': 1 + i % 5, 'created_at': self.now}
+                for i in range(0, self.DEALS_COUNT, 2)
+            ])
+            deal_db.session.execute(SecurityLog.__table__.insert(), [
+                {'user_id': 1000 + i % 2000, 'event_type': 'login', 'severity': 'info',
+                 'description': "Login", 'created_at': self.now - timedelta(minutes=i)}
+                for i in range(0, self.DEALS_COUNT, 2)
+            ])
+            deal_db.session.execute(deal_db.text('ANALYZE'))
+            deal_db.session.commit()
+    
+    def tearDown(self):
+        """تنظيف البيانات بعد الاختبار"""
+        with self.app.app_context():
+            deal_db.session.remove()
+            deal_db.drop_all()
+    
+    def test_hot_queries_use_indexes(self):
+        """اختبار عدم رجوع الاستعلامات المتكررة إلى قراءة الجدول كاملاً"""
+        from sqlalchemy import select, func, or_
+        
+        day_ago = self.now - timedelta(days=1)
+        queries = {
+            # مراقب الدفع
+            'pending_payments': (select(Deal.id, Deal.created_at).where(
+                Deal.status == 'pending', Deal.payment_id.isnot(None)
+            ), 'ix_deals_awaiting_payment'),
+            'expired_payments': (select(Deal).where(
+                Deal.status == 'pending', Deal.created_at < day_ago, Deal.payment_id.isnot(None)
+            ), 'ix_deals_awaiting_payment'),
+            'reconcile': (select(Deal).where(
+                Deal.status.in_(['pending', 'paid']), Deal.payment_id.isnot(None), Deal.created_at >= day_ago
+            ), None),
+            'cleanup': (select(Deal).where(
+                Deal.status == 'cancelled', Deal.created_at < day_ago
+            ), 'ix_deals_status_created'),
+            # صفقات المستخدم
+            'seller_deals': (select(Deal).where(Deal.seller_id == 1001).limit(5), 'ix_deals_seller_created'),
+            'buyer_deals': (select(Deal).where(Deal.buyer_id == 5001), 'ix_deals_buyer_created'),
+            'cancelled_by_user': (select(func.count()).select_from(Deal).where(
+                or_(Deal.seller_id == 1001, Deal.buyer_id == 1001),
+                Deal.status == 'cancelled', Deal.created_at >= day_ago
+            ), None),
+            # لوحة المراقبة
+            'daily_deals': (select(func.count()).select_from(Deal).where(
+                Deal.created_at >= day_ago, Deal.created_at < self.now
+            ), 'ix_deals_created_at'),
+            'recent_deals': (select(Deal).order_by(Deal.created_at.desc()).limit(20), 'ix_deals_created_at'),
+            # النزاعات والتقييمات والحظر وسجل الأمان
+            'open_dispute': (select(Dispute).where(
+                Dispute.deal_id == 'deal-1', Dispute.status == 'open'
+            ), 'ix_disputes_deal_status'),
+            'bad_ratings': (select(func.count()).select_from(UserRating).where(
+                UserRating.rated_id == 1001, UserRating.rating <= 2
+            ), 'ix_user_ratings_rated_rating'),
+            'active_ban': (select(UserBan).where(
+                UserBan.user_id == 1001, UserBan.is_active == True
+            ), 'ix_user_bans_user_active'),
+            'security_logs': (select(SecurityLog).order_by(SecurityLog.created_at.desc()).limit(50),
+                              'ix_security_logs_created_at')
+        }
+        
+        with self.app.app_context():
+            for name, (statement, index_name) in queries.items():
+                plan = explain_query_plan(statement)
+                self.assertEqual(find_full_scans(plan), [], f"{name}: {plan}")
+                if index_name:
+                    self.assertTrue(any(index_name in step for step in plan), f"{name}: {plan}")
+    
+    def test_migrate_adds_missing_indexes(self):
+        """اختبار إضافة الفهارس الناقصة إلى جداول موجودة وإعادة التشغيل بأمان"""
+        with self.app.app_context():
+            deal_db.session.execute(deal_db.text('DROP INDEX ix_deals_awaiting_payment'))
+            deal_db.session.execute(deal_db.text('DROP INDEX ix_user_bans_user_active'))
+            deal_db.session.commit()
+        
+        migrator = SchemaMigrator(self.app)
+        result = migrator.migrate()
+        self.assertEqual(sorted(result['created']), ['ix_deals_awaiting_payment', 'ix_user_bans_user_active'])
+        
+        with self.app.app_context():
+            self.assertEqual(migrator.missing_indexes(), [])
+            plan = explain_query_plan(deal_db.select(Deal.id).where(
+                Deal.status == 'pending', Deal.payment_id.isnot(None)
+            ))
+            self.assertIn('ix_deals_awaiting_payment', plan[0])
+        
+        self.assertEqual(migrator.migrate()['created'], [])
+
+    def test_migrate_adds_missing_columns(self):
+        """اختبار إضافة الأعمدة الجديدة إلى جدول موجود"""
+        with self.app.app_context():
+            deal_db.session.execute(deal_db.text('ALTER TABLE deposit_addresses DROP COLUMN expected_amount'))
+            deal_db.session.commit()
+        
+        migrator = SchemaMigrator(self.app)
+        self.assertEqual(migrator.migrate()['added_columns'], ['deposit_addresses.expected_amount'])
+        self.assertEqual(migrator.migrate()['added_columns'], [])
+
+class TestPerformance(unittest.TestCase):
+    """اختبارات الأداء"""
+    
+    def setUp(self):
+        """إعداد البيئة للاختبار"""
+        self.app = create_test_app(self)
+        
+        with self.app.app_context():
+            user_db.create_all()
+            deal_db.create_all()
+            dispute_db.create_all()
+    
+    def test_database_performance(self):
+        """اختبار أداء قاعدة البيانات"""
+        with self.app.app_context():
+            # قياس وقت إنشاء 100 صفقة
+            start_time = time.time()
+            
+            for i in range(100):
+                deal = Deal(
+                    seller_id=123456789 + i,
+                    title=f"Product {i}",
+                    description=f"Description {i}",
+                    price=100.0 + i,
+                    commission=5.0,
+                    total_price=105.0 + i
+                )
+                deal_db.session.add(deal)
+            
+            deal_db.session.commit()
+            end_time = time.time()
+            
+            creation_time = end_time - start_time
+            print(f"وقت إنشاء 100 صفقة: {creation_time:.2f} ثانية")
+            
+            # يجب أن يكون الوقت أقل من ثانية واحدة
+            self.assertLess(creation_time, 1.0)
+    
+    def test_query_performance(self):
+        """اختبار أداء الاستعلامات"""
+        with self.app.app_context():
+            # إنشاء بيانات للاختبار
+            for i in range(1000):
+                deal = Deal(
+                    seller_id=123456789 + (i % 10),
+                    title=f"Product {i}",
+                    description=f"Description {i}",
+                    price=100.0 + i,
+                    commission=5.0,
+                    total_price=105.0 + i,
+                    status='pending' if i % 2 == 0 else 'completed'
+                )
+                deal_db.session.add(deal)
+            
+            deal_db.session.commit()
+            
+            # قياس وقت الاستعلام
+            start_time = time.time()
+            
+            # استعلام معقد
+            results = Deal.query.filter(
+                Deal.status == 'pending',
+                Deal.price > 500.0
+            ).order_by(Deal.created_at.desc()).limit(50).all()
+            
+            end_time = time.time()
+            query_time = end_time - start_time
+            
+            print(f"وقت الاستعلام المعقد: {query_time:.4f} ثانية")
+            print(f"عدد النتائج: {len(results)}")
+            
+            # يجب أن يكون الوقت أقل من 0.1 ثانية
+            self.assertLess(query_time, 0.1)
+
+def run_tests():
+    """تشغيل جميع الاختبارات"""
+    print("🧪 بدء اختبارات بوت OTC")
+    print("=" * 50)
+    
+    # إنشاء مجموعة الاختبارات
+    test_suite = unittest.TestSuite()
+    
+    # إضافة اختبارات البوت الأساسية
+    test_suite.addTest(unittest.makeSuite(TestOTCBot))
+    
+    # إضافة اختبارات CCPayments
+    test_suite.addTest(unittest.makeSuite(TestCCPaymentIntegration))
+    
+    # إضافة اختبارات مراقب المدفوعات
+    test_suite.addTest(unittest.makeSuite(TestPaymentMonitor))
+    test_suite.addTest(unittest.makeSuite(TestPaymentScheduler))
+    test_suite.addTest(unittest.makeSuite(TestWebhookConsumer))
+    test_suite.addTest(unittest.makeSuite(TestWebhookReplayGuard))
+    test_suite.addTest(unittest.makeSuite(TestDepositAddressPool))
+    test_suite.addTest(unittest.makeSuite(TestPaymentService))
+    test_suite.addTest(unittest.makeSuite(TestTelegramWebhook))
+    test_suite.addTest(unittest.makeSuite(TestBotRepository))
+    test_suite.addTest(unittest.makeSuite(TestCallbackRouter))
+    test_suite.addTest(unittest.makeSuite(TestMediaGroups))
+    test_suite.addTest(unittest.makeSuite(TestRenderedMessageCache))
+    test_suite.addTest(unittest.makeSuite(TestRateLimiter))
+    test_suite.addTest(unittest.makeSuite(TestNotificationOutbox))
+    test_suite.addTest(unittest.makeSuite(TestBroadcastEngine))
+    test_suite.addTest(unittest.makeSuite(TestSchemaIndexes))
     
     # إضافة اختبارات الأداء
     test_suite.addTest(unittest.makeSuite(TestPerformance))